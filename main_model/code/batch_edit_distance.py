@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Word level Levenshtein distance of many sentence pairs at once. The dynamic
+programming table of all the pairs of a chunk is filled one anti-diagonal at
+a time, so every numpy operation covers all the pairs and all the cells of a
+diagonal. Optionally the alignments are backtracked (also over all pairs at
+once) to return the substituted word pairs.
+========================================================================"""
+import numpy as np
+from preprocess_library import flatten_batch, pad_flat
+
+
+def pad_sentences(sentences, pad_id=-1):
+    """ Pads a list of sentences (lists of ids) into an [N, max_len] int array
+    Returns:
+        padded, lengths
+    """
+    return pad_flat(*flatten_batch(sentences), pad_id=pad_id)
+
+
+def _distance_table(tx, rx):
+    """ Full dynamic programming table [N, tx_width+1, rx_width+1]"""
+    numb_pairs, tx_width = tx.shape
+    rx_width = rx.shape[1]
+    table = np.zeros([numb_pairs, tx_width+1, rx_width+1], dtype=np.int32)
+    table[:, :, 0] = np.arange(tx_width+1)
+    table[:, 0, :] = np.arange(rx_width+1)
+    for diag in range(2, tx_width+rx_width+1):
+        i = np.arange(max(1, diag-rx_width), min(tx_width, diag-1)+1)
+        j = diag - i
+        subst = table[:, i-1, j-1] + (tx[:, i-1] != rx[:, j-1])
+        table[:, i, j] = np.minimum(subst, np.minimum(table[:, i-1, j], table[:, i, j-1]) + 1)
+    return table
+
+
+def _substitutions(table, tx, rx, tx_len, rx_len):
+    """ Backtracks the alignments of all the pairs together, preferring
+    match/substitution, then insertion, then deletion (the tie-break of
+    edit_distance.SequenceMatcher, which edit_dist_with_repl_similarity uses)
+    Returns:
+        pair index, tx word, rx word of every substitution
+    """
+    rows = np.arange(len(tx))
+    # A padding column keeps the word lookups valid when a chunk has only empty sentences
+    tx = np.pad(tx, ((0, 0), (0, 1)), constant_values=-1)
+    rx = np.pad(rx, ((0, 0), (0, 1)), constant_values=-2)
+    i = tx_len.astype(np.int64)
+    j = rx_len.astype(np.int64)
+    sub_rows, sub_tx, sub_rx = [], [], []
+    active = (i > 0) | (j > 0)
+    while active.any():
+        r, ii, jj = rows[active], i[active], j[active]
+        curr = table[r, ii, jj]
+        diag_ok = (ii > 0) & (jj > 0)
+        tx_word = tx[r, np.maximum(ii-1, 0)]
+        rx_word = rx[r, np.maximum(jj-1, 0)]
+        differ = tx_word != rx_word
+        diag = diag_ok & (curr == table[r, np.maximum(ii-1, 0), np.maximum(jj-1, 0)] + differ)
+        insert = ~diag & (jj > 0) & (curr == table[r, ii, np.maximum(jj-1, 0)] + 1)
+        delete = ~diag & ~insert
+
+        replaced = diag & differ
+        sub_rows.append(r[replaced])
+        sub_tx.append(tx_word[replaced])
+        sub_rx.append(rx_word[replaced])
+
+        i[active] = ii - (diag | delete)
+        j[active] = jj - (diag | insert)
+        active = (i > 0) | (j > 0)
+    if not sub_rows:
+        return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=tx.dtype), np.zeros([0], dtype=rx.dtype)
+    # Substitutions were found from the end of the sentences, put them in order
+    sub_rows, sub_tx, sub_rx = [np.concatenate(x[::-1]) for x in (sub_rows, sub_tx, sub_rx)]
+    order = np.argsort(sub_rows, kind='stable')
+    return sub_rows[order], sub_tx[order], sub_rx[order]
+
+
+def batch_edit_distance(tx, tx_len, rx, rx_len, return_substitutions=False, chunk_size=2048):
+    """ Edit distances of N pairs of sentences
+    Args:
+        tx: [N, tx_width] int array of the transmitted sentences (padded)
+        tx_len: [N] lengths of the transmitted sentences
+        rx: [N, rx_width] int array of the received sentences (padded)
+        rx_len: [N] lengths of the received sentences
+        return_substitutions: whether to also return the substituted words
+        chunk_size: number of pairs processed together
+    Returns:
+        distances: [N] int array
+        if return_substitutions, also (pair index, tx word, rx word) arrays
+        with one entry per substitution of the alignments
+    """
+    tx, rx = np.asarray(tx), np.asarray(rx)
+    tx_len, rx_len = np.asarray(tx_len), np.asarray(rx_len)
+    distances = np.zeros([len(tx)], dtype=np.int32)
+    subs = []
+    for start in range(0, len(tx), chunk_size):
+        end = start + chunk_size
+        tx_width = int(tx_len[start:end].max(initial=0))
+        rx_width = int(rx_len[start:end].max(initial=0))
+        tx_c, rx_c = tx[start:end, :tx_width], rx[start:end, :rx_width]
+        table = _distance_table(tx_c, rx_c)
+        rows = np.arange(len(tx_c))
+        distances[start:end] = table[rows, tx_len[start:end], rx_len[start:end]]
+        if return_substitutions:
+            sub_rows, sub_tx, sub_rx = _substitutions(table, tx_c, rx_c, tx_len[start:end], rx_len[start:end])
+            subs.append((sub_rows + start, sub_tx, sub_rx))
+    if not return_substitutions:
+        return distances
+    if not subs:
+        return distances, (np.zeros([0], dtype=np.int64), np.zeros([0], dtype=tx.dtype), np.zeros([0], dtype=rx.dtype))
+    return distances, tuple(np.concatenate(x) for x in zip(*subs))
+
+
+def sentences_edit_distance(tx_sentences, rx_sentences, return_substitutions=False, chunk_size=2048):
+    """ batch_edit_distance on lists of sentences (lists of ids)"""
+    tx, tx_len = pad_sentences(tx_sentences)
+    rx, rx_len = pad_sentences(rx_sentences, pad_id=-2)
+    return batch_edit_distance(tx, tx_len, rx, rx_len, return_substitutions, chunk_size)
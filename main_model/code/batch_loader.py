@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Multi-process loader for the training queue. Each worker process owns a shard
+(a byte range) of the corpus and its own length-bucketed sentence batch
+generator. Workers tokenize and pad the batches and write them into shared
+memory slots, so the enqueue thread of VariableSystem only has to run the
+enqueue op. The workers are started with the forkserver (or spawn) method,
+never forked from the training process and its TF session threads.
+========================================================================"""
+import multiprocessing as mp
+import queue
+import bisect
+import numpy as np
+from preprocess_library import flatten_batch, build_feed_buffer, split_feed_buffer
+
+
+def _loader_worker(worker_id, numb_workers, gen_class, corp_path, word2numb, gen_kwargs,
+                   epochs, slots, free_slots, full_slots, stop_event, batch_id_limits):
+    """ Function run by each worker process. Serves the batches of its shard of
+    the corpus for the given number of epochs.
+    Messages put on full_slots are
+        ('batch', slot_id, width, numb_rows, batch_id) - a padded batch is ready in slot_id
+        ('epoch', worker_id) - the worker has finished an epoch
+        ('error', worker_id, message)
+        ('done', worker_id) - always the last message of the worker
+    """
+    np.random.seed() #Workers forked from the server would otherwise share the random state
+    #The epochs are counted here, the generator serves one pass per epoch
+    gen_kwargs = dict((key,val) for key,val in gen_kwargs.items() if key != 'epochs')
+    try:
+        batch_gen = gen_class(corp_path, word2numb, shard=(worker_id,numb_workers), **gen_kwargs)
+        for _ in range(epochs):
+            batch_gen.prepare_batch_queues()
+            batch = batch_gen.get_next_batch()
+            while batch is not None and not stop_event.is_set():
+                buffer, lengths = build_feed_buffer(*flatten_batch(batch))
+                if batch_id_limits:
+                    batch_id = bisect.bisect(batch_id_limits,lengths[0]+1)-1
+                else:
+                    batch_id = 0
+
+                slot_id = None
+                while slot_id is None and not stop_event.is_set():
+                    try:
+                        slot_id = free_slots.get(timeout=0.5)
+                    except queue.Empty:
+                        pass
+                if slot_id is None:
+                    break
+
+                numb_rows, width = buffer.shape
+                slot = np.frombuffer(slots[slot_id],dtype=np.int32)
+                slot[:numb_rows*width] = buffer.ravel()
+                slot[numb_rows*width:numb_rows*(width+1)] = lengths
+                full_slots.put(('batch',slot_id,width,numb_rows,batch_id))
+                batch = batch_gen.get_next_batch()
+            if stop_event.is_set():
+                break
+            full_slots.put(('epoch',worker_id))
+    except Exception as e:
+        full_slots.put(('error',worker_id,repr(e)))
+    finally:
+        full_slots.put(('done',worker_id))
+
+
+class ParallelBatchLoader(object):
+    """ Serves padded batches produced by numb_workers processes. A fixed pool
+    of shared memory slots is recycled between the workers and the consumer:
+    a slot returned by get_next_batch must be handed back with release once the
+    batch has been fed to the graph.
+    """
+    def __init__(self, batch_gen, numb_workers, epochs=1, slots_per_worker=4, batch_id_limits=None,
+                 start_method=None):
+        """
+        Args:
+            batch_gen: a SentenceBatchGenerator. Its class and constructor
+                arguments are used to create one generator per worker
+            numb_workers: number of worker processes
+            epochs: number of epochs each worker serves
+            slots_per_worker: number of shared memory batches per worker
+            batch_id_limits: queue limits used to compute the batch id from the
+                encoder input length. None gives batch id 0 (no variable encoding)
+            start_method: multiprocessing start method of the workers. None uses
+                forkserver where it is available and spawn elsewhere. fork is
+                not safe once a TF session exists
+        """
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        self.context = mp.get_context(start_method)
+        self.numb_workers = numb_workers
+        self.epochs = 0 #Number of epochs completed by every worker
+        self.batch_id_limits = batch_id_limits
+
+        self.gen_class = type(batch_gen)
+        self.corp_path = batch_gen.corp_path
+        self.word2numb = batch_gen.word2numb
+        self.gen_kwargs = dict((key,val) for key,val in batch_gen.init_kwargs.items() if key != 'shard')
+        self.max_epochs = epochs
+
+        batch_size = batch_gen.batch_size
+        slot_size = batch_size*(batch_gen.max_len+5) + batch_size
+        self.slots = [self.context.RawArray('i',slot_size) for _ in range(numb_workers*slots_per_worker)]
+        self.slot_views = [np.frombuffer(slot,dtype=np.int32) for slot in self.slots]
+        self.free_slots = self.context.Queue()
+        self.full_slots = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.workers = []
+        self._epochs_per_worker = [0]*numb_workers
+        self._workers_done = set([])
+
+    def start(self):
+        for slot_id in range(len(self.slots)):
+            self.free_slots.put(slot_id)
+        self.workers = [self.context.Process(target=_loader_worker,
+                                             args=(worker_id, self.numb_workers, self.gen_class,
+                                                   self.corp_path, self.word2numb, self.gen_kwargs,
+                                                   self.max_epochs, self.slots, self.free_slots,
+                                                   self.full_slots, self.stop_event, self.batch_id_limits),
+                                             name='loader_{}'.format(worker_id),
+                                             daemon=True)
+                        for worker_id in range(self.numb_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def get_next_batch(self, timeout=1.0):
+        """ Returns the next padded batch
+        Args:
+            timeout: seconds to wait for a batch
+        Returns:
+            None once all the workers are done, otherwise (slot_id, batch_id, feed)
+            where feed is (enc_inputs, enc_inputs_len, dec_targets, dec_inputs)
+            viewing the shared memory of slot_id
+        Raises:
+            queue.Empty if no batch arrived within the timeout
+            RuntimeError if a worker failed
+        """
+        while len(self._workers_done) < self.numb_workers:
+            message = self.full_slots.get(timeout=timeout)
+            if message[0] == 'batch':
+                _, slot_id, width, numb_rows, batch_id = message
+                slot = self.slot_views[slot_id]
+                buffer = slot[:numb_rows*width].reshape([numb_rows,width])
+                lengths = slot[numb_rows*width:numb_rows*(width+1)]
+                return slot_id, batch_id, split_feed_buffer(buffer,lengths)
+            elif message[0] == 'epoch':
+                self._epochs_per_worker[message[1]] += 1
+                self.epochs = min(self._epochs_per_worker)
+            elif message[0] == 'error':
+                raise RuntimeError('loader worker {} failed: {}'.format(message[1],message[2]))
+            elif message[0] == 'done':
+                self._workers_done.add(message[1])
+        return None
+
+    def release(self, slot_id):
+        """ Hands a slot back to the workers once its batch has been consumed"""
+        self.free_slots.put(slot_id)
+
+    def stop(self, timeout=5):
+        """ Stops the workers and waits for them to exit"""
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+NumPy versions of the channel models of the Channel class, used to add noise
+to encoder outputs outside of the TF graph and to measure the bit error rates
+seen by the traditional (compression + Reed-Solomon) baselines.
+========================================================================"""
+import numpy as np
+from functools import lru_cache
+
+CHANNELS = ['none', 'erasure', 'awgn', 'bsc']
+
+
+class ChannelSimulator(object):
+    """ Applies the erasure, awgn, bsc or none channel to arrays of bits
+    (+1/-1) with the same semantics as Channel.build_channel
+    """
+    def __init__(self, channel_type, seed=None, chunk_rows=4096):
+        """
+        Args:
+            channel_type: one of 'none', 'erasure', 'awgn', 'bsc'
+            seed: seed of the random state. The same seed gives the same noise
+            chunk_rows: number of rows for which noise is drawn at once
+        """
+        if channel_type not in CHANNELS:
+            raise NameError('Channel type is not known.')
+        self.channel_type = channel_type
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.chunk_rows = chunk_rows
+
+    def reset(self):
+        """ Restarts the noise sequence from the seed"""
+        self.rng = np.random.RandomState(self.seed)
+
+    def __call__(self, bits, chan_param):
+        """ Passes the bits through the channel
+        Args:
+            bits: [numb_sentences, numb_chan_bits] (or 1-D) array of +1/-1 values
+            chan_param: keep rate (erasure), noise std (awgn) or flip
+                probability (bsc)
+        Returns:
+            float32 array with the channel outputs
+        """
+        bits = np.asarray(bits, dtype=np.float32)
+        if bits.ndim < 2:
+            return self(bits.reshape([1, -1]), chan_param).reshape(bits.shape)
+        out = np.empty_like(bits)
+        for start in range(0, len(bits), self.chunk_rows):
+            chunk = bits[start:start+self.chunk_rows]
+            out[start:start+self.chunk_rows] = self._apply(chunk, chan_param)
+        return out
+
+    def _apply(self, bits, chan_param):
+        if self.channel_type == 'none':
+            return bits
+        elif self.channel_type == 'erasure':
+            # tf.nn.dropout scales the kept values by 1/keep_prob
+            keep = self.rng.uniform(size=bits.shape) < chan_param
+            return np.where(keep, bits / np.float32(chan_param), np.float32(0))
+        elif self.channel_type == 'awgn':
+            return bits + self.rng.normal(0.0, chan_param, size=bits.shape).astype(np.float32)
+        else:
+            flip = self.rng.uniform(size=bits.shape) <= chan_param
+            return np.where(flip, -bits, bits)
+
+    def error_rates(self, chan_param, numb_bits=1000000, symbol_bits=1):
+        """ Empirical erasure and error rates of the hard decisions on random
+        bits sent through the channel
+        Args:
+            chan_param: channel parameter
+            numb_bits: number of bits simulated
+            symbol_bits: rates of symbols of this many bits. A symbol is erased
+                if any of its bits is, and wrong if it is not erased and any
+                of its bits is wrong
+        Returns:
+            (erasure_rate, error_rate)
+        """
+        numb_cols = symbol_bits*(1000//symbol_bits)
+        bits = np.where(self.rng.uniform(size=[(numb_bits+numb_cols-1)//numb_cols, numb_cols]) < 0.5,
+                        np.float32(-1), np.float32(1))
+        chan_out = self(bits, chan_param)
+        erased = chan_out == 0
+        errors = ~erased & (np.sign(chan_out) != bits)
+        erased = erased.reshape([-1, symbol_bits]).any(axis=1)
+        errors = ~erased & errors.reshape([-1, symbol_bits]).any(axis=1)
+        return np.mean(erased), np.mean(errors)
+
+
+@lru_cache(maxsize=256)
+def effective_erasure_rate(channel_type, chan_param, numb_bits=1000000, seed=0, symbol_bits=1):
+    """ Rate of erasures a Reed-Solomon decoder has to correct, measured by
+    simulation. An error costs as much as two erasures. Results are cached
+    Args:
+        channel_type: one of 'none', 'erasure', 'awgn', 'bsc'
+        chan_param: channel parameter
+        numb_bits: number of bits simulated
+        seed: seed of the simulation
+        symbol_bits: bits per code symbol (8 for byte-wise Reed-Solomon)
+    Returns:
+        float
+    """
+    erasure_rate, error_rate = ChannelSimulator(channel_type, seed=seed).error_rates(chan_param, numb_bits, symbol_bits)
+    return erasure_rate + 2*error_rate
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+On-disk cache of the noiseless encoder outputs (bits before the channel) of
+sentences. For a fixed checkpoint these are deterministic, so a sweep over
+channel parameters only needs to run the encoder once per sentence; the
+noise is then added in numpy (see channel_sim).
+
+Each checkpoint has its own pair of files in the cache folder:
+    <key>.bits - append-only packed bits, one fixed size row per sentence
+    <key>.index.pickle - dictionary sha1(token ids) -> row
+========================================================================"""
+import os
+import hashlib
+import pickle
+import numpy as np
+
+
+def checkpoint_key(ckpt_path):
+    """ Key of a model checkpoint: its path and modification time"""
+    index_path = ckpt_path + '.index'
+    stat_path = index_path if os.path.exists(index_path) else ckpt_path
+    mtime = os.path.getmtime(stat_path) if os.path.exists(stat_path) else 0
+    key = '{}:{}'.format(os.path.abspath(ckpt_path), mtime)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def sentence_key(words_nums):
+    """ Key of a sentence: sha1 of its token ids"""
+    return hashlib.sha1(np.asarray(words_nums, dtype=np.int32).tobytes()).hexdigest()
+
+
+class EncodedSentenceCache(object):
+    """ Cache of the encoder output bits of sentences for one checkpoint
+    """
+    def __init__(self, cache_dir, model_key, numb_bits):
+        """
+        Args:
+            cache_dir: folder of the cache files
+            model_key: key of the checkpoint (see checkpoint_key)
+            numb_bits: number of bits of an encoder output
+        """
+        self.numb_bits = numb_bits
+        self.row_bytes = (numb_bits + 7) // 8
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.bits_path = os.path.join(cache_dir, model_key + '.bits')
+        self.index_path = os.path.join(cache_dir, model_key + '.index.pickle')
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as fop:
+                index = pickle.load(fop)
+            if index['numb_bits'] == numb_bits:
+                self.index = index['rows']
+        # Rows written after the last saved index are not trusted
+        self.numb_rows = max(self.index.values()) + 1 if self.index else 0
+        self.bits = self._load_bits()
+        self.numb_saved = len(self.bits)
+        self.new_rows = []
+
+    def _load_bits(self):
+        if self.numb_rows > 0 and os.path.exists(self.bits_path):
+            bits = np.fromfile(self.bits_path, dtype=np.uint8, count=self.numb_rows*self.row_bytes)
+            if len(bits) == self.numb_rows*self.row_bytes:
+                return bits.reshape([self.numb_rows, self.row_bytes])
+        # Bits file missing or truncated, start over
+        self.index = {}
+        self.numb_rows = 0
+        return np.zeros([0, self.row_bytes], dtype=np.uint8)
+
+    def lookup(self, batch):
+        """ Looks up a batch of sentences
+        Args:
+            batch: list of sentences (lists of ids, as given to the encoder)
+        Returns:
+            bits: [len(batch), numb_bits] float32 +1/-1 array, zero for misses
+            missing: indices in the batch of the sentences not in the cache
+        """
+        rows = [self.index.get(sentence_key(sentence), -1) for sentence in batch]
+        rows = np.array(rows, dtype=np.int64)
+        missing = np.flatnonzero(rows < 0)
+        bits = np.zeros([len(batch), self.numb_bits], dtype=np.float32)
+        found = np.flatnonzero(rows >= 0)
+        if len(found):
+            unpacked = np.unpackbits(self._rows(rows[found]), axis=1)[:, :self.numb_bits]
+            bits[found] = unpacked.astype(np.float32)*2 - 1
+        return bits, missing
+
+    def _rows(self, rows):
+        if len(self.new_rows):
+            self.bits = np.concatenate([self.bits] + self.new_rows, axis=0)
+            self.new_rows = []
+        return self.bits[rows]
+
+    def add(self, batch, bits):
+        """ Adds the encoder outputs of a batch of sentences
+        Args:
+            batch: list of sentences
+            bits: [len(batch), numb_bits] encoder outputs (+1/-1)
+        """
+        packed = np.packbits(np.asarray(bits) > 0, axis=1)
+        for sentence, row in zip(batch, packed):
+            key = sentence_key(sentence)
+            if key in self.index:
+                continue
+            self.index[key] = self.numb_rows
+            self.numb_rows += 1
+            self.new_rows.append(row[None])
+
+    def save(self):
+        """ Appends the new rows to the bits file and writes the index"""
+        if len(self.new_rows):
+            self._rows(np.zeros([0], dtype=np.int64))
+        with open(self.bits_path, 'r+b' if os.path.exists(self.bits_path) else 'wb') as fop:
+            fop.seek(self.numb_saved*self.row_bytes)
+            self.bits[self.numb_saved:].tofile(fop)
+            fop.truncate()
+        self.numb_saved = len(self.bits)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as fop:
+            pickle.dump({'numb_bits': self.numb_bits, 'rows': self.index}, fop)
+        os.replace(tmp_path, self.index_path)
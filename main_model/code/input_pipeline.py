@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+tf.data input backend for VariableSystem. It replaces the RandomShuffleQueue
+fed through feed_dict: sentences are read, tokenized, filtered, bucketed by
+length and padded inside the pipeline, and the batch id, learning rate and
+channel parameter of every batch are computed in the graph.
+========================================================================"""
+import tensorflow as tf
+import numpy as np
+from tokenization import tokenize
+from preprocess_library import compile_corpus, compiled_corpus_valid, load_compiled_corpus
+
+
+def text_sentence_dataset(corp_path, word2numb, numb_parallel_calls=4):
+    """ Dataset of (word ids, number of unknown words) read from a text corpus
+    with one sentence per line
+    """
+    unk_id = word2numb.UNK_ID
+    def tokenize_line(line):
+        words = tokenize(line.decode('utf8').lower())
+        words_nums = np.array(word2numb.convert_w2n(words),dtype=np.int32)
+        return words_nums, np.int32(np.sum(words_nums==unk_id))
+
+    dataset = tf.data.TextLineDataset(corp_path)
+    return dataset.map(lambda line: tuple(tf.py_func(tokenize_line,[line],[tf.int32,tf.int32],stateful=False)),
+                       num_parallel_calls=numb_parallel_calls)
+
+
+def compiled_sentence_dataset(cache_path, numb_parallel_calls=4):
+    """ Dataset of (word ids, number of unknown words) read from a corpus
+    compiled with preprocess_library.compile_corpus
+    """
+    tokens, offsets, unk_counts, _ = load_compiled_corpus(cache_path)
+    def get_sentence(ind):
+        return (np.array(tokens[offsets[ind]:offsets[ind+1]],dtype=np.int32),
+                np.int32(unk_counts[ind]))
+
+    dataset = tf.data.Dataset.range(len(offsets)-1)
+    return dataset.map(lambda ind: tuple(tf.py_func(get_sentence,[ind],[tf.int32,tf.int32],stateful=False)),
+                       num_parallel_calls=numb_parallel_calls)
+
+
+def build_input_dataset(config, word2numb, corp_path, numb_parallel_calls=4):
+    """ Builds the training input pipeline. Each element is a dictionary with
+    the same keys as the queue variables of VariableSystem.
+
+    Args:
+        config - the model configuration. Uses batch sizes, length limits,
+            queue_limits, channel, lr, epochs, qcap and the unk_perc and
+            corpus_cache kwargs
+        word2numb - the dictionary object
+        corp_path - path of the text corpus
+        numb_parallel_calls - number of parallel tokenizing/padding calls
+    Returns:
+        tf.data.Dataset
+    """
+    if config.kwargs.get('corpus_cache',False):
+        cache_path = corp_path + '.compiled'
+        if not compiled_corpus_valid(corp_path,word2numb,cache_path):
+            compile_corpus(corp_path,word2numb,cache_path)
+        dataset = compiled_sentence_dataset(cache_path,numb_parallel_calls)
+    else:
+        dataset = text_sentence_dataset(corp_path,word2numb,numb_parallel_calls)
+
+    # ==== filtering by length and percentage of unknown words ====
+    unk_perc = config.kwargs.get('unk_perc',0.2)
+    def keep_sentence(words_nums,unk_count):
+        length = tf.shape(words_nums)[0]
+        return tf.logical_and(
+                tf.logical_and(length>=config.length_from, length<=config.length_to),
+                tf.cast(unk_count,tf.float32) <= unk_perc*tf.cast(tf.maximum(length,1),tf.float32))
+    dataset = dataset.filter(keep_sentence)
+    dataset = dataset.map(lambda words_nums,_: (words_nums,tf.shape(words_nums)[0]))
+    dataset = dataset.repeat(config.epochs)
+
+    # ==== bucketing on the same bins as SentenceBatchGenerator ====
+    dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+            element_length_func=lambda words_nums,length: length,
+            bucket_boundaries=config.queue_limits[1:],
+            bucket_batch_sizes=[config.batch_size]*len(config.queue_limits),
+            padded_shapes=([None],[]),
+            padding_values=(np.int32(config.PAD),np.int32(0))))
+    dataset = dataset.filter(lambda words_nums,length: tf.equal(tf.shape(words_nums)[0],config.batch_size))
+    dataset = dataset.shuffle(config.qcap)
+    dataset = tf.data.Dataset.zip((dataset,tf.data.Dataset.range(np.iinfo(np.int64).max)))
+
+    # ==== feed tensors and per batch parameters ====
+    queue_limits = tf.constant(config.queue_limits,dtype=tf.int32)
+    def to_queue_vars(batch,counter):
+        words_nums,lengths = batch
+        words_nums.set_shape([config.batch_size,None])
+        max_len = tf.shape(words_nums)[1]
+        padded = tf.pad(words_nums,[[0,0],[0,4]],constant_values=config.PAD)
+        eos_mask = tf.cast(tf.one_hot(lengths,max_len+4,dtype=tf.int32),tf.bool)
+        with_eos = tf.where(eos_mask,tf.fill(tf.shape(padded),config.EOS),padded) #sentence + EOS + 3 PAD
+        sos = tf.fill([config.batch_size,1],config.SOS)
+        enc_inputs_len = lengths + 1
+
+        if config.variable_encoding:
+            batch_id = tf.reduce_sum(tf.cast(queue_limits<=enc_inputs_len[0],tf.int32)) - 1
+        else:
+            batch_id = tf.constant(0,dtype=tf.int32)
+
+        # Same schedules as VariableSystem.update_params
+        expected_runcount = config.epochs * 25000
+        max_lr = config.lr
+        min_lr = max_lr / 100
+        step = tf.cast(counter,tf.float32)
+        lr = tf.where(step < expected_runcount,
+                      min_lr + 0.5 * (max_lr - min_lr) * (1 + tf.cos(step * np.pi / expected_runcount)),
+                      tf.constant(min_lr,dtype=tf.float32))
+        if config.channel['chan_param_max'] is None:
+            chan_param = tf.constant(config.channel['chan_param'],dtype=tf.float32)
+        else:
+            chan_param = tf.random_uniform([],config.channel['chan_param_min'],config.channel['chan_param_max'])
+
+        return {'isTrain': tf.constant(True),
+                'enc_inputs': with_eos[:,:max_len+1],
+                'enc_inputs_len': enc_inputs_len,
+                'dec_inputs': tf.concat([sos,with_eos[:,:max_len+3]],axis=1),
+                'dec_targets': tf.cast(with_eos,tf.int64),
+                'helper_prob': tf.constant(1.0),
+                'chan_param': chan_param,
+                'lr': lr,
+                'batch_id': batch_id}
+
+    dataset = dataset.map(to_queue_vars,num_parallel_calls=numb_parallel_calls)
+    return dataset.prefetch(2)
@@ -23,11 +23,19 @@ import time
 #from tensorflow.python.framework import ops
 from tensorflow.python.framework import dtypes
 from functools import partial
-from preprocess_library import SentenceBatchGenerator, Word2Numb, bin_batch_create
+from preprocess_library import SentenceBatchGenerator, CompiledSentenceBatchGenerator, Word2Numb, bin_batch_create
+from preprocess_library import flatten_batch, pad_flat, build_feed_arrays
 import bisect
 from tqdm import tqdm
 import argparse
 from threading import Thread
+import queue
+from batch_loader import ParallelBatchLoader
+from input_pipeline import build_input_dataset
+from channel_sim import ChannelSimulator
+from enc_cache import EncodedSentenceCache, checkpoint_key
+from batch_edit_distance import sentences_edit_distance
+from results_io import ResultsWriter, results_dir, trim_at_eos
 
 
 #Sets which GPU to use
@@ -87,6 +95,8 @@ class Config(object):
                  save_every = int(1e5),
                  summary_every = 20,
                  qcap = 200,
+                 numb_workers = 0,
+                 input_pipeline = 'queue',
 
                  chan_enc_layers = [4096, 2048, 1024, 512],
                  chan_dec_layers = [4096, 2048, 1600, 1024, 512],
@@ -169,6 +179,8 @@ class Config(object):
         self.max_validate_counter = max_validate_counter
         
         self.qcap = qcap
+        self.numb_workers = numb_workers
+        self.input_pipeline = input_pipeline
         self.kwargs=kwargs
      
 def generate_tb_filename(config):
@@ -198,20 +210,41 @@ def generate_tb_filename(config):
 
 
 class Embedding(object):
-    """The word embeddings used in the encoder and decoder
+    """The word embeddings used in the encoder and decoder. A .npy embedding
+    file is memory mapped and copied into the variable by initialize, a chunk
+    of rows at a time, instead of being stored in the graph as a constant
     """
     def __init__(self,config):
         self.vocab_size = config.vocab_size
         self.embedding_size = config.embedding_size
+        self.embed_matrix = None
         if config.embed_path == None:
             self.embeddings = tf.Variable(tf.random_uniform([self.vocab_size, self.embedding_size], -1.0, 1.0),
                                                             dtype=tf.float32)
+        elif config.embed_path.endswith('.npy'):
+            self.embed_matrix = np.load(config.embed_path, mmap_mode='r')
+            self.embeddings = tf.Variable(tf.zeros(self.embed_matrix.shape), dtype=tf.float32)
+            self.rows_PH = tf.placeholder(tf.float32, shape=[None, self.embed_matrix.shape[1]], name='embed_rows')
+            self.start_PH = tf.placeholder(tf.int32, shape=[], name='embed_start')
+            self.assign_rows = tf.scatter_update(self.embeddings,
+                                                 tf.range(self.start_PH, self.start_PH + tf.shape(self.rows_PH)[0]),
+                                                 self.rows_PH)
         else:
             with open(config.embed_path, 'rb') as fop:
                 embeddings = pickle.load(fop)
                 self.embeddings = tf.Variable(embeddings, dtype=tf.float32)
         self.curr_embeds = None
 
+    def initialize(self, sess, chunk_rows=20000):
+        """ Copies the memory mapped embeddings into the variable. To be run
+        after the global variables initializer (and before restoring weights)
+        """
+        if self.embed_matrix is None:
+            return
+        for start in range(0, len(self.embed_matrix), chunk_rows):
+            sess.run(self.assign_rows, {self.start_PH: start,
+                                        self.rows_PH: self.embed_matrix[start:start+chunk_rows]})
+
     def get_embeddings(self,inputs):    # this thing could get huge in a real world application
         self.curr_embeds = tf.nn.embedding_lookup(self.embeddings, inputs)
         return self.curr_embeds
@@ -1004,12 +1037,21 @@ class VariableSystem(object):
                         ('lr',tf.float32,tf.ones([])*self.config.lr,[]),
                         ('batch_id',tf.int32,tf.zeros([],dtype=tf.int32),[])]
         names_q,dtype_q,init_q,shape_q = zip(*name_dtype_init_shape)
-        self.queue_vars = dict((name,tf.placeholder_with_default(init,shape))
-                                for name,_,init,shape in name_dtype_init_shape)
-        self.queue = tf.RandomShuffleQueue(self.config.qcap,2,dtype_q,names=names_q)
-        self.enqueue_op = self.queue.enqueue(self.queue_vars)
-        self.close_queue = self.queue.close(cancel_pending_enqueues=True) 
-        queue_vars = self.queue.dequeue()     
+        if self.config.input_pipeline == 'tf_data':
+            # ==== tf.data pipeline instead of the queue. The dataset is only built by train_fast ====
+            self.input_iterator = tf.data.Iterator.from_structure(
+                    dict((name,dtype) for name,dtype,_,_ in name_dtype_init_shape),
+                    dict((name,tf.TensorShape(shape)) for name,_,_,shape in name_dtype_init_shape))
+            self.input_init_op = None
+            queue_vars = self.input_iterator.get_next()
+            self.queue_vars = self.queue = self.enqueue_op = self.close_queue = None
+        else:
+            self.queue_vars = dict((name,tf.placeholder_with_default(init,shape))
+                                    for name,_,init,shape in name_dtype_init_shape)
+            self.queue = tf.RandomShuffleQueue(self.config.qcap,2,dtype_q,names=names_q)
+            self.enqueue_op = self.queue.enqueue(self.queue_vars)
+            self.close_queue = self.queue.close(cancel_pending_enqueues=True) 
+            queue_vars = self.queue.dequeue()     
         self.epochs = 0
 
             
@@ -1147,8 +1189,12 @@ class VariableSystem(object):
         else:
             curr_chan_param = np.random.uniform(low = self.config.channel['chan_param_min'], high = self.config.channel['chan_param_max'])
         
+        #Teacher forcing probability, lowered after the first epochs
+        curr_help_prob = 1 if self.epochs<=5 else max(0.0, 1 - 0.05*self.epochs)
+        
         return {'lr': curr_lr, 
-                'chan_param': curr_chan_param}
+                'chan_param': curr_chan_param,
+                'help_prob': curr_help_prob}
         
 
     def load_model_helper(self, sess, trained_model_path, saver_to_load):
@@ -1225,17 +1271,9 @@ class VariableSystem(object):
             batch_out: zero padded batch
             sequence_lengths: sentence len
         """
-        sequence_lengths = [len(seq) for seq in inputs]
-        batch_size = len(inputs)
-
-        if max_sequence_length is None:
-            max_sequence_length = max(sequence_lengths)
-
-        inputs_batch_major = np.zeros(shape=[batch_size, max_sequence_length], dtype=np.int32)  # == PAD
-
-        for i, seq in enumerate(inputs):
-            for j, element in enumerate(seq):
-                inputs_batch_major[i, j] = element
+        inputs_batch_major, sequence_lengths = pad_flat(*flatten_batch(inputs),
+                                                        width=max_sequence_length,
+                                                        pad_id=self.config.PAD)
 
         if time_major:
             # [batch_size, max_time] -> [max_time, batch_size]
@@ -1245,17 +1283,30 @@ class VariableSystem(object):
 
         return batch_out, sequence_lengths
 
+    def batch_to_feed_all(self, batch):
+        """
+        Creates the zero padded encoder inputs, decoder targets and decoder
+        inputs of a batch in a single vectorized pass over a flat token buffer
+
+        Args:
+            batch: list of sentences (integer lists or arrays)
+
+        Outputs:
+            encoder_inputs, encoder_input_lengths, decoder_targets, decoder_inputs
+        """
+        tokens, offsets = flatten_batch(batch)
+        return build_feed_arrays(tokens, offsets,
+                                 eos_id=self.config.EOS,
+                                 sos_id=self.config.SOS,
+                                 pad_id=self.config.PAD)
+
     def next_feed(self, batch, help_prob=1.0, isTrain=True):
         """
         Generate the data feed from the batch
         """
         
-        encoder_inputs_, encoder_input_lengths_ = self.batch_to_feed(
-            [(sequence) + [self.config.EOS] for sequence in batch])
-        decoder_targets_, _ = self.batch_to_feed(
-            [(sequence) + [self.config.EOS] + [self.config.PAD] * 3 for sequence in batch])
-        decoder_inputs_, _ = self.batch_to_feed(
-            [[self.config.SOS] + (sequence) + [self.config.EOS] + [self.config.PAD] * 2 for sequence in batch])
+        (encoder_inputs_, encoder_input_lengths_,
+         decoder_targets_, decoder_inputs_) = self.batch_to_feed_all(batch)
         
         if self.config.variable_encoding:
             batch_id_ =  bisect.bisect(self.config.queue_limits,encoder_input_lengths_[0])-1
@@ -1370,17 +1421,12 @@ class VariableSystem(object):
         Returns:
             None
         """
-        help_prob_ = 1 if self.epochs<=5 else max(0.0, 1 - 0.05*self.epochs)
-        def next_feed_q(batch, help_prob=help_prob_):
+        def next_feed_q(batch):
             """
             Generate the data feed from the batch for the queue
             """
-            encoder_inputs_, encoder_input_lengths_ = self.batch_to_feed(
-                [(sequence) + [self.config.EOS] for sequence in batch])
-            decoder_targets_, _ = self.batch_to_feed(
-                [(sequence) + [self.config.EOS] + [self.config.PAD] * 3 for sequence in batch])
-            decoder_inputs_, _ = self.batch_to_feed(
-                [[self.config.SOS] + (sequence) + [self.config.EOS] + [self.config.PAD] * 2 for sequence in batch])
+            (encoder_inputs_, encoder_input_lengths_,
+             decoder_targets_, decoder_inputs_) = self.batch_to_feed_all(batch)
             if self.config.variable_encoding:
                 batch_id_ =  bisect.bisect(self.config.queue_limits,encoder_input_lengths_[0])-1
             else:
@@ -1393,7 +1439,7 @@ class VariableSystem(object):
                     'enc_inputs_len': encoder_input_lengths_,
                     'dec_inputs': decoder_inputs_,
                     'dec_targets': decoder_targets_,
-                    'helper_prob': help_prob,
+                    'helper_prob': self.updated_params['help_prob'],
                     'chan_param': self.updated_params['chan_param'],
                     'lr': self.updated_params['lr'],
                     'batch_id': batch_id_}
@@ -1418,10 +1464,73 @@ class VariableSystem(object):
             sess.run(self.close_queue)
             coord.request_stop()
             
+    def enqueue_func_parallel(self,coord,sess):
+        """ Same as enqueue_func but the batches are tokenized and padded by 
+        config.numb_workers loader processes, each owning a shard of the 
+        training corpus. This thread only runs the enqueueing op. The helper
+        probability follows the epochs of the loader, as in enqueue_func. 
+        
+        Args:
+            coord - coordinator that does housekeeping on threads
+        Returns:
+            None
+        """
+        batch_id_limits = self.config.queue_limits if self.config.variable_encoding else None
+        loader = ParallelBatchLoader(self.train_data,
+                                     self.config.numb_workers,
+                                     epochs=self.config.epochs,
+                                     batch_id_limits=batch_id_limits)
+        loader.start()
+        try:
+            while not coord.should_stop() and self.epochs < self.config.epochs:
+                try:
+                    loaded = loader.get_next_batch(timeout=1.0)
+                except queue.Empty:
+                    continue
+                self.epochs = loader.epochs
+                if loaded is None:
+                    self.epochs = self.config.epochs
+                    break
+                
+                slot_id, batch_id_, (encoder_inputs_, encoder_input_lengths_,
+                                     decoder_targets_, decoder_inputs_) = loaded
+                self.updated_params = self.update_params()
+                fd_pre = {'isTrain': True,
+                          'enc_inputs': encoder_inputs_,
+                          'enc_inputs_len': encoder_input_lengths_,
+                          'dec_inputs': decoder_inputs_,
+                          'dec_targets': decoder_targets_,
+                          'helper_prob': self.updated_params['help_prob'],
+                          'chan_param': self.updated_params['chan_param'],
+                          'lr': self.updated_params['lr'],
+                          'batch_id': batch_id_}
+                fd = dict((self.queue_vars[name_v],val_v) for name_v,val_v in fd_pre.items())
+                try:
+                    sess.run(self.enqueue_op,feed_dict=fd)
+                finally:
+                    loader.release(slot_id)
+        except Exception as e:
+            print('ERROR in feeding queue',e)
+            sess.run(self.close_queue)
+            coord.request_stop()
+        finally:
+            loader.stop()
+            
+    def build_input_init_op(self):
+        """ Builds the tf.data training pipeline (compiling the corpus if it is
+        cached) and the op that points the input iterator to it. Test runs
+        never read the training corpus, so this is not done with the graph
+        """
+        if self.input_init_op is None:
+            dataset = build_input_dataset(self.config, self.word2numb, self.config.traindata_path)
+            self.input_init_op = self.input_iterator.make_initializer(dataset)
+        return self.input_init_op
+            
     #Default training method.        
     def train_fast(self, sess, tb_writer, grammar=None):
         """
-        This trains the network. it uses a queue mechanism to feed in placement
+        This trains the network. it uses a queue mechanism to feed in placement,
+        or the tf.data pipeline if config.input_pipeline is 'tf_data'
         """
         params = tf.trainable_variables()
         num_params = sum(
@@ -1438,11 +1547,16 @@ class VariableSystem(object):
         # except:
         #     print('Could not restore. Starting from scratch')
         
+        use_queue = self.config.input_pipeline != 'tf_data'
         try:
             coord = tf.train.Coordinator()
-            t = Thread(target=self.enqueue_func,args=(coord,sess,),name='enq_thread')
-            t.daemon = True
-            t.start()
+            if use_queue:
+                enqueue_target = self.enqueue_func_parallel if self.config.numb_workers > 0 else self.enqueue_func
+                t = Thread(target=enqueue_target,args=(coord,sess,),name='enq_thread')
+                t.daemon = True
+                t.start()
+            else:
+                sess.run(self.build_input_init_op())
         
             # =============================  Train on Training Data ===============================
             self.train_data.prepare_batch_queues()
@@ -1459,7 +1573,16 @@ class VariableSystem(object):
                     print('Coord has requested a break in training')
                     break
                   
-                (_, loss, tb_summ) = sess.run([self.train_op, self.loss, self.tb_summary])
+                if use_queue:
+                    (_, loss, tb_summ) = sess.run([self.train_op, self.loss, self.tb_summary])
+                else:
+                    try:
+                        (_, loss, tb_summ, lr_, chan_param_) = sess.run([self.train_op, self.loss, self.tb_summary,
+                                                                         self.lr, self.chan_param])
+                    except tf.errors.OutOfRangeError:
+                        print('Input pipeline has served all epochs')
+                        break
+                    self.updated_params = {'lr': lr_, 'chan_param': chan_param_}
                 
                 self.training_counter += 1
      
@@ -1483,15 +1606,17 @@ class VariableSystem(object):
                     print("Model saved in file: %s" % self.config.model_save_path)
 
         except KeyboardInterrupt:
-            sess.run(self.close_queue)
+            if use_queue:
+                sess.run(self.close_queue)
             coord.request_stop()
             print('Training interrupted.')
         
         finally:
             print('Finished training')
-            sess.run(self.close_queue)
             coord.request_stop()
-            coord.join([t],stop_grace_period_secs=5)
+            if use_queue:
+                sess.run(self.close_queue)
+                coord.join([t],stop_grace_period_secs=5)
             
         # =========================== Save the Model ==========================================
         self.saver.save(sess, self.config.model_save_path)
@@ -1503,14 +1628,22 @@ class VariableSystem(object):
 class SingleStepDecoder(object):
     '''The single step decoder is used for by BeamSearch call for 
     beam search decoding at test time. It simulates a single decode step.
+    The top-k is taken directly on the logits and only the selected entries
+    are normalized. With the beam_shortlist kwarg (N) only the N most frequent
+    words (ids below N) are candidates and only their logits are computed.
+    The log probabilities are then normalized over the shortlist, an
+    approximation that slightly overstates them.
     '''
-    def __init__(self, embeddings, config, curr_input, state_PH):
+    def __init__(self, embeddings, config, curr_input, state_PH, beam_size=None):
         self.batch_size = config.batch_size
         self.peephole = config.peephole
 
         self.numb_dec_layers = config.numb_dec_layers
         self.dec_hidden_units = config.dec_hidden_units
         self.vocab_size = config.vocab_size
+        self.beam_size = beam_size
+        self.shortlist = config.kwargs.get('beam_shortlist',None)
+        self.out_vocab_size = min(self.shortlist or self.vocab_size, self.vocab_size)
 
         self.embeddings = embeddings
 
@@ -1525,6 +1658,12 @@ class SingleStepDecoder(object):
         self.cell = self.build_cell()
         self.topk_ids, self.topk_probs, self.new_states = self.build_dec_network()
 
+    def output_logits(self, decoder_outputs):
+        '''Output projection, restricted to the shortlist if there is one
+        '''
+        if self.out_vocab_size < self.vocab_size:
+            return tf.add(tf.matmul(decoder_outputs, self.W[:, :self.out_vocab_size]), self.b[:self.out_vocab_size])
+        return tf.add(tf.matmul(decoder_outputs, self.W), self.b)
 
 
     def build_cell(self):
@@ -1569,10 +1708,15 @@ class SingleStepDecoder(object):
         decoder_batch_size, decoder_dim = tf.unstack(tf.shape(decoder_outputs))
 
         # pass flattened tensor through decoder
-        decoder_logits = tf.add(tf.matmul(decoder_outputs, self.W), self.b)
+        decoder_logits = self.output_logits(decoder_outputs)
 
-        # final prediction
-        topk_log_probs, topk_ids = tf.nn.top_k(tf.log(tf.nn.softmax(decoder_logits)), decoder_batch_size * 2)
+        # number of candidates per row. Defaults to 2x the beam size
+        default_k = 2 * self.beam_size if self.beam_size else decoder_batch_size * 2
+        self.topk_PH = tf.placeholder_with_default(default_k, shape=[], name='topk')
+
+        # final prediction, log softmax of the top-k logits only (over the shortlist if there is one)
+        topk_logits, topk_ids = tf.nn.top_k(decoder_logits, tf.minimum(self.topk_PH, self.out_vocab_size))
+        topk_log_probs = topk_logits - tf.reduce_logsumexp(decoder_logits, axis=1, keepdims=True)
 
         out_states = [(states[idx].c, states[idx].h)
                                for idx in range(self.numb_dec_layers)]
@@ -1606,6 +1750,46 @@ class Hypothesis(object):
                                                               self.tokens))
 
 
+class BeamStore(object):
+    """Preallocated storage of the beams of a batch of sentences during beam
+    search. Each step only stores the new token and the parent beam of every
+    beam, the sequences are backtracked when needed.
+    """
+
+    def __init__(self, numb_sentences, beam_size, max_steps, start_token):
+        self.step = 0
+        self.tokens = np.zeros([max_steps+1, numb_sentences, beam_size], dtype=np.int32)
+        self.tokens[0] = start_token
+        self.parents = np.zeros([max_steps+1, numb_sentences, beam_size], dtype=np.int32)
+        # Only the first beam is live at the first step since all K are the same
+        self.log_probs = np.full([numb_sentences, beam_size], -np.inf)
+        self.log_probs[:, 0] = 0.0
+
+    def latest_tokens(self):
+        """Last token of every beam, flattened to [B*K]"""
+        return self.tokens[self.step].ravel()
+
+    def push(self, tokens, parents, log_probs):
+        """Adds a step
+        Args:
+            tokens: [B, K] new token of each beam
+            parents: [B, K] index of the beam (at the previous step) it extends
+            log_probs: [B, K] cumulative log probabilities
+        """
+        self.step += 1
+        self.tokens[self.step] = tokens
+        self.parents[self.step] = parents
+        self.log_probs = log_probs
+
+    def backtrack(self, sentence, step, beam):
+        """Returns the tokens (start token included) of a beam at a given step"""
+        seq = np.zeros([step+1], dtype=np.int32)
+        for t in range(step, -1, -1):
+            seq[t] = self.tokens[t, sentence, beam]
+            beam = self.parents[t, sentence, beam]
+        return seq.tolist()
+
+
 class BeamSearchVariable(VariableDecoder_mod):
     """This implements a beam search decoder to be used during testing
     """
@@ -1635,81 +1819,208 @@ class BeamSearchVariable(VariableDecoder_mod):
         self.config = config
         self.chan_coder_out = self.dec_network_out
         self.init_state = self.expand_chann_out(self.chan_coder_out)
-        self.SingleStepDecoder = SingleStepDecoder(embeddings, config, self.input_PH, self.state_PH)
+        self.SingleStepDecoder = SingleStepDecoder(embeddings, config, self.input_PH, self.state_PH, beam_size=beam_size)
+        self.graph_beam_size = tf.placeholder_with_default(beam_size, shape=[], name='graph_beam_size')
+        self.graph_beam_ids, self.graph_beam_log_probs = self.build_graph_beam_search()
+
+    def build_graph_beam_search(self):
+        """Builds a beam search decoder that runs entirely in the graph, so a
+        batch of channel outputs is decoded with a single session call. It uses
+        the cell, projection and embeddings of SingleStepDecoder. Every step
+        takes the top K over the flattened [K*vocab] scores of each sentence and
+        gathers the LSTM states of the parent beams. Beams that produced the end
+        token are kept frozen (they can only be extended by the end token at no
+        cost) until all beams are finished or max steps is reached.
 
+        Returns:
+            beam_ids: [B, K, steps] best sequences of each sentence, best first.
+                Positions after the end token are filled with the end token
+            beam_log_probs: [B, K] log probabilities of the sequences
+        """
+        nest = tf.contrib.framework.nest
+        step_decoder = self.SingleStepDecoder
+        beam_size = self.graph_beam_size
+        vocab_size = step_decoder.out_vocab_size
+        numb_sentences = tf.shape(self.chan_out_PH)[0]
+        numb_rows = numb_sentences * beam_size
+
+        # Each sentence repeated K times, [B*K, units]
+        init_state = nest.map_structure(
+                lambda x: tf.reshape(tf.tile(tf.expand_dims(x,1),[1,beam_size,1]),[numb_rows,self.dec_hidden_units]),
+                self.init_state)
+        # Only the first beam is live at the first step since all K are the same
+        init_log_probs = tf.concat([tf.zeros([numb_sentences,1]),
+                                    tf.fill([numb_sentences,beam_size-1],-np.inf)],axis=1)
+        init_finished = tf.fill([numb_sentences,beam_size],False)
+        init_tokens = tf.fill([numb_rows],self._start_token)
+        # Scores of the extensions of a finished beam: only the end token, at no cost
+        finished_row = tf.one_hot(self._end_token,vocab_size,on_value=0.0,off_value=-np.inf)
+        beam_offsets = tf.expand_dims(tf.range(numb_sentences)*beam_size,1)
+
+        def cond(step, tokens, state, log_probs, finished, ids_ta, parents_ta):
+            return tf.logical_and(step < self._max_steps, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(step, tokens, state, log_probs, finished, ids_ta, parents_ta):
+            input_emb = tf.nn.embedding_lookup(step_decoder.embeddings.embeddings, tokens)
+            outputs, new_state = step_decoder.cell(input_emb, state)
+            step_log_probs = tf.nn.log_softmax(step_decoder.output_logits(outputs))
+            step_log_probs = tf.where(tf.reshape(finished,[-1]),
+                                      tf.tile(tf.expand_dims(finished_row,0),[numb_rows,1]),
+                                      step_log_probs)
+
+            scores = tf.expand_dims(log_probs,2) + tf.reshape(step_log_probs,[numb_sentences,beam_size,vocab_size])
+            top_scores, top_inds = tf.nn.top_k(tf.reshape(scores,[numb_sentences,beam_size*vocab_size]), beam_size)
+            parents = top_inds // vocab_size
+            new_tokens = top_inds % vocab_size
+
+            gather_inds = tf.reshape(parents + beam_offsets,[-1])
+            new_state = nest.map_structure(lambda x: tf.gather(x, gather_inds), new_state)
+            new_finished = tf.logical_or(tf.reshape(tf.gather(tf.reshape(finished,[-1]), gather_inds),
+                                                    [numb_sentences,beam_size]),
+                                         tf.equal(new_tokens, self._end_token))
+
+            return (step+1, tf.reshape(new_tokens,[-1]), new_state, top_scores, new_finished,
+                    ids_ta.write(step, new_tokens), parents_ta.write(step, parents))
+
+        loop_vars = (tf.constant(0), init_tokens, init_state, init_log_probs, init_finished,
+                     tf.TensorArray(tf.int32, size=0, dynamic_size=True),
+                     tf.TensorArray(tf.int32, size=0, dynamic_size=True))
+        numb_steps, _, _, log_probs, _, ids_ta, parents_ta = tf.while_loop(cond, body, loop_vars,
+                                                                          back_prop=False,
+                                                                          name='graph_beam_search')
+
+        # Follow the parents back from the last step, [steps, B, K]
+        beam_ids = tf.contrib.seq2seq.gather_tree(ids_ta.stack(), parents_ta.stack(),
+                                                  max_sequence_lengths=tf.fill([numb_sentences],numb_steps),
+                                                  end_token=self._end_token)
+        return tf.transpose(beam_ids,[1,2,0]), log_probs
+
+    def GraphBeamSearch(self, sess, chan_outputs, batch_id, beam_size = None):
+        """Performs beam search decoding of a batch of channel outputs with the
+        in-graph decoder (one session call)
 
-    def BeamSearch(self, sess, chan_output, batch_id, beam_size = None):
-        """Performs beam search decoding
+        Args:
+            chan_outputs: channel outputs of the B sentences [B, chan_out_dim]
+            batch_id: batch id shared by the sentences
+        Returns:
+            a list with the sorted hypotheses of each sentence
         """
         if beam_size!= None:
             self._beam_size = beam_size
-        init_state = sess.run(self.init_state, feed_dict={self.chan_out_PH:chan_output,self.batch_id:batch_id})
-        print(np.array(init_state).shape)
-
-        # Replicate the initial states K times for the first step.
-        hyps = [Hypothesis([self._start_token], 0.0, np.array(init_state))
-                ] * self._beam_size
+        beam_ids, beam_log_probs = sess.run([self.graph_beam_ids, self.graph_beam_log_probs],
+                                            feed_dict={self.chan_out_PH: chan_outputs,
+                                                       self.batch_id: batch_id,
+                                                       self.graph_beam_size: self._beam_size})
         results = []
+        for sent_ids, sent_log_probs in zip(beam_ids, beam_log_probs):
+            hyps = []
+            for ids, log_prob in zip(sent_ids, sent_log_probs):
+                if not np.isfinite(log_prob):
+                    continue
+                ends = np.flatnonzero(ids == self._end_token)
+                length = ends[0]+1 if len(ends) else len(ids)
+                hyps.append(Hypothesis([self._start_token] + ids[:length].tolist(), log_prob, None))
+            results.append(self._BestHyps(hyps))
+        return results
 
-        steps = 0
-        while steps < self._max_steps and len(results) < self._beam_size:
-            latest_tokens = [h.latest_token for h in hyps]
-            curr_states = [h.state for h in hyps]
-            curr_states = np.array(curr_states)
 
+    def BeamSearch(self, sess, chan_output, batch_id, beam_size = None):
+        """Performs beam search decoding of a single channel output
+        """
+        return self.BatchBeamSearch(sess, chan_output[:1], batch_id, beam_size=beam_size)[0]
 
-            if steps==0:
-                curr_states = np.swapaxes(curr_states,0,3).squeeze(axis=0)
-            else:
-                curr_states = np.swapaxes(curr_states, 0, 1)
-                curr_states = np.swapaxes(curr_states, 1, 2)
+    def BatchBeamSearch(self, sess, chan_outputs, batch_id, beam_size = None):
+        """Performs beam search decoding of a batch of channel outputs together.
+        The B sentences x K beams are run through SingleStepDecoder as one [B*K]
+        batch. For each sentence the 2K*K extensions are looked at best first:
+        the ones ending with the end token are pulled off as results, the others
+        become the new beams, until K beams or K results have been collected.
+        Beams live in a BeamStore, the decoder state is gathered by parent index
+        and the sequences are only built once decoding is finished.
 
+        Args:
+            chan_outputs: channel outputs of the B sentences [B, chan_out_dim]
+            batch_id: batch id shared by the sentences
+        Returns:
+            a list with the sorted hypotheses of each sentence
+        """
+        if beam_size!= None:
+            self._beam_size = beam_size
+        beam_size = self._beam_size
+        numb_cands = min(2 * beam_size, self.SingleStepDecoder.out_vocab_size)
+        numb_sentences = len(chan_outputs)
+        rows = np.arange(numb_sentences)[:, None]
+
+        init_state = sess.run(self.init_state, feed_dict={self.chan_out_PH:chan_outputs,self.batch_id:batch_id})
+        # layers x 2[c,h] x B.K x units, each sentence repeated K times
+        curr_states = np.repeat(np.array(init_state), beam_size, axis=2)
+        store = BeamStore(numb_sentences, beam_size, self._max_steps, self._start_token)
+        results = [[] for _ in range(numb_sentences)] # (step, parent beam, log prob)
+        numb_results = np.zeros([numb_sentences], dtype=np.int32)
 
-            fd = {self.input_PH: latest_tokens,
-                  self.state_PH: curr_states}
+        steps = 0
+        while steps < self._max_steps and (numb_results < beam_size).any():
+            fd = {self.input_PH: store.latest_tokens(),
+                  self.state_PH: curr_states,
+                  self.SingleStepDecoder.topk_PH: numb_cands}
 
             topk_ids, topk_log_probs, new_states = sess.run([self.SingleStepDecoder.topk_ids,
                                                              self.SingleStepDecoder.topk_probs,
                                                              self.SingleStepDecoder.new_states], feed_dict=fd)
-            #for t in topk_ids:
-            #    print(self.word2numb.convert_n2w(t.tolist()))
-            #print(topk_log_probs)
             new_states = np.array(new_states)
-            #print(new_states)
-            #print(new_states.shape)
-            #new_states=new_states.reshape((-1, self.numb_dec_layers, 2, self.dec_hidden_units))
-            #print(new_states)
-            #print(new_states.shape)
-
-
-            # Extend each hypothesis.
-            all_hyps = []
-            # The first step takes the best K results from first hyps. Following
-            # steps take the best K results from K*K hyps.
-            num_beam_source = 1 if steps == 0 else len(hyps)
-            for i in range(num_beam_source):
-                h, ns = hyps[i], new_states[:,:,i,:]
-                for j in range(self._beam_size*2):
-                    all_hyps.append(h.Extend(topk_ids[i, j], topk_log_probs[i, j], ns))
-
-            # Filter and collect any hypotheses that have the end token.
-            hyps = []
-            for h in self._BestHyps(all_hyps):
-                if h.latest_token == self._end_token:
-                    # Pull the hypothesis off the beam if the end token is reached.
-                    results.append(h)
-                else:
-                    # Otherwise continue to the extend the hypothesis.
-                    hyps.append(h)
-                if len(hyps) == self._beam_size or len(results) == self._beam_size:
-                    break
+
+            # Best 2K of the K*2K extensions of each sentence, best first. At most
+            # 2K-1 of them are looked at before K beams or K results are collected
+            cand_ids = topk_ids.reshape([numb_sentences, beam_size * numb_cands])
+            cand_scores = (store.log_probs[:, :, None] +
+                           topk_log_probs.reshape([numb_sentences, beam_size, numb_cands])
+                           ).reshape([numb_sentences, beam_size * numb_cands])
+            top = np.argpartition(-cand_scores, numb_cands-1, axis=1)[:, :numb_cands]
+            order = top[rows, np.lexsort((top, -cand_scores[rows, top]), axis=1)]
+            cand_ids = cand_ids[rows, order]
+            cand_scores = cand_scores[rows, order]
+            cand_parents = order // numb_cands
+
+            # A candidate is looked at only while neither K beams nor K results
+            # (for that sentence) have been collected
+            is_end = cand_ids == self._end_token
+            numb_hyps_before = np.cumsum(~is_end, axis=1) - ~is_end
+            numb_ends_before = np.cumsum(is_end, axis=1) - is_end
+            processed = ((numb_hyps_before < beam_size) &
+                         (numb_results[:, None] + numb_ends_before < beam_size))
+
+            # Pull the hypotheses that reached the end token off the beam
+            for sent, pos in zip(*np.nonzero(processed & is_end & np.isfinite(cand_scores))):
+                results[sent].append((steps, cand_parents[sent, pos], cand_scores[sent, pos]))
+                numb_results[sent] += 1
+
+            # The others continue. Missing beams are dead (-inf)
+            extend = processed & ~is_end
+            sel_pos = np.zeros([numb_sentences, beam_size], dtype=np.int64)
+            live = np.zeros([numb_sentences, beam_size], dtype=bool)
+            ext_rows, ext_cols = np.nonzero(extend)
+            ext_rank = (np.cumsum(extend, axis=1) - 1)[ext_rows, ext_cols]
+            sel_pos[ext_rows, ext_rank] = ext_cols
+            live[ext_rows, ext_rank] = True
+
+            parents = cand_parents[rows, sel_pos]
+            store.push(np.where(live, cand_ids[rows, sel_pos], self._end_token),
+                       parents,
+                       np.where(live, cand_scores[rows, sel_pos], -np.inf))
+            curr_states = new_states[:, :, (rows * beam_size + parents).ravel(), :]
 
             steps += 1
 
+        hyps = [[Hypothesis(store.backtrack(sent, step, parent) + [self._end_token], log_prob, None)
+                 for step, parent, log_prob in results[sent]]
+                for sent in range(numb_sentences)]
+        # Out of steps, the beams still live are results too (beams of sentences
+        # that finished earlier are all dead)
         if steps == self._max_steps:
-            results.extend(hyps)
+            for sent, beam in zip(*np.nonzero(np.isfinite(store.log_probs))):
+                hyps[sent].append(Hypothesis(store.backtrack(sent, steps, beam), store.log_probs[sent, beam], None))
 
-        return self._BestHyps(results)
+        return [self._BestHyps(sent_hyps) for sent_hyps in hyps]
 
     def _BestHyps(self, hyps, norm_by_len=False):
         """Sort the hyps based on log probs and length.
@@ -1773,9 +2084,12 @@ class BeamSearchEncChanDecNetVar(object):
                                           config=config)
 
         self.saver = tf.train.Saver()
+        self.enc_cache = None
+        self.channel_sim = ChannelSimulator(self.config.channel['type'], seed=self.config.kwargs.get('channel_seed',None))
 
     def load_enc_dec_weights(self, sess):
         sess.run(tf.global_variables_initializer())
+        self.embeddings.initialize(sess)
         vars_to_load = [var for var in tf.trainable_variables() if 'src' in var.name or var.name.startswith('chan')]
         print("All vars loaded: ", vars_to_load)
         saver_to_load = tf.train.Saver(vars_to_load)
@@ -1790,10 +2104,38 @@ class BeamSearchEncChanDecNetVar(object):
             saver_to_load.restore(sess, norm_ckpt_path)
         else:
             print("Error reading weights from %s" % norm_ckpt_path)
-        
+        if self.config.kwargs.get('enc_cache',None):
+            numb_bits = int(self.encoder.enc_output.get_shape()[-1])
+            self.enc_cache = EncodedSentenceCache(self.config.kwargs['enc_cache'],
+                                                  checkpoint_key(norm_ckpt_path),
+                                                  numb_bits)
+            print("Encoder output cache: {} sentences".format(self.enc_cache.numb_rows))
+
+    def encode_bits_cached(self, sess, batch):
+        """ Noiseless encoder outputs of a batch of sentences (without EOS),
+        read from the encoder output cache and computed for the missing ones
+        """
+        bits, missing = self.enc_cache.lookup(batch)
+        if len(missing):
+            missing_batch = [batch[ind] for ind in missing]
+            enc_inputs, enc_inputs_len, _, _ = build_feed_arrays(*flatten_batch(missing_batch),
+                                                                 eos_id=self.config.EOS,
+                                                                 sos_id=self.config.SOS,
+                                                                 pad_id=self.config.PAD)
+            fd = {self.isTrain: False,
+                  self.sentence: enc_inputs,
+                  self.sentence_len: enc_inputs_len,
+                  self.batch_id: bisect.bisect(self.config.queue_limits,len(batch[0]))-1}
+            bits[missing] = sess.run(self.encoder.enc_output, fd)
+            self.enc_cache.add(missing_batch, bits[missing])
+        return bits
 
     def encode_Tx_sentence(self, sess, num_tokens, chan_param=None):
         chan_param_eval = chan_param or self.config.channel['chan_param']
+        if self.enc_cache is not None:
+            chan_out = self.channel_sim(self.encode_bits_cached(sess, [num_tokens]), chan_param_eval)
+            num_tokens.append(self.config.EOS)
+            return (chan_out, bisect.bisect(self.config.queue_limits,len(num_tokens)-1)-1)
         num_tokens.append(self.config.EOS)
         
         batch_id_ =  bisect.bisect(self.config.queue_limits,len(num_tokens)-1)-1
@@ -1808,6 +2150,53 @@ class BeamSearchEncChanDecNetVar(object):
         chan_out = np.array(chan_out)
         return (chan_out[0],batch_id_)
 
+    def encode_Tx_batch(self, sess, batch, chan_param=None):
+        """ Encodes a batch of sentences (lists of ids, same length bin) and 
+        passes them through the channel. Unlike encode_Tx_sentence the batch is 
+        not modified.
+        Returns:
+            (channel outputs [batch, chan_out_dim], batch_id)
+        """
+        chan_param_eval = chan_param or self.config.channel['chan_param']
+        if self.enc_cache is not None:
+            return (self.channel_sim(self.encode_bits_cached(sess, batch), chan_param_eval),
+                    bisect.bisect(self.config.queue_limits,len(batch[0]))-1)
+        enc_inputs, enc_inputs_len, _, _ = build_feed_arrays(*flatten_batch(batch),
+                                                             eos_id=self.config.EOS,
+                                                             sos_id=self.config.SOS,
+                                                             pad_id=self.config.PAD)
+        batch_id_ =  bisect.bisect(self.config.queue_limits,len(batch[0]))-1
+
+        fd = {self.isTrain: False,
+              self.sentence: enc_inputs,
+              self.sentence_len: enc_inputs_len,
+              self.chan_param: chan_param_eval,
+              self.batch_id: batch_id_}
+
+        chan_out = sess.run(self.channel.channel_out, fd)
+        return (chan_out,batch_id_)
+
+    def dec_Rx_bits_batch(self, sess, chan_out_batch, beam_size=None):
+        """ Beam search decodes the channel outputs of a whole batch together
+        Returns:
+            list of (bestseq, bestseq_prob, beams) for each sentence
+        """
+        (chan_output,batch_id) = chan_out_batch
+        all_beams = self.beam_search_dec.BatchBeamSearch(sess, chan_output, batch_id, beam_size=beam_size)
+        return [(" ".join(self.word2numb.convert_n2w(beams[0].tokens)), beams[0].log_prob, beams)
+                for beams in all_beams]
+
+    def dec_Rx_bits_graph(self, sess, chan_out_batch, beam_size=None):
+        """ Beam search decodes the channel outputs of a whole batch with the
+        in-graph decoder
+        Returns:
+            list of (bestseq, bestseq_prob, beams) for each sentence
+        """
+        (chan_output,batch_id) = chan_out_batch
+        all_beams = self.beam_search_dec.GraphBeamSearch(sess, chan_output, batch_id, beam_size=beam_size)
+        return [(" ".join(self.word2numb.convert_n2w(beams[0].tokens)), beams[0].log_prob, beams)
+                for beams in all_beams]
+
     def dec_Rx_bits(self, sess, chan_out_batch, beam_size=None):
         (chan_output,batch_id) = chan_out_batch
         beams = self.beam_search_dec.BeamSearch(sess, chan_output,batch_id, beam_size=beam_size)
@@ -1815,13 +2204,21 @@ class BeamSearchEncChanDecNetVar(object):
         bestseq_prob = beams[0].log_prob
         return bestseq, bestseq_prob, beams
     
-def test_on_testset(sysNN,test_results_path):
+def test_on_testset(sysNN,test_results_path,results_format='text'):
+    """ Decodes the test set.
+    Args:
+        results_format - 'text' writes TX:/RX: lines to test_results_path,
+            'binary' writes the ids to the results folder (see results_io)
+            and 'both' does both
+    """
     # =============================  Validate on Test Data ===============================
     sysNN.test_data.prepare_batch_queues(randomize=False)
     batch = sysNN.test_data.get_next_batch(randomize=False)
     acc_list = []
+    write_text = results_format in ['text','both']
+    writer = ResultsWriter(results_dir(test_results_path)) if results_format in ['binary','both'] else None
     pbar=tqdm(total=sysNN.config.max_test_counter)
-    with open(test_results_path, 'w', newline='') as file:
+    with open(test_results_path if write_text else os.devnull, 'w', newline='') as file:
         while batch != None and pbar.n<=sysNN.config.max_test_counter:
 
             fd = sysNN.next_feed(batch, isTrain=False, help_prob = 0.0)
@@ -1829,7 +2226,14 @@ def test_on_testset(sysNN,test_results_path):
             acc_list.append(accu_)
             print("Channnel outputs: ", channel_out)
 
+            if writer is not None:
+                writer.write_batch([inp[:inp_len] for inp,inp_len in zip(fd[sysNN.enc_inputs],fd[sysNN.enc_inputs_len])],
+                                   trim_at_eos(predict_,sysNN.config.EOS),
+                                   fd[sysNN.batch_id], fd[sysNN.chan_param])
+
             for i, (inp, pred) in enumerate(zip(fd[sysNN.enc_inputs], predict_)):
+                if not write_text and (i >= 3 or pbar.n >= 3):
+                    break
                 tx = " ".join(sysNN.word2numb.convert_n2w(inp))
                 rx = " ".join(sysNN.word2numb.convert_n2w(pred))
                 if i < 3 and pbar.n<3:
@@ -1845,10 +2249,20 @@ def test_on_testset(sysNN,test_results_path):
         pbar.close()
         print("Average Accuracy: ", np.average(acc_list))
         file.write("Average Accuracy: {}\n".format(np.average(acc_list)))
+    if writer is not None:
+        writer.close()
     return
 
 
-def beam_test_on_testset(sess, beamNN, test_data, test_results_path,test_results_err_path,chan_param=None,bits_param = None):
+def beam_test_on_testset(sess, beamNN, test_data, test_results_path,test_results_err_path,chan_param=None,bits_param = None,
+                         beam_mode='single', results_format='text'):
+    """ Beam search decoding of the test set.
+    Args:
+        beam_mode - 'single' decodes the first sentence of every batch on its own,
+            'batched' decodes all the sentences of every batch together and
+            'graph' does the same with the in-graph decoder (one session call)
+        results_format - 'text', 'binary' or 'both' (see test_on_testset)
+    """
     # =============================  Validate on Test Data ===============================
     bits_lim = bits_param or beamNN.config.bits_per_bin
     
@@ -1856,45 +2270,72 @@ def beam_test_on_testset(sess, beamNN, test_data, test_results_path,test_results
     batches = test_data.get_next_batch(randomize=False)
     numb_errors = 0
     numb_words = 0
+    numb_edits = 0
+    numb_tx_words = 0
+    write_text = results_format in ['text','both']
+    writer = ResultsWriter(results_dir(test_results_path)) if results_format in ['binary','both'] else None
+    chan_param_eval = chan_param or beamNN.config.channel['chan_param']
     pbar = tqdm(total = beamNN.config.max_test_counter)
 
-    with open(test_results_path, 'w', newline='') as file:
+    with open(test_results_path if write_text else os.devnull, 'w', newline='') as file:
         with open(test_results_err_path, 'w', newline='') as fileErr:
             while batches != None and pbar.n<beamNN.config.max_test_counter:
-                batch = batches[0]
-                chan_out = beamNN.encode_Tx_sentence(sess, batch,chan_param=chan_param)
-                channel_out,batch_out = chan_out
-#                print(channel_out[0,:10])
-                channel_out[0,bits_lim[batch_out]:] = 0
-                chan_out = (channel_out,batch_out)
-#                print(channel_out[0,:10])
-                bestseq, bestseq_prob, all_beams = beamNN.dec_Rx_bits(sess, chan_out)
-
-                pred = all_beams[0].tokens
-                pred = pred[1:]
-                diff = [int(pred[i] != batch[i]) for i in range(min(len(pred), len(batch)))]
-                numb_words += max(len(pred), len(batch))
-                curr_errors = sum(diff) + abs(len(pred)-len(batch))
-                numb_errors += curr_errors
-                running_err_rate = numb_errors/numb_words
-                print("Running word error rate: ", running_err_rate)
-                tx = " ".join(beamNN.word2numb.convert_n2w(batch))
-                rx = " ".join(beamNN.word2numb.convert_n2w(pred))
-                    
-                file.write('TX: {}\n'.format(tx))
-                file.write('RX: {}\n'.format(rx))
-                print('Batch: {}\n'.format(tx))
-                print('Prediction: {}\n'.format(rx))
-                if curr_errors > 0:
-                    fileErr.write('TX: {}\n'.format(tx))
-                    fileErr.write('RX: {}\n'.format(rx))
-                pbar.update(1)
+                if beam_mode in ['batched', 'graph']:
+                    batches = batches[:beamNN.config.max_test_counter-pbar.n]
+                    channel_out,batch_out = beamNN.encode_Tx_batch(sess, batches,chan_param=chan_param)
+                    channel_out[:,bits_lim[batch_out]:] = 0
+                    if beam_mode == 'graph':
+                        decoded = beamNN.dec_Rx_bits_graph(sess, (channel_out,batch_out))
+                    else:
+                        decoded = beamNN.dec_Rx_bits_batch(sess, (channel_out,batch_out))
+                    tx_pred = [(sentence + [beamNN.config.EOS], all_beams[0].tokens[1:], bestseq_prob)
+                               for sentence,(_,bestseq_prob,all_beams) in zip(batches,decoded)]
+                else:
+                    batch = batches[0]
+                    chan_out = beamNN.encode_Tx_sentence(sess, batch,chan_param=chan_param)
+                    channel_out,batch_out = chan_out
+#                    print(channel_out[0,:10])
+                    channel_out[0,bits_lim[batch_out]:] = 0
+                    chan_out = (channel_out,batch_out)
+#                    print(channel_out[0,:10])
+                    bestseq, bestseq_prob, all_beams = beamNN.dec_Rx_bits(sess, chan_out)
+                    tx_pred = [(batch, all_beams[0].tokens[1:], bestseq_prob)]
+
+                tx_sents,pred_sents,log_probs = zip(*tx_pred)
+                if writer is not None:
+                    writer.write_batch(tx_sents,pred_sents,batch_out,chan_param_eval,log_probs)
+                numb_edits += int(np.sum(sentences_edit_distance(tx_sents,pred_sents)))
+                numb_tx_words += sum(len(sentence) for sentence in tx_sents)
+                for batch,pred,_ in tx_pred:
+                    diff = [int(pred[i] != batch[i]) for i in range(min(len(pred), len(batch)))]
+                    numb_words += max(len(pred), len(batch))
+                    curr_errors = sum(diff) + abs(len(pred)-len(batch))
+                    numb_errors += curr_errors
+                    running_err_rate = numb_errors/numb_words
+                    print("Running word error rate: ", running_err_rate)
+                    tx = " ".join(beamNN.word2numb.convert_n2w(batch))
+                    rx = " ".join(beamNN.word2numb.convert_n2w(pred))
+                        
+                    file.write('TX: {}\n'.format(tx))
+                    file.write('RX: {}\n'.format(rx))
+                    print('Batch: {}\n'.format(tx))
+                    print('Prediction: {}\n'.format(rx))
+                    if curr_errors > 0:
+                        fileErr.write('TX: {}\n'.format(tx))
+                        fileErr.write('RX: {}\n'.format(rx))
+                    pbar.update(1)
                 batches = test_data.get_next_batch(randomize=False)
 
         WER = numb_errors/numb_words
         print("Average Word Error Rate: ", WER)
         file.write("Average Word Error Rate: {}\n".format(WER))
+        ED_WER = numb_edits/numb_tx_words
+        print("Average Word Error Rate (edit distance): ", ED_WER)
         pbar.close()
+    if beamNN.enc_cache is not None:
+        beamNN.enc_cache.save()
+    if writer is not None:
+        writer.close()
     return
 
 
@@ -1916,6 +2357,12 @@ def parse_args(arg_to_parse = None):
     parser.add_argument('--chan_param_min','-cp_min', type=float,help='min keep rate or sig value of channel')
     parser.add_argument('--performance_file_name', '-p_fname')
     parser.add_argument('--edit_distance_type', '-edt', default = 'ed_only', choices = ['ed_only', 'ed_WuP'])
+    parser.add_argument('--eval_workers', '-ew', default=None, type=int, help='Number of processes scoring the results. Defaults to all cpus')
+    parser.add_argument('--wup_memo', '-wm', default=None, help='Pickle file of the Wu Palmer similarity memo')
+    parser.add_argument('--synset_table', '-st', default=None, help='Pickle file of the precomputed POS/lemma/synset table of the vocabulary')
+    parser.add_argument('--stream_eval', '-sev', action='store_true', help='Evaluate the results in constant memory with running statistics')
+    parser.add_argument('--follow_results', '-fr', default=None, type=float, help='Keep reading results being written, stopping after this many idle seconds')
+    parser.add_argument('--reservoir_size', '-rsz', default=0, type=int, help='Number of sampled performances kept per length bin by the streaming evaluation')
     
     parser.add_argument('--variable_encoding','-v',action='count',help='Number of v indicate version. 0 is no variable, 1 is std method, 2 is exp method')
     parser.add_argument('--dataset','-d',default='news',choices=['wiki','news','euro','beta'])
@@ -1952,11 +2399,19 @@ def parse_args(arg_to_parse = None):
     parser.add_argument('--summary_every','-sme',default=5,type=int)
     parser.add_argument('--peephole','-p',action='store_false')
     parser.add_argument('--beam_size','-bs',default=10,type=int)
+    parser.add_argument('--beam_mode','-bm',default='single',choices=['single','batched','graph'],help='Beam search one sentence at a time, whole test batches together or whole test batches in-graph')
+    parser.add_argument('--beam_shortlist','-bsl',default=None,type=int,help='Restrict beam search candidates to the N most frequent words. Only their logits are computed and the probabilities are normalized over them (an approximation)')
+    parser.add_argument('--enc_cache','-ec',default=None,help='Folder of the encoder output cache. Channel noise is then added in numpy')
+    parser.add_argument('--channel_seed','-cs',default=None,type=int,help='Seed of the numpy channel noise used with the encoder output cache')
+    parser.add_argument('--results_format','-rf',default='text',choices=['text','binary','both'],help='Test results as TX:/RX: text, columnar binary ids or both')
     parser.add_argument('--test_param','-tp',default=None,type=float,help='Channel parameter value for testing')
     parser.add_argument('--test_param2','-tp2',nargs='+',type=int,help='Channel parameter to pass a different number of bits at test time')
     parser.add_argument('--add_name_results','-anr',default='')
     parser.add_argument('--unk_perc','-up',default=0.2,type=float)
     parser.add_argument('--qcap','-q',default=200,type=int)
+    parser.add_argument('--corpus_cache','-cc',action='store_true',help='Read pre-tokenized (compiled) corpora instead of tokenizing text')
+    parser.add_argument('--input_pipeline','-ip',default='queue',choices=['queue','tf_data'],help='Training input backend')
+    parser.add_argument('--numb_workers','-nw',default=0,type=int,help='Number of loader processes feeding the training queue. 0 uses the enqueue thread only')
     
     if arg_to_parse is None:
         conf_args = vars(parser.parse_args())
@@ -1981,12 +2436,18 @@ def parse_args(arg_to_parse = None):
             conf_args['bits_per_bin_gen'].append(None)
         conf_args['bits_per_bin']= bin_batch_create(conf_args['numb_tx_bits'],
                          dataset=conf_args['dataset'],
-                         type_bit_bin = type_bit_bin,low_lim=low_lim)
+                         type_bit_bin = type_bit_bin,low_lim=low_lim,
+                         length_from=conf_args['length_from'],length_to=conf_args['length_to'],
+                         bin_len=conf_args['bin_len'])
         
-    conf_args['w2n_path'] = conf_args['w2n_path'] or os.path.join(parent_dir,'data',conf_args['dataset'],'w2n_n2w_'+conf_args['dataset']+'.pickle')
+    if conf_args['w2n_path'] is None: #Prefers the .npz vocabulary if it was built
+        w2n_path = os.path.join(parent_dir,'data',conf_args['dataset'],'w2n_n2w_'+conf_args['dataset'])
+        conf_args['w2n_path'] = w2n_path + '.npz' if os.path.exists(w2n_path + '.npz') else w2n_path + '.pickle'
     conf_args['testdata_path'] = conf_args['testdata_path'] or os.path.join(parent_dir,'data',conf_args['dataset'],conf_args['dataset']+'_test.dat')
     conf_args['traindata_path'] = conf_args['traindata_path'] or os.path.join(parent_dir,'data',conf_args['dataset'],conf_args['dataset']+'_train.dat')
-    conf_args['embed_path'] = conf_args['embed_path'] or os.path.join(parent_dir,'data',conf_args['dataset'],'{}_embed_{}.pickle'.format(conf_args['embedding_size'],conf_args['dataset']))
+    if conf_args['embed_path'] is None: #Prefers the memory mappable .npy embeddings if they were built
+        embed_path = os.path.join(parent_dir,'data',conf_args['dataset'],'{}_embed_{}'.format(conf_args['embedding_size'],conf_args['dataset']))
+        conf_args['embed_path'] = embed_path + '.npy' if os.path.exists(embed_path + '.npy') else embed_path + '.pickle'
     fileName = generate_tb_filename(Config(**conf_args))
     print("File name generated: ", fileName)
     
@@ -2016,9 +2477,10 @@ if __name__ == '__main__':
     config = Config(**conf_args)
 
     word2numb = Word2Numb(config.w2n_path,vocab_size = config.vocab_size)
-    config.vocab_size= min(len(word2numb.n2w),config.vocab_size)
+    config.vocab_size= min(len(word2numb),config.vocab_size)
     
-    train_sentence_gen = SentenceBatchGenerator(config.traindata_path,
+    batch_gen_class = CompiledSentenceBatchGenerator if conf_args['corpus_cache'] else SentenceBatchGenerator
+    train_sentence_gen = batch_gen_class(config.traindata_path,
                                                 word2numb,
                                                 batch_size=config.batch_size,
                                                 min_len=config.length_from,
@@ -2026,7 +2488,7 @@ if __name__ == '__main__':
                                                 diff=config.bin_len,
                                                 unk_perc = conf_args['unk_perc'])
 
-    test_sentences = SentenceBatchGenerator(config.testdata_path,
+    test_sentences = batch_gen_class(config.testdata_path,
                                             word2numb,
                                             batch_size=config.batch_size,
                                             min_len=config.length_from,
@@ -2050,6 +2512,7 @@ if __name__ == '__main__':
         print('Start training src coder...')
         with tf.Session() as sess:
             sess.run(tf.global_variables_initializer())
+            sysNN.embeddings.initialize(sess)
             sysNN.load_trained_model(sess) #Loads nothing if config.load_mech == 'None'    
             writer = tf.summary.FileWriter(summ_path)
             writer.add_graph(sess.graph)
@@ -2061,6 +2524,7 @@ if __name__ == '__main__':
         print('Start training...')
         with tf.Session() as sess:
             sess.run(tf.global_variables_initializer())
+            sysNN.embeddings.initialize(sess)
             
             sysNN.load_trained_model(sess) #Expect load_mech to be set to 'individual_all'
 
@@ -2086,18 +2550,20 @@ if __name__ == '__main__':
         print('Start testing...')
         with tf.Session() as sess:
             sess.run(tf.global_variables_initializer())
+            sysNN.embeddings.initialize(sess)
 
             print("Mod_chan: ", config.mod_chan_coding)
             print("Channel: ", config.channel)
             sysNN.load_trained_model(sess) #Expect load_mech to be set to one of ['full',  'src_only']
             print("Done Loading")
-            test_on_testset(sysNN, test_results_path)
+            test_on_testset(sysNN, test_results_path, results_format = conf_args['results_format'])
         print('Finished testing...')
         
     elif train_test in ['beam', 'test_src']: #'beam' tests on full model, 'test_src' only tests src code
-        test_results_path = "beam-" + "test_results_path"
         print("Saving results to: ",  test_results_path)
-        test_sentences = SentenceBatchGenerator(config.testdata_path,
+        if not os.path.exists(os.path.dirname(os.path.abspath(test_results_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(test_results_path)))
+        test_sentences = batch_gen_class(config.testdata_path,
                                         word2numb,
                                         batch_size=config.batch_size_test,
                                         min_len=config.length_from,
@@ -2116,5 +2582,7 @@ if __name__ == '__main__':
             print("Beam weights initialized and loaded.")
             beam_test_on_testset(sess, beam_sys, test_sentences, test_results_path, 
                                  test_results_err_path,chan_param=conf_args['test_param'],
-                                 bits_param = conf_args['test_param2'])
+                                 bits_param = conf_args['test_param2'],
+                                 beam_mode = conf_args['beam_mode'],
+                                 results_format = conf_args['results_format'])
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Constant memory statistics for streaming evaluation: running mean/variance
+(Welford), uniform reservoir samples and their per length bin combination.
+========================================================================"""
+import numpy as np
+
+
+class RunningStats(object):
+    """ Running count, mean and variance (Welford's algorithm)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 #Sum of squared differences from the mean
+
+    def add(self, values):
+        """ Adds a value or an array of values"""
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if len(values) == 0:
+            return
+        other = RunningStats()
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean)**2).sum())
+        self.merge(other)
+
+    def merge(self, other):
+        """ Adds the values summarized by another RunningStats"""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def total(self):
+        return self.mean * self.count
+
+
+class Reservoir(object):
+    """ Uniform sample of at most size values out of a stream (algorithm R)
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.samples = []
+        self.seen = 0
+        self.rng = np.random.RandomState(seed)
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            ind = self.rng.randint(self.seen)
+            if ind < self.size:
+                self.samples[ind] = value
+
+
+class BinnedStats(object):
+    """ RunningStats (and optionally a Reservoir) for each length bin. Values
+    can be grouped by batch_size before being added, as batch_performance does.
+    """
+    def __init__(self, numb_bins, batch_size=1, reservoir_size=0, seed=None):
+        self.stats = [RunningStats() for _ in range(numb_bins)]
+        self.reservoirs = [Reservoir(reservoir_size, seed) for _ in range(numb_bins)] if reservoir_size else None
+        self.batch_size = batch_size
+        self.pending = [[] for _ in range(numb_bins)]
+        self.numb_values = [0]*numb_bins #Values added, before grouping
+
+    def add(self, idx, value):
+        self.numb_values[idx] += 1
+        if self.batch_size > 1:
+            self.pending[idx].append(value)
+            if len(self.pending[idx]) < self.batch_size:
+                return
+            value = np.mean(self.pending[idx])
+            self.pending[idx] = []
+        self.stats[idx].add(value)
+        if self.reservoirs is not None:
+            self.reservoirs[idx].add(value)
+
+    def metrics(self):
+        """ Same dictionary as performance_tests._performance_metrics, with the
+        reservoir samples (if any) as performances
+        """
+        perf_mean = [stat.mean if stat.count else np.nan for stat in self.stats]
+        perf_std = [stat.std for stat in self.stats]
+        bin_counts = [stat.count for stat in self.stats]
+        performance = [res.samples for res in self.reservoirs] if self.reservoirs is not None else None
+        total_count = np.sum(bin_counts)
+        total_mean = np.sum([stat.total for stat in self.stats]) / total_count if total_count else np.nan
+
+        if len(self.stats)==1: #It is not divided by batches
+            performance = performance[0] if performance is not None else None
+            perf_mean = perf_mean[0]
+            perf_std = perf_std[0]
+
+        return {'performances': performance,
+                'means': perf_mean,
+                'std_devs': perf_std,
+                'bin_counts': bin_counts,
+                'total_mean': total_mean}
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Character level prefix codes (5 bit, Huffman) encoded with lookup tables
+into packed bits (np.packbits) instead of strings of '0'/'1', and decoded
+with a table indexed by the next bits of the stream.
+========================================================================"""
+from collections import namedtuple
+import numpy as np
+
+PackedBits = namedtuple('PackedBits', ['data', 'numb_bits']) #data: bytes, numb_bits: bits used
+
+
+class PrefixCodec(object):
+    """ Encoder/decoder of a prefix code over characters
+    """
+    def __init__(self, codebook, default_char, max_table_bits=16):
+        """
+        Args:
+            codebook: dictionary char -> code as a string of '0'/'1'
+            default_char: character whose code is used for characters that
+                are not in the codebook
+            max_table_bits: the decoding table covers codes of up to this many
+                bits, longer codes are looked up one length at a time
+        """
+        self.codebook = codebook
+        self.max_len = max(len(code) for code in codebook.values())
+        numb_chars = max(ord(char) for char in codebook) + 1
+        default = ord(default_char)
+
+        # Encoding tables indexed by code point
+        self.lengths = np.zeros([numb_chars], dtype=np.int64)
+        self.bits = np.zeros([numb_chars, self.max_len], dtype=np.uint8)
+        for char, code in codebook.items():
+            self.lengths[ord(char)] = len(code)
+            self.bits[ord(char), :len(code)] = [int(bit) for bit in code]
+        unknown = self.lengths == 0
+        self.lengths[unknown] = self.lengths[default]
+        self.bits[unknown] = self.bits[default]
+        self.default = default
+
+        # Decoding table indexed by the next table_bits bits
+        self.table_bits = min(self.max_len, max_table_bits)
+        self.table_chars = np.zeros([2**self.table_bits], dtype=np.int64)
+        self.table_lens = np.zeros([2**self.table_bits], dtype=np.int64) #0 marks a longer or invalid code
+        self.long_codes = {}
+        for char, code in codebook.items():
+            if len(code) > self.table_bits:
+                self.long_codes[(len(code), int(code, 2))] = ord(char)
+                continue
+            start = int(code, 2) << (self.table_bits - len(code))
+            end = start + 2**(self.table_bits - len(code))
+            self.table_chars[start:end] = ord(char)
+            self.table_lens[start:end] = len(code)
+
+    def _code_points(self, text):
+        chars = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        chars[chars >= len(self.lengths)] = self.default
+        return chars
+
+    def code_lengths(self, text):
+        """ Number of bits of every character of text"""
+        return self.lengths[self._code_points(text)]
+
+    def prefix_bits(self, sentences):
+        """ Number of bits of ' '.join(sentences[:k+1]) for every k"""
+        bits = np.concatenate([[0], np.cumsum(self.code_lengths(' '.join(sentences)))])
+        ends = np.cumsum([len(sentence) for sentence in sentences]) + np.arange(len(sentences))
+        return bits[ends]
+
+    def encode(self, text):
+        """ Encodes text
+        Returns:
+            PackedBits
+        """
+        chars = self._code_points(text)
+        lengths = self.lengths[chars]
+        mask = np.arange(self.max_len) < lengths[:, None]
+        bits = self.bits[chars][mask]
+        return PackedBits(np.packbits(bits).tobytes(), len(bits))
+
+    def decode(self, data, numb_bits=None):
+        """ Decodes packed bits. Decoding stops at the first invalid code
+        Args:
+            data: bytes (or PackedBits)
+            numb_bits: number of bits used. None uses them all
+        Returns:
+            text
+        """
+        if isinstance(data, PackedBits):
+            data, numb_bits = data
+        bits = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8)).astype(np.int64)
+        numb_bits = len(bits) if numb_bits is None else min(numb_bits, len(bits))
+        bits = np.concatenate([bits[:numb_bits], np.zeros([self.max_len], dtype=np.int64)])
+        # Value of the table_bits bits starting at every position
+        weights = 2**np.arange(self.table_bits-1, -1, -1)
+        windows = np.lib.stride_tricks.sliding_window_view(bits, self.table_bits)[:numb_bits].dot(weights)
+
+        chars = []
+        pos = 0
+        while pos < numb_bits:
+            length = self.table_lens[windows[pos]]
+            if length:
+                chars.append(self.table_chars[windows[pos]])
+            else:
+                char = None
+                value = windows[pos]
+                for length in range(self.table_bits+1, self.max_len+1):
+                    value = 2*value + bits[pos+length-1]
+                    char = self.long_codes.get((length, value))
+                    if char is not None:
+                        break
+                if char is None:
+                    break
+                chars.append(char)
+            pos += length
+        if pos > numb_bits: #Last code ran into the padding
+            chars = chars[:-1]
+        return ''.join(map(chr, chars))
@@ -18,10 +18,18 @@ import bisect
 import numpy as np
 from tqdm import tqdm
 import os
+import pickle
+import multiprocessing as mp
+import time
 from nltk.stem import WordNetLemmatizer
 from nltk import pos_tag
 from nltk.corpus import wordnet as wn
 from jointSC_modChan import parse_args
+from batch_edit_distance import sentences_edit_distance
+from results_io import ResultsReader, results_dir
+from online_stats import BinnedStats, Reservoir
+
+_lemmatizer = WordNetLemmatizer()
 
 
 def simple_tokenizer(sentence,word2numb,special_words=[]):
@@ -62,13 +70,12 @@ def get_synset(tagged):
         Returns:
             syn: the synonyms set, i.e., synset for the word
     """
-    lemmatzr = WordNetLemmatizer()
     wn_tag = penn_to_wn(tagged[0][1]) #convert tag to synset wordnet tag
     if not wn_tag: # if the tag not in synset wordnet tag, (e.g. for word our)
         return None
 
     # find the base of the word
-    lemma = lemmatzr.lemmatize(tagged[0][0], pos=wn_tag)
+    lemma = _lemmatizer.lemmatize(tagged[0][0], pos=wn_tag)
 
     # find synset using synset wordnet tag
     syn = wn.synsets(lemma, pos=wn_tag)
@@ -80,7 +87,135 @@ def get_synset(tagged):
     return syn[0] # return the first word in the synset
 
 
-def edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb):
+def word_similarity(tx_word,rx_word):
+    """ Wu Palmer similarity of two words, 0 if either has no synset"""
+    tx_syn = get_synset(pos_tag([tx_word]))
+    rx_syn = get_synset(pos_tag([rx_word]))
+    sim = 0
+    if (tx_syn is not None) and (rx_syn is not None):
+        sim = tx_syn.wup_similarity(rx_syn) # use Wu Palmer similarity measure
+        if sim is None:
+            sim = 0
+    return sim
+
+
+class SynsetTable(object):
+    """ POS tag, lemma and first synset of every word id of the vocabulary,
+    precomputed with build_synset_table so that no tagging or lemmatizing is
+    done at evaluation time. Similarities of pairs of ids below dense_size
+    (the most frequent words) are cached in a dense matrix.
+    """
+    def __init__(self, path, dense_size=2000):
+        with open(path, 'rb') as fop:
+            table = pickle.load(fop)
+        self.pos = table['pos']
+        self.lemma = table['lemma']
+        self.synset_name = table['synset']
+        self.synsets = {}
+        self.dense_size = min(dense_size, len(self.synset_name))
+        self.dense_sim = np.full([self.dense_size, self.dense_size], np.nan, dtype=np.float32)
+
+    def synset(self, word_id):
+        if word_id >= len(self.synset_name) or not self.synset_name[word_id]:
+            return None
+        if word_id not in self.synsets:
+            self.synsets[word_id] = wn.synset(self.synset_name[word_id])
+        return self.synsets[word_id]
+
+    def similarity(self, tx_id, rx_id):
+        """ Wu Palmer similarity of two word ids, 0 if either has no synset"""
+        dense = tx_id < self.dense_size and rx_id < self.dense_size
+        if dense and not np.isnan(self.dense_sim[tx_id, rx_id]):
+            return float(self.dense_sim[tx_id, rx_id])
+        tx_syn = self.synset(tx_id)
+        rx_syn = self.synset(rx_id)
+        sim = 0
+        if (tx_syn is not None) and (rx_syn is not None):
+            sim = tx_syn.wup_similarity(rx_syn) or 0
+        if dense:
+            self.dense_sim[tx_id, rx_id] = sim
+        return sim
+
+
+def build_synset_table(word2numb, path):
+    """ Tags, lemmatizes and looks up the first synset of every word id of
+    word2numb (as get_synset does) and saves them for SynsetTable
+    Args:
+        word2numb: the dictionary object
+        path: pickle file to write
+    """
+    numb_words = len(word2numb)
+    pos = np.full([numb_words], '', dtype='U4')
+    lemma = np.full([numb_words], '', dtype=object)
+    synset = np.full([numb_words], '', dtype=object)
+    for word_id,word in enumerate(tqdm(word2numb.convert_n2w(range(numb_words)), desc='synsets ')):
+        if word == "<>":
+            continue
+        tag = pos_tag([word])[0][1]
+        pos[word_id] = tag
+        wn_tag = penn_to_wn(tag)
+        if not wn_tag:
+            continue
+        lemma[word_id] = _lemmatizer.lemmatize(word, pos=wn_tag)
+        syn = wn.synsets(lemma[word_id], pos=wn_tag) or wn.synsets(lemma[word_id])
+        if syn:
+            synset[word_id] = syn[0].name()
+    with open(path, 'wb') as fop:
+        pickle.dump({'pos': pos, 'lemma': lemma.astype(str), 'synset': synset.astype(str)}, fop)
+
+
+class SimilarityMemo(object):
+    """ Memo table (tx_word_id, rx_word_id) -> Wu Palmer similarity that can
+    be saved to and loaded from a pickle file to be reused across runs. Missing
+    similarities are computed with the SynsetTable if one is given, else with
+    NLTK directly
+    """
+    def __init__(self, path=None, synset_table=None):
+        self.path = path
+        self.synset_table = synset_table
+        self.table = {}
+        self.new_entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as fop:
+                self.table = pickle.load(fop)
+
+    def similarity(self, tx_id, rx_id, tx_word, rx_word):
+        key = (tx_id, rx_id)
+        sim = self.table.get(key)
+        if sim is None:
+            if self.synset_table is not None:
+                sim = self.synset_table.similarity(tx_id, rx_id)
+            else:
+                sim = word_similarity(tx_word, rx_word)
+            self.table[key] = sim
+            self.new_entries[key] = sim
+        return sim
+
+    def update(self, entries):
+        """ Adds entries computed elsewhere (e.g. by another process)"""
+        self.table.update(entries)
+        self.new_entries.update(entries)
+
+    def pop_new_entries(self):
+        entries, self.new_entries = self.new_entries, {}
+        return entries
+
+    def save(self):
+        if self.path is None or not self.new_entries:
+            return
+        if os.path.exists(self.path): #Merge with entries saved by other runs
+            with open(self.path, 'rb') as fop:
+                table = pickle.load(fop)
+            table.update(self.table)
+            self.table = table
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fop:
+            pickle.dump(self.table, fop)
+        os.replace(tmp_path, self.path)
+        self.new_entries = {}
+
+
+def edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb,memo=None):
     """ This function aligns two seq according to edit distance and then
      subtracts the similarity measure between replaced words from the edit distance.
      Wu Parmer similarity measure is used for this task.
@@ -89,6 +224,7 @@ def edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb):
         tx_numb: the number representation of the tx sentence
         rx_numb: the number representation fo the rx sentence
         word2numb: word to numb object
+        memo: optional SimilarityMemo
 
     Returns:
         dist_measur: returns the distance measure
@@ -111,13 +247,10 @@ def edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb):
             indx_rx += 1
             continue
         elif op[0] == 'replace': # if replacement discount similarity
-            tx_syn = get_synset(pos_tag([tx_txt[indx_tx]]))
-            rx_syn = get_synset(pos_tag([rx_txt[indx_rx]]))
-            sim = 0
-            if (tx_syn is not None) and (rx_syn is not None):
-                sim = tx_syn.wup_similarity(rx_syn) # use Wu Palmer similarity measure
-                if sim is None:
-                    sim = 0
+            if memo is not None:
+                sim = memo.similarity(tx_numb[indx_tx], rx_numb[indx_rx], tx_txt[indx_tx], rx_txt[indx_rx])
+            else:
+                sim = word_similarity(tx_txt[indx_tx], rx_txt[indx_rx])
             dist_measur -= sim
             indx_tx += 1
             indx_rx += 1
@@ -131,7 +264,7 @@ def edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb):
 
     return dist_measur
 
-def calc_distance(tx_numb,rx_numb,word2numb, dist_type="ed_only"):
+def calc_distance(tx_numb,rx_numb,word2numb, dist_type="ed_only", memo=None):
     """ This function returns the distance measure between two sequences
     depending on the type of the distance measure.
 
@@ -142,6 +275,7 @@ def calc_distance(tx_numb,rx_numb,word2numb, dist_type="ed_only"):
         dist_type: can be "ed_only" for edit distance or "ed_WuP" for
                    edit distance with discounted similarity measure.
                    Other types can be added in the future.
+        memo: optional SimilarityMemo used by "ed_WuP"
 
     Returns:
         dist_measur: returns the distance measure
@@ -149,15 +283,158 @@ def calc_distance(tx_numb,rx_numb,word2numb, dist_type="ed_only"):
     if dist_type == "ed_only":
         return edeval(tx_numb,rx_numb)
     elif dist_type == "ed_WuP":
-        return edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb)
+        return edit_dist_with_repl_similarity(tx_numb,rx_numb,word2numb,memo)
     else:
         return None
 
 
+def batch_calc_distance(tx_sentences,rx_sentences,word2numb,dist_type="ed_only",memo=None):
+    """ calc_distance of many pairs of sentences at once, using the batched
+    edit distance. With "ed_WuP" the similarities of the substituted words of
+    the alignments are subtracted.
+
+    Args:
+        tx_sentences: list of tx sentences (lists of ids)
+        rx_sentences: list of rx sentences
+        word2numb: word to numb object
+        dist_type: "ed_only" or "ed_WuP"
+        memo: optional SimilarityMemo used by "ed_WuP"
+
+    Returns:
+        array of distance measures
+    """
+    if dist_type == "ed_only":
+        return sentences_edit_distance(tx_sentences,rx_sentences).astype(np.float64)
+    elif dist_type == "ed_WuP":
+        distances,(rows,sub_tx,sub_rx) = sentences_edit_distance(tx_sentences,rx_sentences,
+                                                                 return_substitutions=True)
+        memo = memo if memo is not None else SimilarityMemo()
+        sims = [memo.similarity(int(tx_id),int(rx_id),tx_word,rx_word)
+                for tx_id,rx_id,tx_word,rx_word in zip(sub_tx,sub_rx,word2numb.convert_n2w(sub_tx),word2numb.convert_n2w(sub_rx))]
+        return distances - np.bincount(rows,weights=sims,minlength=len(distances))
+    else:
+        return None
+
+
+_eval_state = {}
+
+def _init_eval_worker(word2numb, dist_type, memo_path, synset_path=None):
+    """ Initializer of the performance_test worker processes"""
+    _eval_state['word2numb'] = word2numb
+    _eval_state['dist_type'] = dist_type
+    synset_table = SynsetTable(synset_path) if synset_path else None
+    _eval_state['memo'] = SimilarityMemo(memo_path, synset_table)
+
+def _score_pairs(pairs):
+    """ Scores (tx_words, rx_words) pairs with the worker state
+    Returns:
+        word error rates of the pairs, new similarity memo entries
+    """
+    memo = _eval_state['memo']
+    tx_sentences,rx_sentences = zip(*pairs)
+    distances = batch_calc_distance(tx_sentences,rx_sentences,_eval_state['word2numb'],_eval_state['dist_type'],memo)
+    scores = distances/np.array([len(tx_words) for tx_words in tx_sentences])
+    return scores.tolist(), memo.pop_new_entries()
+
+def read_result_pairs(test_path,word2numb,batch_limits,max_per_point):
+    """ Reads the TX/RX pairs of a results file, keeping at most max_per_point+1
+    pairs in each length bin
+    Returns:
+        list of (bin index, tx_words, rx_words)
+    """
+    special_words = word2numb.convert_w2n(['<pad>','<end>','<start>'])
+    bin_counts = [0]*len(batch_limits)
+    do_not_fill = set([])
+    pairs = []
+    with open(test_path,'r',encoding='utf8') as fop:
+        for line in tqdm(fop,total=20000,desc='reading '):
+            tx_line = line[4:-7]
+
+            try:
+                rx_line = fop.readline()[4:-7]
+                tx_words = simple_tokenizer(tx_line,word2numb,special_words)
+                rx_words = remove_duplicates(simple_tokenizer(rx_line,word2numb,special_words))
+            except:
+                break
+
+            idx =  bisect.bisect(batch_limits,len(tx_words))-1
+
+            if idx not in do_not_fill:
+                pairs.append((idx,tx_words,rx_words))
+                bin_counts[idx] += 1
+            if bin_counts[idx]>max_per_point:
+                do_not_fill.add(idx)
+            if len(do_not_fill) == len(batch_limits):
+                break
+    return pairs
+
+def _filter_special(tokens,lengths,special_words,dedupe=False):
+    """ Removes the special words (and contiguous duplicates if dedupe) from
+    back to back sentences
+    Returns:
+        list of the filtered sentences (arrays)
+    """
+    segment = np.repeat(np.arange(len(lengths)),lengths)
+    keep = ~np.isin(tokens,special_words)
+    tokens,segment = tokens[keep],segment[keep]
+    if dedupe and len(tokens):
+        keep = np.ones(len(tokens),dtype=bool)
+        keep[1:] = (tokens[1:] != tokens[:-1]) | (segment[1:] != segment[:-1])
+        tokens,segment = tokens[keep],segment[keep]
+    new_lengths = np.bincount(segment,minlength=len(lengths))
+    return np.split(tokens,np.cumsum(new_lengths)[:-1])
+
+def read_result_pairs_binary(test_path,word2numb,batch_limits,max_per_point):
+    """ read_result_pairs for results written in the binary format (no
+    tokenization, the ids are read from the memory mapped results)
+    """
+    reader = ResultsReader(results_dir(test_path))
+    special_words = np.array(word2numb.convert_w2n(['<pad>','<end>','<start>']))
+    records = reader.records
+    tx_sentences = _filter_special(np.asarray(reader.tx_tokens[:records['tx_len'].sum()]),records['tx_len'],special_words)
+    rx_sentences = _filter_special(np.asarray(reader.rx_tokens[:records['rx_len'].sum()]),records['rx_len'],special_words,
+                                   dedupe=True)
+
+    bin_counts = [0]*len(batch_limits)
+    do_not_fill = set([])
+    pairs = []
+    for tx_words,rx_words in zip(tx_sentences,rx_sentences):
+        idx =  bisect.bisect(batch_limits,len(tx_words))-1
+        if idx not in do_not_fill:
+            pairs.append((idx,tx_words,rx_words))
+            bin_counts[idx] += 1
+        if bin_counts[idx]>max_per_point:
+            do_not_fill.add(idx)
+        if len(do_not_fill) == len(batch_limits):
+            break
+    return pairs
+
+def _performance_metrics(performance,batch_size=1):
+    """ Per bin and total statistics of the word error rates of each bin"""
+    performance = [batch_performance(row,batch_size) for row in performance] #No effect for batch size == 1
+    perf_mean = [np.mean(row) for row in performance]
+    perf_std = [np.std(row) for row in performance]
+    bin_counts = [len(row) for row in performance] #Number of sentences in each bin
+    total_mean = np.sum([np.sum(row) for row in performance]) / np.sum(bin_counts)
+
+    if len(performance)==1: #It is not divided by batches
+        performance = performance[0]
+        perf_mean = perf_mean[0]
+        perf_std = perf_std[0]        
+
+    return {'performances': performance,
+            'means': perf_mean,
+            'std_devs': perf_std,
+            'bin_counts': bin_counts,
+            'total_mean': total_mean}
+
 def performance_test(test_path,word2numb,min_len=4,max_len=30,diff=2,
-                     max_per_point = 50000,batch_size=1,dist_type="ed_WuP"):
+                     max_per_point = 50000,batch_size=1,dist_type="ed_WuP",
+                     numb_workers=None,memo_path=None,chunk_size=500,synset_path=None,
+                     results_format='text'):
     """ Function computes the performance index for the files using the edit
-    distance or levenshtein metric for batches of different sentence lengths
+    distance or levenshtein metric for batches of different sentence lengths.
+    The sentence pairs are scored by a pool of processes.
     
     Args:
         test_path: path to the results tests path
@@ -169,65 +446,198 @@ def performance_test(test_path,word2numb,min_len=4,max_len=30,diff=2,
         dist_type: can be "ed_only" for edit distance or "ed_WuP" for
                    edit distance with discounted similarity measure.
                    Other types can be added in the future.
+        numb_workers: number of processes. None uses all cpus, 1 scores in
+                   this process
+        memo_path: pickle file of the Wu Palmer similarity memo, reused and
+                   extended across runs. None does not persist it
+        chunk_size: number of sentence pairs sent to a worker at a time
+        synset_path: table written by build_synset_table. None uses NLTK
+                   tagging and WordNet lookups for every new pair
+        results_format: 'text' reads the TX:/RX: lines of test_path, 'binary'
+                   reads the binary results folder of test_path
         
     Returns:
-        performance: performance at each point
-        perf_mean: mean 
-        perf_std: standard deviation
-        batch_limits: the limits of the batch
+        dictionary with performances (at each point), means, std_devs,
+        bin_counts and total_mean
     """
-    fop = open(test_path,'r',encoding='utf8')
     batch_limits = list(range(min_len,max_len,diff))
     print("Batch limits: ", batch_limits)
+    if results_format == 'binary':
+        pairs = read_result_pairs_binary(test_path,word2numb,batch_limits,max_per_point*batch_size)
+    else:
+        pairs = read_result_pairs(test_path,word2numb,batch_limits,max_per_point*batch_size)
+    chunks = [[(tx_words,rx_words) for _,tx_words,rx_words in pairs[start:start+chunk_size]]
+              for start in range(0,len(pairs),chunk_size)]
+
+    memo = SimilarityMemo(memo_path, SynsetTable(synset_path) if synset_path else None)
+    numb_workers = numb_workers or mp.cpu_count()
+    scores = []
+    if numb_workers == 1 or len(chunks) <= 1:
+        _init_eval_worker(word2numb,dist_type,None)
+        _eval_state['memo'] = memo
+        for chunk in tqdm(chunks,desc='scoring '):
+            chunk_scores,new_entries = _score_pairs(chunk)
+            scores.extend(chunk_scores)
+            memo.update(new_entries)
+    else:
+        with mp.Pool(numb_workers,initializer=_init_eval_worker,
+                     initargs=(word2numb,dist_type,memo_path,synset_path)) as pool:
+            for chunk_scores,new_entries in tqdm(pool.imap(_score_pairs,chunks),total=len(chunks),desc='scoring '):
+                scores.extend(chunk_scores)
+                memo.update(new_entries)
+    memo.save()
 
     performance = [[] for _ in range(len(batch_limits))]
     print("Perf length", len(performance))
-    do_not_fill=set([])
-    
+    for (idx,_,_),score in zip(pairs,scores):
+        performance[idx].append(score)
+
+    return _performance_metrics(performance,batch_size)
+
+def _iter_text_pairs(test_path,word2numb,follow=None,poll_interval=5.):
+    """ Iterates over the (tx_words, rx_words) pairs of a text results file
+    Args:
+        follow: None stops at the end of the file. Otherwise keeps waiting for
+                pairs still being written, and stops after follow seconds
+                without any. None is yielded whenever it is waiting
+        poll_interval: seconds between checks for new pairs
+    """
     special_words = word2numb.convert_w2n(['<pad>','<end>','<start>'])
-    
-    for line in tqdm(fop,total=20000):
-        tx_line = line[4:-7]
-        
-        try:
-            rx_line = fop.readline()[4:-7]
-            tx_words = simple_tokenizer(tx_line,word2numb,special_words)
-            rx_words = remove_duplicates(simple_tokenizer(rx_line,word2numb,special_words))
-        except:
-            break
-        
-        idx =  bisect.bisect(batch_limits,len(tx_words))-1
+    idle = 0.
+    with open(test_path,'r',encoding='utf8') as fop:
+        while True:
+            pos = fop.tell()
+            tx_line = fop.readline()
+            rx_line = fop.readline()
+            if follow is not None and not rx_line.endswith('\n'): #Pair not fully written yet
+                fop.seek(pos)
+                if idle >= follow:
+                    break
+                yield None
+                time.sleep(poll_interval)
+                idle += poll_interval
+                continue
+            if not tx_line:
+                break
+            idle = 0.
+            try:
+                tx_words = simple_tokenizer(tx_line[4:-7],word2numb,special_words)
+                rx_words = remove_duplicates(simple_tokenizer(rx_line[4:-7],word2numb,special_words))
+            except:
+                break
+            yield tx_words,rx_words
 
-        if idx not in do_not_fill:
-            performance[idx].append(calc_distance(tx_words,rx_words,word2numb, dist_type)/len(tx_words))
-        if len(performance[idx])>max_per_point*batch_size:
-            do_not_fill.add(idx)
-        if len(do_not_fill) == len(performance):
-#            print('Filled all slots')
+def _iter_binary_pairs(test_path,word2numb,follow=None,poll_interval=5.,block_size=10000):
+    """ _iter_text_pairs for results written in the binary format. Only
+    block_size pairs are read from the memory mapped files at a time
+    """
+    special_words = np.array(word2numb.convert_w2n(['<pad>','<end>','<start>']))
+    path = results_dir(test_path)
+    reader = None
+    start = 0
+    idle = 0.
+    while True:
+        if reader is not None:
+            reader.refresh()
+        elif os.path.exists(os.path.join(path,'records.bin')):
+            reader = ResultsReader(path)
+        stop = len(reader) if reader is not None else 0
+        if start < stop:
+            idle = 0.
+            for block_start in range(start,stop,block_size):
+                records = reader.records[block_start:min(block_start+block_size,stop)]
+                tx_off,rx_off = records['tx_off'][0],records['rx_off'][0]
+                tx_sentences = _filter_special(np.asarray(reader.tx_tokens[tx_off:tx_off+records['tx_len'].sum()]),
+                                               records['tx_len'],special_words)
+                rx_sentences = _filter_special(np.asarray(reader.rx_tokens[rx_off:rx_off+records['rx_len'].sum()]),
+                                               records['rx_len'],special_words,dedupe=True)
+                for tx_words,rx_words in zip(tx_sentences,rx_sentences):
+                    yield tx_words,rx_words
+            start = stop
+            continue
+        if follow is None or idle >= follow:
             break
-    
-    fop.close()
+        yield None
+        time.sleep(poll_interval)
+        idle += poll_interval
+
+def _score_chunk(stats,memo,chunk,chunk_idx):
+    """ Scores a chunk of pairs and adds the scores to the stats of their bins"""
+    scores,new_entries = _score_pairs(chunk)
+    memo.update(new_entries)
+    for idx,score in zip(chunk_idx,scores):
+        stats.add(idx,score)
+
+def _print_partial(metrics,numb_pairs):
+    print("{} pairs, total mean {:.4f}, bin counts {}".format(numb_pairs,metrics['total_mean'],metrics['bin_counts']))
+
+def streaming_performance_test(test_path,word2numb,min_len=4,max_len=30,diff=2,
+                               max_per_point = 50000,batch_size=1,dist_type="ed_WuP",
+                               memo_path=None,chunk_size=500,synset_path=None,
+                               results_format='text',reservoir_size=0,follow=None,
+                               poll_interval=5.,report_every=20):
+    """ performance_test in constant memory: the pairs are read and scored a
+    chunk at a time and only running statistics (and optionally a reservoir
+    sample of the performances) are kept for each length bin. With follow,
+    results still being written by a test run are evaluated as they come and
+    partial results are printed along the way.
 
-    performance = [batch_performance(row,batch_size) for row in performance] #No effect for batch size == 1
-    perf_mean = [np.mean(row) for row in performance]
-    perf_std = [np.std(row) for row in performance]
-    
-    if len(performance)==1: #It is not divided by batches
-        performance = performance[0]
-        perf_mean = perf_mean[0]
-        perf_std = perf_std[0]        
-    
-    bin_counts = [len(row) for row in performance] #Number of sentences in each bin
-    
-    total_mean = np.sum(np.sum(row) for row in performance) / np.sum(bin_counts)
+    Args:
+        test_path, min_len, max_len, diff, max_per_point, batch_size, dist_type,
+        memo_path, chunk_size, synset_path, results_format: as performance_test
+        reservoir_size: number of performances sampled for each bin. 0 keeps none
+        follow: None evaluates the pairs already written. Otherwise waits for new
+                pairs, and stops after follow seconds without any
+        poll_interval: seconds between checks for new pairs
+        report_every: number of scored chunks between partial reports
 
-    performance_metrics = {'performances': performance,
-                           'means': perf_mean,
-                           'std_devs': perf_std,
-                           'bin_counts': bin_counts,
-                           'total_mean': total_mean}
+    Returns:
+        dictionary with performances (reservoir samples, None if
+        reservoir_size is 0), means, std_devs, bin_counts and total_mean
+    """
+    batch_limits = list(range(min_len,max_len,diff))
+    print("Batch limits: ", batch_limits)
+    iter_pairs = _iter_binary_pairs if results_format == 'binary' else _iter_text_pairs
+
+    memo = SimilarityMemo(memo_path, SynsetTable(synset_path) if synset_path else None)
+    _init_eval_worker(word2numb,dist_type,None)
+    _eval_state['memo'] = memo
+    stats = BinnedStats(len(batch_limits),batch_size,reservoir_size)
+    max_per_bin = max_per_point*batch_size
+    bin_counts = [0]*len(batch_limits)
+    do_not_fill = set([])
+    chunk,chunk_idx = [],[]
+    numb_pairs,numb_chunks = 0,0
+
+    for pair in iter_pairs(test_path,word2numb,follow,poll_interval):
+        if pair is not None:
+            idx = bisect.bisect(batch_limits,len(pair[0]))-1
+            if idx in do_not_fill:
+                continue
+            chunk.append(pair)
+            chunk_idx.append(idx)
+            bin_counts[idx] += 1
+            if bin_counts[idx]>max_per_bin:
+                do_not_fill.add(idx)
+        #Scores full chunks, and whatever is left while waiting for the writer
+        if len(chunk) >= chunk_size or (pair is None and chunk):
+            _score_chunk(stats,memo,chunk,chunk_idx)
+            numb_pairs += len(chunk)
+            numb_chunks += 1
+            chunk,chunk_idx = [],[]
+            if numb_chunks % report_every == 0 or pair is None:
+                _print_partial(stats.metrics(),numb_pairs)
+                memo.save()
+        if len(do_not_fill) == len(batch_limits):
+            break
+    if chunk:
+        _score_chunk(stats,memo,chunk,chunk_idx)
+        numb_pairs += len(chunk)
+    memo.save()
 
-    return performance_metrics
+    metrics = stats.metrics()
+    _print_partial(metrics,numb_pairs)
+    return metrics
 
 def variation_exp(word2numb,bdr=0.95,bps=400,channel='erasure',var_bps_lin = 250,**kwargs):
     """ Returns performance of multiple files
@@ -309,26 +719,29 @@ def variation_test(word2numb,bdr=0.05,bps=400,max_per_point = 50,batch_size=32):
         if not os.path.exists(test_path):
             print('{} does not exist'.format(test_path))
             continue
+        #Uniform sample of the line pairs, the file is never held in memory.
+        #Only the sampled lines are tokenized
+        sample = Reservoir(max_per_point*batch_size)
         fop = open(test_path,'r',encoding='utf8')
-        perf_point = []
         for line in tqdm(fop,total=200000,desc='test_file '):
-            if np.random.rand()>(max_per_point*batch_size)/200000: #scrambling
-                fop.readline()
-                continue
-            
             tx_line = line[4:-1]
             rx_line = fop.readline()[4:-1]
             
-            try:
-                tx_words = simple_tokenizer(tx_line,word2numb,special_words)
-                rx_words = remove_duplicates(simple_tokenizer(rx_line,word2numb,special_words))
-            except:
+            #An RX line without words other than special ones ends the results
+            if all(word2numb.w2n.get(word,word2numb.UNK_ID) in special_words for word in rx_line.split(' ')):
                 break
             
-            perf_point.append(edeval(tx_words,rx_words)/len(tx_words))
+            sample.add((tx_line,rx_line))
         
         fop.close()
-        np.random.shuffle(perf_point)
+        if sample.samples:
+            tx_sentences = [simple_tokenizer(tx_line,word2numb,special_words) for tx_line,_ in sample.samples]
+            rx_sentences = [remove_duplicates(simple_tokenizer(rx_line,word2numb,special_words))
+                            for _,rx_line in sample.samples]
+            perf_point = list(sentences_edit_distance(tx_sentences,rx_sentences)/
+                              np.array([len(tx_words) for tx_words in tx_sentences]))
+        else:
+            perf_point = []
         perf_point = batch_performance(perf_point,batch_size)
         perf_mean_point = np.mean(perf_point) 
         perf_std_point = np.std(perf_point)
@@ -367,7 +780,25 @@ if __name__=="__main__":
 #    perf_all,perf_mean,perf_std = performance_test(test_path,w2numb,diff=10,max_per_point=50)
 
     #PERFORMANCE = WORD ERROR RATE
-    performance_metrics = performance_test(test_path, w2numb, dist_type = conf_args['edit_distance_type']) #returns a dict
+    memo_path = conf_args['wup_memo'] or os.path.join(parent_dir, 'data', conf_args['dataset'], 'wup_memo.pickle')
+    synset_path = None
+    if conf_args['edit_distance_type'] == 'ed_WuP':
+        synset_path = conf_args['synset_table'] or os.path.join(parent_dir, 'data', conf_args['dataset'], 'synsets_{}.pickle'.format(conf_args['dataset']))
+        if not os.path.exists(synset_path):
+            print("Building synset table: ", synset_path)
+            build_synset_table(w2numb, synset_path)
+    results_format = 'text' if conf_args['results_format'] == 'text' else 'binary'
+    if conf_args['stream_eval'] or conf_args['follow_results'] is not None:
+        performance_metrics = streaming_performance_test(test_path, w2numb, dist_type = conf_args['edit_distance_type'],
+                                                         memo_path = memo_path, synset_path = synset_path,
+                                                         results_format = results_format,
+                                                         reservoir_size = conf_args['reservoir_size'],
+                                                         follow = conf_args['follow_results'])
+    else:
+        performance_metrics = performance_test(test_path, w2numb, dist_type = conf_args['edit_distance_type'],
+                                               numb_workers = conf_args['eval_workers'], memo_path = memo_path,
+                                               synset_path = synset_path,
+                                               results_format = results_format) #returns a dict
     
     write_to_performance_file(performance_metrics, p_fpath, conf_args['chan_param'])
 
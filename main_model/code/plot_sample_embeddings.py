@@ -4,7 +4,7 @@ import tensorflow as tf
 import numpy as np
 from SentenceBatchGenerator import SentenceBatchGenerator, Word2Numb
 from EncDecChanModels import Config
-import nltk
+from tokenization import tokenize
 from SentenceEncChanDecNet import BeamSearchEncChanDecNet
 from sklearn import manifold
 import matplotlib.pyplot as plt
@@ -35,9 +35,8 @@ if __name__ == '__main__':
                        'Politicians have elected',
                        'the politicians have chosen']
     
-    word_token = nltk.tokenize.WordPunctTokenizer()
     def tokenizer(sentence):
-        words = word_token.tokenize(sentence)
+        words = tokenize(sentence)
         words = [w.lower() for w in words]
         tokens = word2numb.convert_w2n(words)
         return tokens
@@ -11,12 +11,13 @@ import os
 import tensorflow as tf
 import numpy as np
 from tqdm import tqdm
-import nltk
 import pickle
+import hashlib
 import random
-from collections import deque
-import bisect
+from collections import deque, Counter
 import itertools
+import multiprocessing as mp
+from tokenization import tokenize, lines_to_ids, count_tokens, count_per_line
 
 
 # Pre-initializing what the constants should be
@@ -25,6 +26,131 @@ END_ID = 1
 START_ID = 2
 UNK_ID = 3
 
+def line_offset(path, numb_lines, block_size=1<<24):
+    """ Byte offset of the end of the first numb_lines lines of a file (the
+    file size if it is shorter)
+    """
+    count = 0
+    pos = 0
+    with open(path,'rb') as fop:
+        while True:
+            block = fop.read(block_size)
+            if not block:
+                return pos
+            numb_newlines = block.count(b'\n')
+            if count + numb_newlines >= numb_lines:
+                idx = -1
+                for _ in range(numb_lines - count):
+                    idx = block.index(b'\n', idx+1)
+                return pos + idx + 1
+            count += numb_newlines
+            pos += len(block)
+
+def file_shards(path, numb_shards, end=None):
+    """ Splits the first end bytes of a file (all of it if None) into about
+    numb_shards byte ranges that start at the beginning of lines
+    Returns:
+        list of (start, end) offsets
+    """
+    size = os.path.getsize(path) if end is None else end
+    bounds = [0]
+    with open(path,'rb') as fop:
+        for ind in range(1,numb_shards):
+            fop.seek(max(size*ind//numb_shards - 1, bounds[-1]))
+            fop.readline()
+            pos = min(fop.tell(), size)
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def read_line_blocks(path, start, end, block_size=1<<24):
+    """ Reads the byte range [start, end) of a file (start and end at the
+    beginning of lines) as text blocks of whole lines of about block_size bytes
+    """
+    with open(path,'rb') as fop:
+        fop.seek(start)
+        pos = start
+        while pos < end:
+            block = fop.read(min(block_size, end-pos))
+            if pos + len(block) < end:
+                block += fop.readline()
+            if not block:
+                break
+            block = block[:end-pos]
+            pos += len(block)
+            yield block.decode('utf8')
+
+def read_line_range(path, start, end):
+    """ Lines (with their line breaks) of the byte range [start, end) of a
+    file, start and end at the beginning of lines
+    """
+    with open(path,'rb') as fop:
+        fop.seek(start)
+        pos = start
+        for line in fop:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('utf8')
+
+def _count_tokens(shard):
+    """ Lower cased token counts of a (path, start, end) shard of a corpus"""
+    path, start, end = shard
+    word_freq = Counter()
+    for block in read_line_blocks(path, start, end):
+        #Tokens never span lines, so a block is tokenized at once
+        word_freq.update(map(str.lower, tokenize(block)))
+    return word_freq
+
+def count_words(path_corpus, iter_limit=None, numb_workers=None):
+    """ Counts the (lower cased) tokens of the first iter_limit lines of a
+    corpus with a pool of processes, each counting byte range shards of the
+    file. The counts are merged in file order, so ties are ordered by first
+    appearance as with a single FreqDist
+    Returns:
+        Counter
+    """
+    numb_workers = numb_workers or mp.cpu_count()
+    end = line_offset(path_corpus, iter_limit) if iter_limit else None
+    shards = [(path_corpus, start, stop) for start, stop in file_shards(path_corpus, 4*numb_workers, end)]
+    word_freq = Counter()
+    if numb_workers == 1:
+        for shard in tqdm(shards, desc='counting '):
+            word_freq.update(_count_tokens(shard))
+        return word_freq
+    with mp.Pool(numb_workers) as pool:
+        for shard_freq in tqdm(pool.imap(_count_tokens, shards), total=len(shards), desc='counting '):
+            word_freq.update(shard_freq)
+    return word_freq
+
+def read_glove(path_embed, word2num, dim, block_lines=100000):
+    """ Reads the vectors of the words of word2num from a GloVe text file.
+    Only the lines of vocabulary words are parsed, a block of lines at a time
+    Returns:
+        float32 array [len(word2num), dim] (zero for words not in the file),
+        set of the ids of the words not in the file
+    """
+    embedding = np.zeros([len(word2num),dim],dtype=np.float32)
+    not_present_word = set(range(len(word2num)))
+    with open(path_embed,'r',encoding='utf8') as fop:
+        while True:
+            lines = list(itertools.islice(fop,block_lines))
+            if not lines:
+                break
+            ids, values = [], []
+            for line in lines:
+                split_line = line.split(None,1)
+                word = word2num.get(split_line[0],False) if split_line else False
+                if word:
+                    ids.append(word)
+                    values.append(split_line[1])
+            if ids:
+                embedding[ids,:] = np.fromstring(' '.join(values),dtype=np.float32,sep=' ').reshape([len(ids),dim])
+                not_present_word.difference_update(ids)
+    return embedding, not_present_word
+
 def word_dict_embed(vocab_size=50000, **kwargs):
     """This function creates the word2num, num2word and embeddings objects. It 
     first goes through the corpus to extract word counts. It then uses these and 
@@ -37,8 +163,10 @@ def word_dict_embed(vocab_size=50000, **kwargs):
         path_embed: path of the embeddings file. Default is constructed from dim
            size
         path_w2n_n2w: path to save the w2n_n2w file
-        path_word_embed: path to save the final word embeddings
+        path_word_embed: path to save the final (float32) word embeddings. A
+           .npy file (which can be memory mapped), else a pickle
         iter_limit: maximum number of lines to read in the corpus file.
+        numb_workers: number of processes counting the words. Default all cpus
     Returns:
         
     """
@@ -51,17 +179,11 @@ def word_dict_embed(vocab_size=50000, **kwargs):
     path_w2n_n2w = kwargs.get('path_w2n_n2w',
                               os.path.join(parent_dir, 'data', 'w2n_n2w_euro.pickle'))
     path_word_embed = kwargs.get('path_word_embed',
-                                 os.path.join(parent_dir, 'data', '%d_embed_euro.pickle'%dim))
+                                 os.path.join(parent_dir, 'data', '%d_embed_euro.npy'%dim))
     iter_limit = kwargs.get('iter_limit',10000000)
     #------- Extracting the most common words from the corpus-----------
-    word_token = nltk.tokenize.WordPunctTokenizer()
-    word_freq = nltk.FreqDist()
-    with open(path_corpus,'r',encoding='utf8') as fop:
-        print('Reading the corpus to extract word frequencies')
-        for line in tqdm(itertools.islice(fop,0,iter_limit)):
-            words = (w.lower() for w in 
-                     word_token.tokenize(line[:-1])) #Removing the newline, extract token, convert to lower case
-            word_freq.update(words)
+    print('Reading the corpus to extract word frequencies')
+    word_freq = count_words(path_corpus, iter_limit, kwargs.get('numb_workers'))
     
     #-------- using word frequencies to create word2num, num2word -------
     words_special = [('<pad>', PAD_ID), ('<end>', END_ID), ('<start>', START_ID), ('<unk>', UNK_ID)]
@@ -75,43 +197,269 @@ def word_dict_embed(vocab_size=50000, **kwargs):
     
     with open(path_w2n_n2w, 'wb') as fop:
         pickle.dump([word2num, num2word], fop)
+    Word2Numb(path_w2n_n2w).save(os.path.splitext(path_w2n_n2w)[0] + '.npz')
         
     #-------- Initializing word embeddings -------------------------------
-    embedding = np.zeros([len(word2num),dim])
-    not_present_word = set(range(len(word2num)))
-    with open(path_embed,'r',encoding='utf8') as fop:
-        print('Saving pre-trained embeddings')
-        for line in tqdm(fop):
-            split_line = line[:-1].split()
-            word = word2num.get(split_line[0],False)
-            if word:
-                not_present_word.discard(word)
-                embedding[word,:] = list(map(float, split_line[1:]))
-    
+    print('Saving pre-trained embeddings')
+    embedding, not_present_word = read_glove(path_embed, word2num, dim)
     embedding[list(not_present_word),:] = np.random.uniform(-0.7,0.7,[len(not_present_word),dim])
-    with open(path_word_embed, 'wb') as fop:
-        pickle.dump(embedding, fop)
+    if path_word_embed.endswith('.npy'):
+        np.save(path_word_embed, embedding)
+    else:
+        with open(path_word_embed, 'wb') as fop:
+            pickle.dump(embedding, fop)
         
     return word2num,num2word,embedding
 
 class Word2Numb(object):
+    """ Vocabulary stored as arrays: the word of each id, and the ids sorted by
+    word for (binary search) word to id lookups of whole arrays. The w2n and
+    n2w dictionaries are only built if they are used
+    """
     def __init__(self, w2n_path,vocab_size=None):
-        # ==== load num2word and word2num =======
-        with open(w2n_path, 'rb') as fop:
-            [w2n, n2w] = pickle.load(fop)
-        if vocab_size !=None and vocab_size<len(n2w):
-            self.n2w = dict((num,n2w[num]) for num in range(vocab_size))
-            self.w2n = dict((word,num) for num,word in self.n2w.items())
+        """
+        Args:
+            w2n_path: .npz file written by save, or pickle of [w2n, n2w]
+            vocab_size: keeps only the first vocab_size words
+        """
+        if w2n_path.endswith('.npz'):
+            with np.load(w2n_path) as arrays:
+                self.words, self.sorted_ids = arrays['words'], arrays['sorted_ids']
         else:
-            self.n2w, self.w2n = n2w,w2n
-        print('loaded dictionary of size ',len(self.w2n))
-        self.UNK_ID = self.w2n['<unk>']
+            # ==== load num2word and word2num =======
+            with open(w2n_path, 'rb') as fop:
+                [w2n, n2w] = pickle.load(fop)
+            self.words = np.array([n2w.get(num,"<>") for num in range(max(n2w)+1)])
+            self.sorted_ids = None
+        if vocab_size !=None and vocab_size<len(self.words):
+            self.words = self.words[:vocab_size]
+            self.sorted_ids = None
+        if self.sorted_ids is None:
+            self.sorted_ids = np.argsort(self.words, kind='stable')
+        self.sorted_words = self.words[self.sorted_ids]
+        self._w2n = None
+        self._n2w = None
+        self._digest = None
+        print('loaded dictionary of size ',len(self))
+        unk_id, found = self._lookup(['<unk>'])
+        if not found[0]:
+            raise KeyError('<unk>')
+        self.UNK_ID = int(unk_id[0])
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def w2n(self):
+        if self._w2n is None:
+            self._w2n = dict(zip(self.words.tolist(), range(len(self))))
+        return self._w2n
+
+    @property
+    def n2w(self):
+        if self._n2w is None:
+            self._n2w = dict(enumerate(self.words.tolist()))
+        return self._n2w
+
+    def digest(self):
+        """ Hash of the words of the vocabulary, in id order. Vocabularies of
+        the same size but different words (or ids) have different digests
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1('\n'.join(self.words.tolist()).encode('utf8')).hexdigest()
+        return self._digest
+
+    def save(self, path):
+        """ Saves the vocabulary as a .npz file that loads without any parsing"""
+        np.savez(path, words=self.words, sorted_ids=self.sorted_ids)
 
     def convert_w2n(self, sentence):
         return [self.w2n.get(x, self.UNK_ID) for x in sentence]
 
     def convert_n2w(self, numbs):
-        return [self.n2w.get(x, "<>") for x in numbs]
+        return self.convert_n2w_batch(numbs).tolist()
+
+    def _lookup(self, words):
+        """ Binary search of an array of words
+        Returns:
+            candidate ids, whether each word was found
+        """
+        words = np.asarray(words, dtype=self.words.dtype.kind)
+        pos = np.minimum(np.searchsorted(self.sorted_words, words), len(self)-1)
+        return self.sorted_ids[pos], self.sorted_words[pos] == words
+
+    def convert_w2n_batch(self, words):
+        """ Ids of an array (of any shape) of words, UNK_ID for unknown words"""
+        ids, found = self._lookup(words)
+        return np.where(found, ids, self.UNK_ID)
+
+    def convert_n2w_batch(self, numbs):
+        """ Words of an array (of any shape) of ids, "<>" for unknown ids"""
+        numbs = np.asarray(numbs, dtype=np.int64)
+        valid = (numbs >= 0) & (numbs < len(self))
+        return np.where(valid, self.words[np.where(valid, numbs, 0)], "<>")
+
+def compile_corpus(corp_path, word2numb, cache_path=None, iter_limit=None, block_lines=100000):
+    """ Tokenizes the corpus once and stores the token ids as a flat binary
+    array along with an offsets index. Each line of the corpus is one sentence.
+    The files written are
+        cache_path.tok - token ids (uint16 if the vocabulary allows, else int32)
+        cache_path.off - int64 offsets of each sentence, numb_sentences+1 long
+        cache_path.unk - number of unknown words in each sentence
+        cache_path.meta.pickle - dtype, sizes and the corpus/vocabulary it was built from
+
+    Args:
+        corp_path: path of the text corpus
+        word2numb: word2numb object
+        cache_path: prefix of the compiled files. Default corp_path + '.compiled'
+        iter_limit: maximum number of lines to read in the corpus file.
+        block_lines: number of lines tokenized at once
+    Returns:
+        cache_path
+    """
+    cache_path = cache_path or corp_path + '.compiled'
+    vocab_size = len(word2numb)
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+    unk_id = word2numb.UNK_ID
+    lengths = [np.zeros([0],dtype=np.int64)]
+    unk_counts = [np.zeros([0],dtype=np.int64)]
+    with open(corp_path,'r',encoding='utf8') as fop, open(cache_path + '.tok','wb') as ftok, tqdm() as pbar:
+        print('Compiling the corpus to ', cache_path)
+        lines = itertools.islice(fop,0,iter_limit)
+        #Blocks of lines are tokenized at once and written as they are read
+        for block in iter(lambda: [line.lower()[:-1] for line in itertools.islice(lines,block_lines)], []):
+            words_nums,block_offsets = lines_to_ids(block,word2numb,dtype=np.int64)
+            words_nums.astype(dtype).tofile(ftok)
+            lengths.append(np.diff(block_offsets))
+            unk_counts.append(count_per_line(words_nums==unk_id,block_offsets))
+            pbar.update(len(block))
+    lengths = np.concatenate(lengths)
+    unk_counts = np.concatenate(unk_counts)
+
+    offsets = np.zeros(len(lengths)+1,dtype=np.int64)
+    np.cumsum(lengths,out=offsets[1:])
+    offsets.tofile(cache_path + '.off')
+    np.minimum(unk_counts,np.iinfo(np.uint16).max).astype(np.uint16).tofile(cache_path + '.unk')
+
+    meta = {'dtype': np.dtype(dtype).str,
+            'numb_sentences': len(lengths),
+            'numb_tokens': int(offsets[-1]),
+            'vocab_size': vocab_size,
+            'vocab_digest': word2numb.digest(),
+            'corp_path': os.path.abspath(corp_path),
+            'corp_mtime': os.path.getmtime(corp_path),
+            'iter_limit': iter_limit}
+    with open(cache_path + '.meta.pickle','wb') as fop:
+        pickle.dump(meta, fop)
+    return cache_path
+
+def compiled_corpus_valid(corp_path, word2numb, cache_path=None, iter_limit=None):
+    """ Checks that a compiled corpus exists and was built from the current
+    version of the corpus, with the same vocabulary (same words and ids) and
+    the same iter_limit"""
+    cache_path = cache_path or corp_path + '.compiled'
+    if not all(os.path.exists(cache_path + ext) for ext in ['.tok','.off','.unk','.meta.pickle']):
+        return False
+    with open(cache_path + '.meta.pickle','rb') as fop:
+        meta = pickle.load(fop)
+    return (meta['vocab_size'] == len(word2numb) and
+            meta.get('vocab_digest') == word2numb.digest() and
+            meta['iter_limit'] == iter_limit and
+            meta['corp_mtime'] == os.path.getmtime(corp_path))
+
+def load_compiled_corpus(cache_path):
+    """ Memory maps a compiled corpus
+    Returns:
+        tokens: flat array of token ids
+        offsets: sentence i is tokens[offsets[i]:offsets[i+1]]
+        unk_counts: number of unknown words in each sentence
+        meta: the metadata dictionary
+    """
+    with open(cache_path + '.meta.pickle','rb') as fop:
+        meta = pickle.load(fop)
+    numb_sentences = meta['numb_sentences']
+    if meta['numb_tokens'] > 0:
+        tokens = np.memmap(cache_path + '.tok',dtype=np.dtype(meta['dtype']),mode='r',
+                           shape=(meta['numb_tokens'],))
+    else: #np.memmap cannot map empty files
+        tokens = np.zeros([0],dtype=np.dtype(meta['dtype']))
+    offsets = np.fromfile(cache_path + '.off',dtype=np.int64,count=numb_sentences+1)
+    unk_counts = np.fromfile(cache_path + '.unk',dtype=np.uint16,count=numb_sentences)
+    return tokens, offsets, unk_counts, meta
+
+def flatten_batch(batch):
+    """ Converts a batch of sentences (lists or arrays of word ids) into a flat
+    token buffer and an offsets index without copying each sentence
+    Returns:
+        tokens: int32 array of all the ids in the batch
+        offsets: sentence i is tokens[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.zeros(len(batch)+1,dtype=np.int64)
+    np.cumsum(np.fromiter((len(seq) for seq in batch),dtype=np.int64,count=len(batch)),
+              out=offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(batch),dtype=np.int32,count=offsets[-1])
+    return tokens, offsets
+
+def pad_flat(tokens, offsets, width=None, pad_id=PAD_ID, dtype=np.int32):
+    """ Creates a padded [batch, width] matrix from a flat token buffer
+    Args:
+        tokens, offsets: as returned by flatten_batch
+        width: width of the matrix. Default is the maximum sentence length
+        pad_id: the padding value
+    Returns:
+        padded: the padded matrix
+        lengths: length of each sentence
+    """
+    lengths = np.diff(offsets)
+    if width is None:
+        width = int(lengths.max()) if len(lengths) else 0
+    padded = np.full([len(lengths),width],pad_id,dtype=dtype)
+    padded[np.arange(width)<lengths[:,None]] = tokens
+    return padded, lengths
+
+def build_feed_buffer(tokens, offsets, eos_id=END_ID, sos_id=START_ID, pad_id=PAD_ID):
+    """ Builds the padded buffer SOS + sentence + EOS + 3 PAD of a batch in one
+    vectorized pass. split_feed_buffer gives the network inputs as views of it
+    Args:
+        tokens, offsets: as returned by flatten_batch
+    Returns:
+        buffer: int32 [batch, max_len+5]
+        lengths: length of each sentence
+    """
+    lengths = np.diff(offsets)
+    batch_size = len(lengths)
+    max_len = int(lengths.max())
+    buffer = np.full([batch_size,max_len+5],pad_id,dtype=np.int32)
+    buffer[:,0] = sos_id
+    buffer[:,1:][np.arange(max_len+4)<lengths[:,None]] = tokens
+    buffer[np.arange(batch_size),lengths+1] = eos_id
+    return buffer, lengths
+
+def split_feed_buffer(buffer, lengths):
+    """ Splits a buffer from build_feed_buffer into
+        encoder inputs: sentence + EOS
+        decoder targets: sentence + EOS + 3 PAD
+        decoder inputs: SOS + sentence + EOS + 2 PAD
+    Returns:
+        enc_inputs, enc_inputs_len, dec_targets, dec_inputs
+    """
+    width = buffer.shape[1]
+    enc_inputs = buffer[:,1:width-3]
+    enc_inputs_len = (np.asarray(lengths)+1).astype(np.int32)
+    dec_targets = buffer[:,1:]
+    dec_inputs = buffer[:,:width-1]
+    return enc_inputs, enc_inputs_len, dec_targets, dec_inputs
+
+def build_feed_arrays(tokens, offsets, eos_id=END_ID, sos_id=START_ID, pad_id=PAD_ID):
+    """ Builds the encoder inputs, decoder targets and decoder inputs of a batch
+    in one pass. All three are views of a single padded buffer
+    Args:
+        tokens, offsets: as returned by flatten_batch
+    Returns:
+        enc_inputs, enc_inputs_len, dec_targets, dec_inputs
+    """
+    buffer, lengths = build_feed_buffer(tokens, offsets, eos_id=eos_id, sos_id=sos_id, pad_id=pad_id)
+    return split_feed_buffer(buffer, lengths)
 
 class SentenceBatchGenerator (object):
     def __init__(self, corp_path,
@@ -128,21 +476,25 @@ class SentenceBatchGenerator (object):
             diff: the difference between sentence length in each batch
             epochs: the number of epochs
             unk_perc: the unknown word percentage
+            shard: (index, numb_shards). Only the index-th of numb_shards byte
+                ranges of the corpus (see file_shards) is read, so a shard
+                reads its part of the file only. Default (0,1) reads everything
         """
 
         self.corp_path = corp_path
         self.word2numb = word2numb
+        self.init_kwargs = dict(kwargs)
+        self.shard = kwargs.get('shard',(0,1))
         self.batch_size = kwargs.get('batch_size',32)
-        self.UNK_ID = kwargs.get('UNK_ID',word2numb.w2n['<unk>'])
+        self.UNK_ID = kwargs.get('UNK_ID',word2numb.UNK_ID)
         self.unk_perc = kwargs.get('unk_perc',0.2)
         self.epochs = kwargs.get('epochs',1)
         self.curr_epoch = 0
-        self.file_pointer = open(corp_path,'r',encoding='utf8')
+        self._open_corpus()
         self.min_len = kwargs.get('min_len',4)
         self.max_len = kwargs.get('max_len',30)
         diff = kwargs.get('diff',4)
         self.init_batch_queues(self.min_len,self.max_len,diff)
-        self._word_tokenizer = nltk.tokenize.WordPunctTokenizer()
         self.do_not_fill = set([]) #List of elements of the queue to not fill anymore
 
     def init_batch_queues(self,min_len,max_len,diff):
@@ -151,15 +503,44 @@ class SentenceBatchGenerator (object):
         self.numb_queues = len(self.queue_limits)-1
         self.batch_queues = [deque() for _ in self.queue_limits[:-1]]
 
+    def _open_corpus(self):
+        """ Opens (or re-opens) the corpus from the first sentence of the shard"""
+        shard_index, numb_shards = self.shard
+        if numb_shards > 1:
+            shards = file_shards(self.corp_path,numb_shards)
+            start,end = shards[shard_index] if shard_index < len(shards) else (0,0) #Tiny files have fewer shards
+            self.file_pointer = read_line_range(self.corp_path,start,end)
+        else:
+            self.file_pointer = open(self.corp_path,'r',encoding='utf8')
+
     def prepare_batch_queues(self,**kwargs):
         """ Function does a hard reset of the file pointer"""
-        self.file_pointer = open(self.corp_path,'r',encoding='utf8')
+        self._open_corpus()
         
     def update_do_not_fill(self,index):
         """ Add index to the list of elements of do_not_fill
         """
         self.do_not_fill.add(index)
         
+    def read_filtered_lines(self, num_lines_read=100):
+        """ Reads num_lines_read lines, tokenizes them as one block and yields
+        the ones that pass the length and unknown word filters
+
+        Returns:
+            generator of (queue index, sentence, word ids array)
+        """
+        sentences = [sentence.lower()[:-1] for sentence in itertools.islice(self.file_pointer,num_lines_read)]
+        if not sentences:
+            raise ValueError('file pointer has reached the end')
+        ids,offsets = lines_to_ids(sentences,self.word2numb)
+        lengths = np.diff(offsets)
+        unk_counts = count_per_line(ids==self.UNK_ID,offsets)
+        keep = ((lengths>=self.min_len) & (lengths<=self.max_len) &
+                (unk_counts/np.maximum(lengths,1) <= self.unk_perc))
+        queue_ids = np.minimum(np.searchsorted(self.queue_limits,lengths,side='right')-1,self.numb_queues-1)
+        for ind in np.flatnonzero(keep):
+            yield int(queue_ids[ind]), sentences[ind], ids[offsets[ind]:offsets[ind+1]]
+
     def fill_batch_queues(self, num_lines_read=100, randomize=True):
         """ This function reads in num_lines_read number of lines. 
         It then converts it numbers, does filtering and places it in the appropriate batch
@@ -168,27 +549,12 @@ class SentenceBatchGenerator (object):
             num_lines_read: number of lines to read at once
             randomize: whether to randomize read lines
         """
-        sentence = None
-        for sentence in itertools.islice(self.file_pointer,num_lines_read):
-            sentence = sentence.lower()[:-1]
-            words = self._word_tokenizer.tokenize(sentence)
-            if len(words)<self.min_len or len(words)>self.max_len:
-                continue
-            words_nums = self.word2numb.convert_w2n(words)
-            if sum([w==self.UNK_ID for w in words_nums])/len(words) > self.unk_perc:
-                continue
-            idx =  bisect.bisect(self.queue_limits,len(words))-1
-            if idx==self.numb_queues:
-                idx = self.numb_queues-1
+        for idx,sentence,words_nums in self.read_filtered_lines(num_lines_read):
             if idx not in self.do_not_fill:
-                self.batch_queues[idx].appendleft(words_nums)
+                self.batch_queues[idx].appendleft(words_nums.tolist())
             if len(self.do_not_fill) == self.numb_queues:
                 raise ValueError('no more queues can serve')
         
-        if sentence is None:
-            raise ValueError('file pointer has reached the end')
-            
-        
     def can_serve(self):
         """ Returns the id of the queue which is in a position to serve"""
         idxes = list(filter(
@@ -215,7 +581,7 @@ class SentenceBatchGenerator (object):
                 print('File Pointer has reached the end')
                 self.curr_epoch = self.curr_epoch+1
                 if self.curr_epoch<self.epochs:
-                    self.file_pointer = open(self.corp_path,'r',encoding='utf8')
+                    self._open_corpus()
                 else:
                     return None
             id_can_serve = self.can_serve()
@@ -229,46 +595,65 @@ class RawSentenceBatchGenerator(SentenceBatchGenerator):
         super().__init__(corp_path,word2numb,**kwargs)
         
     def fill_batch_queues(self,num_lines_read=100,randomize=True):
-        sentence = None
-        for sentence in itertools.islice(self.file_pointer,num_lines_read):
-            sentence = sentence.lower()[:-1]
-            words = self._word_tokenizer.tokenize(sentence)
-            if len(words)<self.min_len or len(words)>self.max_len:
-                continue
-            words_nums = self.word2numb.convert_w2n(words)
-            if sum([w==self.UNK_ID for w in words_nums])/len(words) > self.unk_perc:
-                continue
-            idx =  bisect.bisect(self.queue_limits,len(words))-1
-            if idx==self.numb_queues:
-                idx = self.numb_queues-1
+        for idx,sentence,words_nums in self.read_filtered_lines(num_lines_read):
             if idx not in self.do_not_fill:
                 self.batch_queues[idx].appendleft(sentence)
             if len(self.do_not_fill) == self.numb_queues:
                 raise ValueError('no more queues can serve')
-        if sentence is None:
-            raise ValueError('file pointer has reached the end')
             
 class RawSentenceBatchGeneratorLength(RawSentenceBatchGenerator):
     def fill_batch_queues(self,num_lines_read=100,randomize=True):
-        sentence = None
-        for sentence in itertools.islice(self.file_pointer,num_lines_read):
-            sentence = sentence.lower()[:-1]
-            words = self._word_tokenizer.tokenize(sentence)
-            if len(words)<self.min_len or len(words)>self.max_len:
-                continue
-            words_nums = self.word2numb.convert_w2n(words)
-            if sum([w==self.UNK_ID for w in words_nums])/len(words) > self.unk_perc:
-                continue
-            idx =  bisect.bisect(self.queue_limits,len(words))-1
-            if idx==self.numb_queues:
-                idx = self.numb_queues-1
+        for idx,sentence,words_nums in self.read_filtered_lines(num_lines_read):
             if idx not in self.do_not_fill:
-                self.batch_queues[idx].appendleft([sentence,len(words_nums)])  
+                self.batch_queues[idx].appendleft([sentence,len(words_nums)])
             if len(self.do_not_fill) == self.numb_queues:
                 raise ValueError('no more queues can serve')
-        if sentence is None:
+
+class CompiledSentenceBatchGenerator(SentenceBatchGenerator):
+    """ Serves the same batches as SentenceBatchGenerator but reads the token
+    ids from a corpus compiled with compile_corpus instead of tokenizing every
+    line. The corpus is compiled on first use. The length and unknown word
+    filters are precomputed as a mask over all the sentences.
+
+    Extra kwargs:
+        cache_path: prefix of the compiled corpus. Default corp_path + '.compiled'
+    A shard (index, numb_shards) serves the index-th of numb_shards contiguous
+    ranges of sentences.
+    """
+    def __init__(self,corp_path,word2numb,**kwargs):
+        self.cache_path = kwargs.get('cache_path',corp_path + '.compiled')
+        if not compiled_corpus_valid(corp_path,word2numb,self.cache_path):
+            compile_corpus(corp_path,word2numb,self.cache_path)
+        self.tokens,self.offsets,self.unk_counts,_ = load_compiled_corpus(self.cache_path)
+        self.numb_sentences = len(self.offsets)-1
+        shard_index, numb_shards = kwargs.get('shard',(0,1))
+        self.shard_start = shard_index*self.numb_sentences//numb_shards
+        self.shard_end = (shard_index+1)*self.numb_sentences//numb_shards
+        super().__init__(corp_path,word2numb,**kwargs)
+
+        lengths = np.diff(self.offsets)
+        self.keep_mask = ((lengths>=self.min_len) & (lengths<=self.max_len) &
+                          (self.unk_counts/np.maximum(lengths,1) <= self.unk_perc))
+        queue_ids = np.searchsorted(self.queue_limits,lengths,side='right')-1
+        self.queue_ids = np.clip(queue_ids,0,self.numb_queues-1)
+
+    def _open_corpus(self):
+        """ Moves the read position back to the first sentence of the shard"""
+        self.cursor = self.shard_start
+
+    def fill_batch_queues(self, num_lines_read=100, randomize=True):
+        if self.cursor >= self.shard_end:
             raise ValueError('file pointer has reached the end')
-            
+        end = min(self.cursor + num_lines_read, self.shard_end)
+        for ind in np.flatnonzero(self.keep_mask[self.cursor:end]) + self.cursor:
+            idx = int(self.queue_ids[ind])
+            if idx not in self.do_not_fill:
+                self.batch_queues[idx].appendleft(
+                        self.tokens[self.offsets[ind]:self.offsets[ind+1]].tolist())
+            if len(self.do_not_fill) == self.numb_queues:
+                raise ValueError('no more queues can serve')
+        self.cursor = end
+
 def test_batch_gen():
     parent_dir = os.path.split(os.getcwd())[0]
     path_w2n_n2w = os.path.join(parent_dir, 'data', 'w2n_n2w_euro.pickle')
@@ -282,49 +667,135 @@ def test_w2n():
     parent_dir = os.path.split(os.getcwd())[0]
     path_corpus = os.path.join(parent_dir, 'data', 'corpora','news.2014.en.shuffled.v2' )
     path_w2n_n2w = os.path.join(parent_dir, 'data', 'w2n_n2w_news.pickle')
-    path_word_embed = os.path.join(parent_dir, 'data', '%d_embed_news.pickle'%dim)
+    path_word_embed = os.path.join(parent_dir, 'data', '%d_embed_news.npy'%dim)
     w2n,n2w,e=word_dict_embed(80000,dim=200,path_corpus=path_corpus,path_w2n_n2w=path_w2n_n2w,path_word_embed=path_word_embed)
 
-def line_count_stats(pathname,limit=int(1e6),length_from=4,length_to=30,bin_len=4,*kwargs):
+def _add_counts(counts, other):
+    """ Sum of two histograms of possibly different lengths"""
+    if len(other) > len(counts):
+        counts, other = other, counts
+    counts = counts.copy()
+    counts[:len(other)] += other
+    return counts
+
+def _count_lengths(shard):
+    """ Histogram of the number of tokens of the lines of a (path, start, end)
+    shard of a corpus"""
+    path, start, end = shard
+    counts = np.zeros([1],dtype=np.int64)
+    for block in read_line_blocks(path, start, end):
+        lines = block.lower().split('\n')
+        if lines[-1] == '': #Blocks end with a line break except at the end of a file without one
+            lines.pop()
+        counts = _add_counts(counts, np.bincount(count_tokens(lines)))
+    return counts
+
+def length_histogram(pathname, limit=None, numb_workers=None, index_path=None):
+    """ Histogram of the sentence lengths (number of tokens of each line) of
+    the first limit lines of a corpus. It is built in one pass by a pool of
+    processes over byte range shards of the file and stored next to the corpus,
+    so it is only rebuilt when the corpus changes
+    If the corpus is missing, a stored histogram is used as it is. If the
+    histogram cannot be stored (read-only folder) it is only returned
+    Args:
+        pathname: path of the text corpus
+        limit: maximum number of lines read. None reads all of them
+        numb_workers: number of processes. Defaults to all cpus
+        index_path: file of the histogram. Default pathname + '.lengths.pickle'
+    Returns:
+        array whose element i is the number of lines of length i
+    """
+    index_path = index_path or pathname + '.lengths.pickle'
+    if os.path.exists(index_path):
+        with open(index_path,'rb') as fop:
+            index = pickle.load(fop)
+        if index['limit'] == limit and (not os.path.exists(pathname) or
+                                        index['corp_mtime'] == os.path.getmtime(pathname)):
+            return index['counts']
+    if not os.path.exists(pathname):
+        raise FileNotFoundError(pathname)
+
+    numb_workers = numb_workers or mp.cpu_count()
+    end = line_offset(pathname, limit) if limit else None
+    shards = [(pathname, start, stop) for start, stop in file_shards(pathname, 4*numb_workers, end)]
+    counts = np.zeros([1],dtype=np.int64)
+    if numb_workers == 1:
+        for shard in tqdm(shards, desc='lengths '):
+            counts = _add_counts(counts, _count_lengths(shard))
+    else:
+        with mp.Pool(numb_workers) as pool:
+            for shard_counts in tqdm(pool.imap_unordered(_count_lengths, shards), total=len(shards), desc='lengths '):
+                counts = _add_counts(counts, shard_counts)
+
+    index = {'counts': counts,
+             'corp_path': os.path.abspath(pathname),
+             'corp_mtime': os.path.getmtime(pathname),
+             'limit': limit}
+    try:
+        with open(index_path,'wb') as fop:
+            pickle.dump(index,fop)
+    except OSError as err:
+        print('Length histogram not stored: ', err)
+    return counts
+
+def bin_frequencies(counts, length_from=4, length_to=30, bin_len=4):
+    """ Relative frequency of each length bin of a length histogram. The bins
+    start at range(length_from,length_to,bin_len) and the last one ends at
+    length_to (included), as the queues of SentenceBatchGenerator
+    """
+    limits = list(range(length_from,length_to,bin_len)) + [length_to+1]
+    counts = np.pad(counts,(0,max(length_to+1-len(counts),0)))
+    bin_counts = np.array([counts[low:high].sum() for low,high in zip(limits[:-1],limits[1:])])
+    return (bin_counts/bin_counts.sum()).tolist()
+
+def line_count_stats(pathname,limit=int(1e6),length_from=4,length_to=30,bin_len=4,**kwargs):
     """ Returns the relative frequency of the batches of different lengths for 
     computation of number of bits to allow per batch
     """
-    freq = {}
-    word_token = nltk.tokenize.WordPunctTokenizer()
-    with open(pathname,'r',encoding='utf8') as fop:
-        for line in tqdm(itertools.islice(fop,limit)):
-            num_words = len(word_token.tokenize(line))
-            freq[num_words] = freq.get(num_words,0)+1
-    
-    freq_rel = [freq[_] for _ in range(4,31)]
-    freq_rel_bat = [sum(x) for x in itertools.zip_longest(*([iter(freq_rel)]*4),fillvalue = 0)]
-    freq_rel_bat_norm = [x/sum(freq_rel_bat) for x in freq_rel_bat]
-    return freq_rel_bat_norm
+    counts = length_histogram(pathname,limit,numb_workers=kwargs.get('numb_workers'))
+    return bin_frequencies(counts,length_from,length_to,bin_len)
+
+# Corpora the bit allocation of each dataset is computed on, and the stored
+# 4-30-4 bin frequencies used when they are not available
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data'))
+LINE_STATS_CORPORA = {'wiki': os.path.join(DATA_DIR,'wiki','wiki_test.dat'),
+                      'euro': os.path.join(DATA_DIR,'corpora','europarl-v7.en','europarl-v7.en'),
+                      'news': os.path.join(DATA_DIR,'corpora','news','news.2016.en.shuffled')}
+CORP_FREQ_PATH = os.path.join(DATA_DIR,'corp_freq.pickle')
 
 def create_line_stats():
-    """ Creates and stores line stats
+    """ Creates the length histograms of the line stats corpora and stores
+    their 4-30-4 bin frequencies
     """
     freq= {}
-    freq['wiki'] = line_count_stats('../data/wiki/wiki_test.dat')
-    freq['euro'] = line_count_stats('../data/corpora/europarl-v7.en/europarl-v7.en')
-    freq['news'] = line_count_stats('../data/corpora/news/news.2016.en.shuffled')
-    pickle.dump(freq,open('../data/corp_freq.pickle','wb'))
+    for dataset,pathname in LINE_STATS_CORPORA.items():
+        freq[dataset] = line_count_stats(pathname)
+    pickle.dump(freq,open(CORP_FREQ_PATH,'wb'))
+    return freq
     
 def bin_batch_create(numb_tx_bits,dataset='euro',type_bit_bin = 'const',low_lim=None,**kwargs):
-    """ Creates bits per bin for std 4-4-30 line length config from dataset
+    """ Creates bits per bin for a line length config from the length histogram
+    of the dataset corpus
     Args:
         numb_tx_bits - number of transmission bits
         dataset - which dataset. Can be euro, wiki, or news
         type_bit_bin - can be const, linear, or sqrt
         low_lim - how many bits for the small sentences batch
+        length_from, length_to, bin_len - line length config. Default 4-30 by 4
+        corp_path - corpus of the length histogram. Defaults to LINE_STATS_CORPORA[dataset].
+            Without the corpus (or its histogram) the frequencies of corp_freq.pickle
+            are used, which are only for the 4-30-4 config
+        limit - number of lines of the corpus used. Default 1e6
         
     Returns:
         bits per bin
     """
     if low_lim == None:
         low_lim = round(0.6*numb_tx_bits)
-    freq = pickle.load(open('../data/corp_freq.pickle','rb'))
-    len_bats = len(freq[dataset])
+    length_from = kwargs.get('length_from',4)
+    length_to = kwargs.get('length_to',30)
+    bin_len = kwargs.get('bin_len',4)
+    len_bats = len(range(length_from,length_to,bin_len))
     if type_bit_bin == 'const':
         return [numb_tx_bits]*len_bats
     elif type_bit_bin == 'linear':
@@ -332,7 +803,15 @@ def bin_batch_create(numb_tx_bits,dataset='euro',type_bit_bin = 'const',low_lim=
     elif type_bit_bin == 'sqrt':
         func_i = [np.sqrt(i) for i in range(len_bats)]
     
-    step = (numb_tx_bits-low_lim)/sum(freq[dataset][i]*func_i[i] for i in range(len_bats))
+    corp_path = kwargs.get('corp_path') or LINE_STATS_CORPORA[dataset]
+    try:
+        freq = line_count_stats(corp_path,kwargs.get('limit',int(1e6)),length_from,length_to,bin_len)
+    except FileNotFoundError:
+        if (length_from,length_to,bin_len) != (4,30,4):
+            raise ValueError('No corpus or length histogram at {} for the {}-{}-{} config'.format(
+                corp_path,length_from,length_to,bin_len))
+        freq = pickle.load(open(CORP_FREQ_PATH,'rb'))[dataset]
+    step = (numb_tx_bits-low_lim)/sum(freq[i]*func_i[i] for i in range(len_bats))
     bits_per_bin = [round(low_lim + step*func_i[i]) for i in range(len_bats)]
     return bits_per_bin
    
@@ -341,7 +820,7 @@ if __name__ == "__main__":
     parent_dir = os.path.split(os.getcwd())[0]
     path_w2n_n2w = os.path.join(parent_dir, 'data', 'wikipedia','w2n_n2w_wiki.pickle')
     path_corpus = os.path.join(parent_dir, 'data', 'corpora', 'wikipedia', 'wikipedia_train.dat')
-    path_word_embed = os.path.join(parent_dir,'data','wikipedia','200_embed_wiki.pickle')
+    path_word_embed = os.path.join(parent_dir,'data','wikipedia','200_embed_wiki.npy')
     w2n,n2w,e=word_dict_embed(100000,dim=200,path_corpus=path_corpus,path_w2n_n2w=path_w2n_n2w,path_word_embed=path_word_embed)
 
 #    w2numb = Word2Numb(path_w2n_n2w)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Columnar binary format of the test results. A results folder holds
+    tx_tokens.bin - int32 ids of all the transmitted sentences, back to back
+    rx_tokens.bin - int32 ids of all the decoded sentences
+    records.bin - one RECORD_DTYPE record per sentence pair with the offsets
+        and lengths of its tokens, the batch id, the channel parameter and
+        the log probability of the decoded sentence (nan if there is none)
+All files are append-only, so they can be read (memory mapped) while a test
+is still writing them.
+========================================================================"""
+import os
+import numpy as np
+
+RECORD_DTYPE = np.dtype([('tx_off', np.int64), ('tx_len', np.int32),
+                         ('rx_off', np.int64), ('rx_len', np.int32),
+                         ('batch_id', np.int32), ('chan_param', np.float32),
+                         ('log_prob', np.float32)])
+
+
+def results_dir(test_results_path):
+    """ Folder of the binary results that go with a text results path"""
+    return test_results_path + '.results'
+
+
+def trim_at_eos(rows, eos_id):
+    """ Cuts each row of a padded prediction matrix after its first EOS"""
+    rows = np.asarray(rows)
+    has_eos = rows == eos_id
+    lengths = np.where(has_eos.any(axis=1), has_eos.argmax(axis=1) + 1, rows.shape[1])
+    return [row[:length] for row, length in zip(rows, lengths)]
+
+
+class ResultsWriter(object):
+    """ Appends sentence pairs to a results folder
+    """
+    def __init__(self, path, append=False):
+        """
+        Args:
+            path: the results folder
+            append: add to existing results instead of starting over
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        mode = 'ab' if append else 'wb'
+        self.tx_file = open(os.path.join(path, 'tx_tokens.bin'), mode)
+        self.rx_file = open(os.path.join(path, 'rx_tokens.bin'), mode)
+        self.rec_file = open(os.path.join(path, 'records.bin'), mode)
+        self.tx_off = self.tx_file.tell() // 4
+        self.rx_off = self.rx_file.tell() // 4
+
+    def write_batch(self, tx_sentences, rx_sentences, batch_id, chan_param, log_probs=None):
+        """ Writes a batch of sentence pairs
+        Args:
+            tx_sentences: list of transmitted sentences (lists or arrays of ids)
+            rx_sentences: list of decoded sentences
+            batch_id: batch id of the batch
+            chan_param: channel parameter
+            log_probs: log probability of each decoded sentence, if any
+        """
+        tx_lens = np.array([len(sentence) for sentence in tx_sentences], dtype=np.int64)
+        rx_lens = np.array([len(sentence) for sentence in rx_sentences], dtype=np.int64)
+        records = np.zeros([len(tx_lens)], dtype=RECORD_DTYPE)
+        records['tx_off'] = self.tx_off + np.cumsum(tx_lens) - tx_lens
+        records['tx_len'] = tx_lens
+        records['rx_off'] = self.rx_off + np.cumsum(rx_lens) - rx_lens
+        records['rx_len'] = rx_lens
+        records['batch_id'] = batch_id
+        records['chan_param'] = chan_param
+        records['log_prob'] = np.nan if log_probs is None else log_probs
+
+        if len(tx_lens):
+            np.concatenate([np.asarray(s, dtype=np.int32) for s in tx_sentences]).tofile(self.tx_file)
+            np.concatenate([np.asarray(s, dtype=np.int32) for s in rx_sentences]).tofile(self.rx_file)
+        self.tx_off += int(tx_lens.sum())
+        self.rx_off += int(rx_lens.sum())
+        # Records last, so a reader never sees a record without its tokens
+        self.tx_file.flush()
+        self.rx_file.flush()
+        records.tofile(self.rec_file)
+        self.rec_file.flush()
+
+    def close(self):
+        self.tx_file.close()
+        self.rx_file.close()
+        self.rec_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultsReader(object):
+    """ Memory mapped view of a results folder
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    @staticmethod
+    def _memmap(file_path, dtype):
+        numb_items = os.path.getsize(file_path) // dtype.itemsize
+        if numb_items == 0:
+            return np.zeros([0], dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=(numb_items,))
+
+    def refresh(self):
+        """ Maps the files again to see the pairs written since"""
+        self.records = self._memmap(os.path.join(self.path, 'records.bin'), RECORD_DTYPE)
+        self.tx_tokens = self._memmap(os.path.join(self.path, 'tx_tokens.bin'), np.dtype(np.int32))
+        self.rx_tokens = self._memmap(os.path.join(self.path, 'rx_tokens.bin'), np.dtype(np.int32))
+
+    def __len__(self):
+        return len(self.records)
+
+    def tx(self, ind):
+        rec = self.records[ind]
+        return self.tx_tokens[rec['tx_off']:rec['tx_off']+rec['tx_len']]
+
+    def rx(self, ind):
+        rec = self.records[ind]
+        return self.rx_tokens[rec['rx_off']:rec['rx_off']+rec['rx_len']]
+
+    def pairs(self, start=0, stop=None):
+        """ Iterates over (tx ids, rx ids, record) of the pairs"""
+        for ind in range(start, len(self) if stop is None else stop):
+            yield self.tx(ind), self.rx(ind), self.records[ind]
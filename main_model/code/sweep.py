@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Runs a grid of experiments (channel parameter x bits per sentence) for the
+neural model results and the traditional (gzip/bit5/huffman + Reed-Solomon)
+baselines. The points are evaluated in parallel, the metrics of every point
+are kept in a sweep folder so that points which are up to date are skipped
+on the next run, and all of them are written to one CSV table.
+
+Example:
+    python sweep.py -c erasure -cp 1 0.99 0.95 0.9 -ntx 400 -d news
+    python sweep.py -s figure_bps.json
+
+A spec file is a JSON dictionary with the same keys as the command line
+arguments (channel, chan_params, numb_tx_bits, bits_per_bin_gen, dataset,
+models, ...).
+========================================================================"""
+import os
+import sys
+import csv
+import json
+import argparse
+import itertools
+import subprocess
+import multiprocessing as mp
+from collections import namedtuple
+import numpy as np
+from tqdm import tqdm
+from preprocess_library import RawSentenceBatchGeneratorLength, Word2Numb
+from performance_tests import performance_test
+from traditional import traditional, bit5_rs, huffman_rs
+from jointSC_modChan import parse_args as parse_model_args
+from results_io import results_dir
+
+MODEL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jointSC_modChan.py')
+
+MODELS = ['neural', 'trad', 'bit5', 'huffman']
+CSV_FIELDS = ['model', 'channel', 'chan_param', 'numb_tx_bits', 'bits_per_bin_gen', 'dataset',
+              'mean', 'std', 'count']
+
+SweepPoint = namedtuple('SweepPoint', ['model', 'channel', 'chan_param', 'numb_tx_bits',
+                                       'bits_per_bin_gen', 'dataset'])
+
+
+def grid_points(spec):
+    """ All the points of a sweep spec, in table order"""
+    bits_per_bin_gen = spec.get('bits_per_bin_gen')
+    bits_per_bin_gen = ' '.join(str(x) for x in bits_per_bin_gen) if bits_per_bin_gen else ''
+    return [SweepPoint(model, spec['channel'], float(chan_param), int(numb_tx_bits),
+                       bits_per_bin_gen if model == 'neural' else '', spec['dataset'])
+            for model, chan_param, numb_tx_bits in itertools.product(spec['models'], spec['chan_params'],
+                                                                     spec['numb_tx_bits'])]
+
+
+def point_name(point, spec):
+    """ File name of the metrics of a point. Includes everything the metrics
+    depend on, so a change of settings does not reuse old metrics
+    """
+    name = '{}-{}{:0.3f}-b{}-{}'.format(point.model, point.channel, point.chan_param,
+                                        point.numb_tx_bits, point.dataset)
+    if point.model == 'neural':
+        name += '-{}'.format(spec['edit_distance_type'])
+        if point.bits_per_bin_gen:
+            name += '-var-' + point.bits_per_bin_gen.replace(' ', '-')
+        if spec.get('model_args'):
+            name += '-' + '-'.join(arg.strip('-') for arg in spec['model_args'])
+    else:
+        name += '-mp{}-bs{}'.format(spec['max_per_point'], spec['batch_size'])
+    return name + '.json'
+
+
+def model_args(point, spec):
+    """ jointSC_modChan arguments of the beam test of a neural point"""
+    args = ['-c', point.channel, '-cp', repr(point.chan_param),
+            '-ntx', '{}'.format(point.numb_tx_bits), '-d', point.dataset, '-t', 'beam']
+    if point.bits_per_bin_gen:
+        args += ['-vv', '-bg'] + point.bits_per_bin_gen.split(' ')
+    if spec.get('results_format', 'text') != 'text':
+        args += ['-rf', spec['results_format']]
+    return args + list(spec.get('model_args', []))
+
+
+def point_source(point, spec):
+    """ File whose changes make the metrics of a point out of date: the test
+    results for the neural model, the test data for the baselines
+    """
+    conf_args = parse_model_args(model_args(point, spec))
+    if point.model == 'neural':
+        if spec.get('results_format', 'text') == 'binary':
+            return results_dir(conf_args['test_results_path'])
+        return conf_args['test_results_path']
+    return conf_args['testdata_path']
+
+
+def is_up_to_date(metrics_path, source_path):
+    return (os.path.exists(metrics_path) and os.path.exists(source_path) and
+            os.path.getmtime(metrics_path) >= os.path.getmtime(source_path))
+
+
+_sweep_state = {}
+
+def _init_sweep_worker(spec):
+    """ Initializer of the sweep worker processes. The baseline models are
+    built the first time a worker needs them
+    """
+    _sweep_state['spec'] = spec
+    _sweep_state['models'] = {}
+    _sweep_state['word2numb'] = None
+
+def _get_word2numb(w2n_path):
+    if _sweep_state['word2numb'] is None:
+        _sweep_state['word2numb'] = Word2Numb(w2n_path)
+    return _sweep_state['word2numb']
+
+def _get_model(name, path_to_data):
+    models = _sweep_state['models']
+    if name not in models:
+        if name == 'trad':
+            models[name] = traditional()
+        elif name == 'bit5':
+            models[name] = bit5_rs()
+        else:
+            models[name] = huffman_rs(path_to_data)
+    return models[name]
+
+def _run_point(job):
+    """ Evaluates one sweep point
+    Args:
+        job: (point, metrics path, source path)
+    Returns:
+        metrics dictionary, or None if the point has no results
+    """
+    point, metrics_path, source_path = job
+    spec = _sweep_state['spec']
+    if not os.path.exists(source_path):
+        return None
+    conf_args = parse_model_args(model_args(point, spec))
+    word2numb = _get_word2numb(conf_args['w2n_path'])
+    if point.model == 'neural':
+        metrics = performance_test(conf_args['test_results_path'], word2numb, diff=30,
+                                   max_per_point=spec['max_per_point_neural'],
+                                   dist_type=spec['edit_distance_type'], numb_workers=1,
+                                   results_format=spec['results_format'])
+        mean, std, count = metrics['total_mean'], metrics['std_devs'], int(np.sum(metrics['bin_counts']))
+    else:
+        batch_gen = RawSentenceBatchGeneratorLength(source_path, word2numb, batch_size=spec['batch_size'], diff=50)
+        batches = [batch_gen.get_next_batch() for _ in range(spec['max_per_point'])]
+        performance = _get_model(point.model, source_path).performance_batches(
+            batches, point.chan_param, point.numb_tx_bits, channel=point.channel)
+        mean, std, count = np.mean(performance), np.std(performance), len(performance)
+
+    metrics = dict(point._asdict(), mean=float(mean), std=float(std), count=count)
+    tmp_path = metrics_path + '.tmp'
+    with open(tmp_path, 'w') as fop:
+        json.dump(metrics, fop)
+    os.replace(tmp_path, metrics_path)
+    return metrics
+
+
+def run_missing_beam_tests(points, spec):
+    """ Runs the beam tests of the neural points without results, one at a
+    time since they share the GPU
+    """
+    for point in points:
+        if point.model != 'neural' or os.path.exists(point_source(point, spec)):
+            continue
+        args = model_args(point, spec)
+        args += ['-terp', parse_model_args(args)['test_results_path']] #Written where point_source looks
+        print('Running beam test: ', ' '.join(args))
+        subprocess.run([sys.executable, MODEL_SCRIPT] + args)
+
+
+def run_sweep(spec):
+    """ Evaluates all the points of a spec and writes the CSV table
+    Args:
+        spec: dictionary with channel, chan_params, numb_tx_bits,
+            bits_per_bin_gen, dataset, models and the evaluation settings
+            (see parse_args)
+    Returns:
+        list of the metrics dictionaries of the points, in table order
+    """
+    points = grid_points(spec)
+    if not os.path.exists(spec['sweep_dir']):
+        os.makedirs(spec['sweep_dir'])
+    if spec['run_missing']:
+        run_missing_beam_tests(points, spec)
+
+    metrics = {}
+    jobs = []
+    for point in points:
+        metrics_path = os.path.join(spec['sweep_dir'], point_name(point, spec))
+        source_path = point_source(point, spec)
+        if not spec['force'] and is_up_to_date(metrics_path, source_path):
+            with open(metrics_path, 'r') as fop:
+                metrics[point] = json.load(fop)
+        else:
+            jobs.append((point, metrics_path, source_path))
+    print('{} points up to date, {} to evaluate'.format(len(metrics), len(jobs)))
+
+    if jobs:
+        numb_workers = min(spec['workers'] or mp.cpu_count(), len(jobs))
+        with mp.Pool(numb_workers, initializer=_init_sweep_worker, initargs=(spec,)) as pool:
+            for (point, _, source_path), point_metrics in tqdm(zip(jobs, pool.imap(_run_point, jobs)),
+                                                               total=len(jobs), desc='sweep '):
+                if point_metrics is None:
+                    print('{} does not exist, skipping {}'.format(source_path, point))
+                else:
+                    metrics[point] = point_metrics
+
+    rows = [metrics[point] for point in points if point in metrics]
+    with open(spec['out'], 'w', newline='') as fop:
+        writer = csv.DictWriter(fop, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Metrics of {} points written to {}'.format(len(rows), spec['out']))
+    return rows
+
+
+def parse_args(arg_to_parse=None):
+    """ Function parses the sweep args. Values of a spec file are overridden
+    by the ones given in the command line
+    """
+    parent_dir, _ = os.path.split(os.getcwd())
+    parser = argparse.ArgumentParser(description='Channel parameter / bit budget sweeps')
+    parser.add_argument('--spec', '-s', default=None, help='JSON file with the sweep spec')
+    parser.add_argument('--channel', '-c', choices=['erasure', 'awgn', 'bsc', 'none'])
+    parser.add_argument('--chan_params', '-cp', nargs='+', type=float)
+    parser.add_argument('--numb_tx_bits', '-ntx', nargs='+', type=int)
+    parser.add_argument('--bits_per_bin_gen', '-bg', nargs='+', help='Variable encoding bits per bin of the neural model. const linear or sqrt followed by low_lim on bits')
+    parser.add_argument('--dataset', '-d', choices=['wiki', 'news', 'euro', 'beta'])
+    parser.add_argument('--models', '-m', nargs='+', choices=MODELS)
+    parser.add_argument('--model_args', '-ma', nargs=argparse.REMAINDER, help='Extra jointSC_modChan arguments of the neural model')
+    parser.add_argument('--max_per_point', '-mp', type=int, help='Number of batches evaluated for the baselines')
+    parser.add_argument('--max_per_point_neural', '-mpn', type=int, help='Maximum number of sentences evaluated for the neural model')
+    parser.add_argument('--batch_size', '-b', type=int)
+    parser.add_argument('--edit_distance_type', '-edt', choices=['ed_only', 'ed_WuP'])
+    parser.add_argument('--results_format', '-rf', choices=['text', 'binary'])
+    parser.add_argument('--workers', '-w', type=int, help='Number of processes. Defaults to all cpus')
+    parser.add_argument('--run_missing', '-rm', action='store_true', default=None, help='Run the beam tests of the neural points without results')
+    parser.add_argument('--force', '-f', action='store_true', default=None, help='Evaluate all the points, even up to date ones')
+    parser.add_argument('--sweep_dir', '-sd', help='Folder of the metrics of every point')
+    parser.add_argument('--out', '-o', help='CSV file of the metrics table')
+
+    if arg_to_parse is None:
+        args = vars(parser.parse_args())
+    else:
+        args = vars(parser.parse_args(arg_to_parse))
+
+    spec = {'channel': 'erasure', 'chan_params': [0.95], 'numb_tx_bits': [400], 'bits_per_bin_gen': None,
+            'dataset': 'news', 'models': MODELS, 'model_args': [], 'max_per_point': 50,
+            'max_per_point_neural': 50000, 'batch_size': 32, 'edit_distance_type': 'ed_only',
+            'results_format': 'text', 'workers': None, 'run_missing': False, 'force': False,
+            'sweep_dir': os.path.join(parent_dir, 'performance_results', 'sweep'), 'out': None}
+    if args['spec'] is not None:
+        with open(args['spec'], 'r') as fop:
+            spec.update(json.load(fop))
+    spec.update((key, value) for key, value in args.items() if value is not None and key != 'spec')
+    spec['out'] = spec['out'] or os.path.join(spec['sweep_dir'], 'sweep_{}_{}.csv'.format(spec['channel'], spec['dataset']))
+    return spec
+
+
+if __name__ == "__main__":
+    run_sweep(parse_args())
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Tests of the batched edit distance: distances and substituted word pairs
+(the alignment ed_WuP discounts) must be those of the per pair
+edit_distance.SequenceMatcher path, including its tie-break.
+========================================================================"""
+import numpy as np
+import pytest
+from batch_edit_distance import sentences_edit_distance
+
+
+def substitutions(tx_sentences, rx_sentences):
+    _, (rows, sub_tx, sub_rx) = sentences_edit_distance(tx_sentences, rx_sentences, return_substitutions=True)
+    subs = [[] for _ in tx_sentences]
+    for row, tx_word, rx_word in zip(rows, sub_tx, sub_rx):
+        subs[row].append((int(tx_word), int(rx_word)))
+    return subs
+
+
+def test_tie_break_pinned():
+    # Equal cost alignments: insertions are preferred to deletions, as SequenceMatcher does
+    tx_sentences = [[1, 2], [1, 2, 3], [1, 2, 3, 4], [0, 1, 0], [3, 0, 1, 2], []]
+    rx_sentences = [[3], [3, 4], [2, 5], [2, 2, 0, 1], [1, 2, 1], [1]]
+    assert substitutions(tx_sentences, rx_sentences) == [[(2, 3)], [(2, 3), (3, 4)], [(4, 5)],
+                                                         [(0, 2), (1, 2)], [], []]
+
+
+def test_matches_sequence_matcher():
+    edit_distance = pytest.importorskip('edit_distance')
+    rng = np.random.RandomState(0)
+    tx_sentences = [list(rng.randint(0, 4, size=rng.randint(0, 9))) for _ in range(500)]
+    rx_sentences = [list(rng.randint(0, 4, size=rng.randint(0, 9))) for _ in range(500)]
+    distances = sentences_edit_distance(tx_sentences, rx_sentences)
+    for tx, rx, distance, subs in zip(tx_sentences, rx_sentences, distances,
+                                      substitutions(tx_sentences, rx_sentences)):
+        matcher = edit_distance.SequenceMatcher(a=tx, b=rx)
+        assert distance == matcher.distance()
+        assert subs == [(tx[op[1]], rx[op[3]]) for op in matcher.get_opcodes() if op[0] == 'replace']
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Tests of the shared tokenizer: the tokens must be the ones of nltk's
+WordPunctTokenizer, so that the existing vocabularies and trained models stay
+valid, and the block APIs must agree with tokenizing line by line.
+========================================================================"""
+import os
+import itertools
+import numpy as np
+import pytest
+from tokenization import tokenize, tokenize_block, tokenize_lines, lines_to_ids, count_tokens
+
+nltk = pytest.importorskip('nltk')
+
+CASES = ['The car is coming.', "don't -- stop!!", 'état , naïve café_au_lait 3.14',
+         '\tTabs\tand  spaces ', '', '...', 'Straße ΑΒΓ 漢字', 'a_b __ 1,000,000$',
+         "<unk> <end> w145 (parens) [x]{y}", 'emoji 🙂 and ½ ² Ⅻ', 'no-break\xa0space',
+         "it's 9:30 p.m. -- ok?!", 'CamelCase UPPER lower']
+
+# Recent nltk compiles the pattern with the regex module, whose \w also matches
+# combining marks. The tokens of re (those the vocabularies were built with) are kept
+KNOWN_DIFFERENCES = {'i\u0307stanbul': ['i', '\u0307', 'stanbul'],
+                     'cafe\u0301': ['cafe', '\u0301']}
+
+CHARS = 'abcXYZ019_ .,;:!?\'"-()$%éßΩж漢\t'
+
+
+def nltk_tokens(lines):
+    word_token = nltk.tokenize.WordPunctTokenizer()
+    return [word_token.tokenize(line) for line in lines]
+
+
+def random_lines(numb_lines=2000, seed=0):
+    rng = np.random.RandomState(seed)
+    return [''.join(rng.choice(list(CHARS), size=rng.randint(0, 40))) for _ in range(numb_lines)]
+
+
+def test_matches_nltk():
+    lines = CASES + [line.lower() for line in CASES] + random_lines()
+    assert tokenize_lines(lines) == nltk_tokens(lines)
+    assert [tokenize(line) for line in lines] == nltk_tokens(lines)
+
+
+def test_known_differences():
+    for line, tokens in KNOWN_DIFFERENCES.items():
+        assert tokenize(line) == tokens
+        assert tokenize_lines([line]) == [tokens]
+
+
+def test_matches_nltk_on_corpus():
+    parent_dir = os.path.split(os.path.dirname(os.path.abspath(__file__)))[0]
+    path = os.path.join(parent_dir, 'data', 'news', 'news_test.dat')
+    if not os.path.exists(path):
+        pytest.skip('no test corpus at ' + path)
+    with open(path, 'r', encoding='utf8') as fop:
+        lines = [line[:-1].lower() for line in itertools.islice(fop, 100000)]
+    assert tokenize_lines(lines) == nltk_tokens(lines)
+
+
+def test_block_apis():
+    lines = CASES + random_lines(200)
+    tokens, offsets = tokenize_block(lines)
+    per_line = [tokenize(line) for line in lines]
+    assert tokens == list(itertools.chain.from_iterable(per_line))
+    assert list(np.diff(offsets)) == [len(words) for words in per_line]
+    assert list(count_tokens(lines)) == [len(words) for words in per_line]
+    assert tokenize_block([])[0] == [] and list(tokenize_block([])[1]) == [0]
+
+
+def test_lines_to_ids():
+    class Vocab(object):
+        UNK_ID = 3
+        w2n = {'the': 4, 'car': 5, '.': 6}
+        def convert_w2n(self, words):
+            return [self.w2n.get(word, self.UNK_ID) for word in words]
+    vocab = Vocab()
+    lines = ['the car .', '', 'the truck', 'car']
+    ids, offsets = lines_to_ids(lines, vocab)
+    assert [ids[start:end].tolist() for start, end in zip(offsets[:-1], offsets[1:])] == \
+        [vocab.convert_w2n(tokenize(line)) for line in lines]
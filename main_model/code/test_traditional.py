@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""========================================================================
+Tests of the traditional (gzip/bit5 + Reed-Solomon) baselines: the word
+error rate estimated from the code sizes must agree with the one measured
+end to end through the simulated channel when the channel is mild and the
+codes are sized for byte erasures.
+========================================================================"""
+import numpy as np
+import pytest
+from traditional import traditional, bit5_rs, rs_nsym
+
+WORDS = ['the', 'car', 'is', 'coming', 'a', 'vehicle', 'approaching', 'girl', 'told',
+         'him', 'that', 'politicians', 'have', 'voted', 'few', 'decided', 'woman', 'said']
+
+
+def make_batches(numb_batches=6, batch_size=16, seed=0):
+    rng = np.random.RandomState(seed)
+    batches = []
+    for _ in range(numb_batches):
+        sentences = [' '.join(rng.choice(WORDS, size=rng.randint(4, 20))) + ' .' for _ in range(batch_size)]
+        batches.append([(sentence, len(sentence.split())) for sentence in sentences])
+    return batches
+
+
+def test_rs_nsym():
+    assert rs_nsym(0.05) == 13
+    assert rs_nsym(0, byte_level=True) == 0
+    assert rs_nsym(1, byte_level=True) == 254
+    assert rs_nsym(0.1, byte_level=True) > 255*0.1
+
+
+def test_erasure_rate():
+    model = traditional()
+    assert np.isclose(model.erasure_rate(0.95, 'erasure'), 0.05)
+    assert np.isclose(model.erasure_rate(0.01, 'bsc'), 0.02)
+    assert model.erasure_rate(0.95, 'none') == 0
+    with pytest.raises(ValueError):
+        model.erasure_rate(0.95, 'fading')
+
+
+def test_byte_erasure_rate():
+    model = traditional()
+    assert np.isclose(model.erasure_rate(0.95, 'erasure', byte_level=True), 1-0.95**8)
+    assert np.isclose(model.erasure_rate(0.01, 'bsc', byte_level=True), 2*(1-0.99**8))
+
+
+def test_end_to_end_matches_estimate():
+    batches = make_batches()
+    for model in [traditional(), bit5_rs()]:
+        for channel, chan_param, bps in [('erasure', 0.95, 400), ('erasure', 0.95, 150), ('bsc', 0.01, 200)]:
+            estimate = model.performance_batches(batches, chan_param, bps, channel=channel, byte_level=True)
+            measured = model.decode_batches(batches, chan_param, bps, channel=channel, seed=0, byte_level=True)
+            assert max(measured) <= 1
+            assert abs(np.mean(estimate) - np.mean(measured)) < 0.05, (type(model).__name__, channel, bps)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+r"""========================================================================
+Word tokenization shared by the batch generators, the corpus statistics and
+the vocabulary builder. It is the regex of nltk's WordPunctTokenizer
+(\w+|[^\w\s]+) precompiled once and applied to whole blocks of lines, so the
+tokens are the same as the ones the vocabularies and the trained models were
+built with. lines_to_ids goes straight from a block of lines to a flat array
+of word ids.
+
+The regex is compiled with re, as nltk did when the vocabularies were built.
+Recent nltk versions compile it with the regex module, whose \w also matches
+combining marks, so the tokens can differ on text with combining characters.
+========================================================================"""
+import re
+import itertools
+import numpy as np
+
+TOKEN_PATTERN = r'\w+|[^\w\s]+' #Same as nltk.tokenize.WordPunctTokenizer
+token_re = re.compile(TOKEN_PATTERN)
+_block_re = re.compile(TOKEN_PATTERN + r'|\n') #Line breaks are kept as separators
+
+
+def tokenize(text):
+    """ Tokens of a string"""
+    return token_re.findall(text)
+
+def _block_tokens(lines):
+    """ Tokens of a list of lines (without line breaks) tokenized at once
+    Returns:
+        tokens with '\n' between lines, mask of the '\n' separators
+    """
+    tokens = _block_re.findall('\n'.join(lines))
+    breaks = np.fromiter(map('\n'.__eq__, tokens), dtype=bool, count=len(tokens))
+    return tokens, breaks
+
+def _offsets(breaks, numb_lines):
+    """ Offsets of the tokens of each line in the flat tokens, numb_lines+1 long"""
+    if numb_lines == 0:
+        return np.zeros([1], dtype=np.int64)
+    ends = np.flatnonzero(breaks) - np.arange(np.count_nonzero(breaks))
+    return np.concatenate([[0], ends, [len(breaks) - len(ends)]]).astype(np.int64)
+
+def tokenize_block(lines):
+    """ Tokenizes a list of lines (without line breaks) at once
+    Returns:
+        flat list of the tokens, offsets (numb_lines+1) of the tokens of each line
+    """
+    tokens, breaks = _block_tokens(lines)
+    return list(itertools.compress(tokens, ~breaks)), _offsets(breaks, len(lines))
+
+def tokenize_lines(lines):
+    """ List of the tokens of every line of a list of lines"""
+    tokens, offsets = tokenize_block(lines)
+    return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def lines_to_ids(lines, word2numb, dtype=np.int32):
+    """ Tokenizes a list of lines (without line breaks) and converts the tokens
+    to word ids, UNK_ID for the unknown ones
+    Args:
+        lines: list of strings, already lower cased if needed
+        word2numb: Word2Numb object
+    Returns:
+        flat array of the word ids, offsets (numb_lines+1) of the ids of each line
+    """
+    tokens, breaks = _block_tokens(lines)
+    ids = np.fromiter(map(word2numb.w2n.get, tokens, itertools.repeat(word2numb.UNK_ID)),
+                      dtype=dtype, count=len(tokens))
+    return ids[~breaks], _offsets(breaks, len(lines))
+
+def count_tokens(lines):
+    """ Number of tokens of every line of a list of lines"""
+    return np.diff(tokenize_block(lines)[1])
+
+def count_per_line(mask, offsets):
+    """ Number of True values of a flat per token mask within each line"""
+    cumsum = np.concatenate([[0], np.cumsum(mask)])
+    return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
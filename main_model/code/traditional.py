@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import itertools
 import collections
+import multiprocessing as mp
 from huffman import codebook as hcode
 from functools import lru_cache
 from preprocess_library import RawSentenceBatchGeneratorLength, Word2Numb
@@ -23,6 +24,23 @@ import bisect
 from performance_tests import performance_test, variation_exp
 from scipy.stats import norm
 from jointSC_modChan import parse_args
+from channel_sim import ChannelSimulator, effective_erasure_rate
+from batch_edit_distance import sentences_edit_distance
+from packed_codec import PrefixCodec, PackedBits
+from tokenization import tokenize
+
+def rs_nsym(rate, byte_level=False, margin=3):
+    """ Number of reed-solomon parity bytes of a 255 byte block for an
+    erasure rate (see traditional.erasure_rate). By default it is the rate
+    times 255. With byte_level, the rate is a byte erasure rate and the parity
+    is the mean number of erasures of a block plus margin standard
+    deviations, so that few blocks fail. Errors count twice, so the variance
+    is bounded by twice the mean. At most 254
+    """
+    if not byte_level:
+        return int(np.ceil(255*rate))
+    mean = 255*min(max(rate,0),1)
+    return int(min(np.ceil(mean + margin*np.sqrt(2*mean)), 254))
 
 class traditional(object):
     def source(self,sentences):
@@ -40,18 +58,46 @@ class traditional(object):
         """
         return reedsolo.RSCodec(bdr_byte)
         
-    def channel(self,obj_to_chan_code,bdr=0.05):
+    def channel(self,obj_to_chan_code,bdr=0.05,byte_level=False):
         """ Does reed-solomon coding
         Args:
             obj_to_chan_code 
-            bdr: bit drop rate
+            bdr: erasure rate (see erasure_rate)
+            byte_level: bdr is a byte erasure rate (see rs_nsym)
         Returns:
             reed-solomon code
         """
-        bdr_byte = int(np.ceil(255*bdr))
-        channel_coder = self.rs_codec(bdr_byte)
+        channel_coder = self.rs_codec(rs_nsym(bdr,byte_level))
         return channel_coder.encode(obj_to_chan_code)
 
+    def source_sizes(self,sentences):
+        """ Sizes in bytes of the gzipped prefixes ' '.join(sentences[:k+1]) for
+        every k. Each sentence is compressed once, the size of a prefix is read
+        from a copy of the compressor flushed at that point
+        Args:
+            sentences - list of sentences
+        Returns:
+            array of sizes
+        """
+        compressor = zlib.compressobj(9)
+        numb_bytes = 0
+        sizes = []
+        for ind,sentence in enumerate(sentences):
+            numb_bytes += len(compressor.compress(str.encode(' '+sentence if ind else sentence)))
+            sizes.append(numb_bytes + len(compressor.copy().flush()))
+        return np.array(sizes)
+
+    def channel_size(self,numb_bytes,bdr=0.05,byte_level=False):
+        """ Size in bytes of the reed-solomon code of numb_bytes bytes, without
+        encoding anything. Each block of 255-nsym bytes gets nsym parity bytes
+        Args:
+            numb_bytes - int or array of sizes
+            bdr - erasure rate (see erasure_rate)
+            byte_level - bdr is a byte erasure rate (see rs_nsym)
+        """
+        nsym = rs_nsym(bdr,byte_level)
+        return numb_bytes + nsym*((numb_bytes + 254-nsym)//(255-nsym))
+
     def source_channel(self,sentences,**kwargs):
         """ Accepts a sentence. gzips it and uses reed-solomon. Returns the 
         encoded object
@@ -84,7 +130,35 @@ class traditional(object):
                                          
         return (encoded,comp_ratio,bits_per_sentence)
 
-    def performance_batch(self,batch,batch_lens,bdr=0.05,bps=500,channel='erasure'):
+    def erasure_rate(self,bdr,channel='erasure',simulated=False,byte_level=False):
+        """ Rate of erasures the Reed-Solomon code has to correct for a
+        channel (an error counts as two erasures)
+        Args:
+            bdr - channel parameter: keep rate (erasure), noise std (awgn) or
+                flip probability (bsc)
+            channel - type of channel. none, erasure, awgn, bsc
+            simulated - measure the rate with channel_sim instead of the
+                closed form expressions
+            byte_level - rate of the bytes the code works on instead of the
+                bits. A byte is lost if any of its 8 bits is
+        """
+        if channel == 'none':
+            return 0
+        if channel not in ['erasure','awgn','bsc']:
+            raise ValueError('Channel type is not known: {}'.format(channel))
+        if simulated:
+            return effective_erasure_rate(channel,bdr,symbol_bits=8 if byte_level else 1)
+        if channel == 'erasure': 
+            bit_erasure,bit_error = 1 - bdr,0
+        elif channel == 'awgn': #awgn greedy decoding
+            bit_erasure,bit_error = 0,1-norm.cdf(1/max(bdr,1e-5))
+        else: #binary switching
+            bit_erasure,bit_error = 0,bdr
+        if not byte_level:
+            return bit_erasure + 2*bit_error
+        return 1-(1-bit_erasure)**8 + 2*(1-(1-bit_error)**8)
+
+    def performance_batch(self,batch,batch_lens,bdr=0.05,bps=500,channel='erasure',simulated=False,byte_level=False):
         """ Computes the performance of the traditional method given bit drop rate
         and bits per sentence restrictions
         Args:
@@ -93,33 +167,137 @@ class traditional(object):
             bdr - bit drop rate
             bps - bits per sentence
             channel - type of channel. erasure, awgn, bsc
+            simulated - whether the erasure rate is measured by simulation
+            byte_level - size the code for the byte erasure rate (see rs_nsym)
         Returns:
             performance - word error rate accurate to second decimal place
         """
-        if channel == 'erasure': 
-            bdr = 1 - bdr
-        elif channel == 'awgn': #awgn greedy decoding
-            bdr = 2*(1-norm.cdf(1/max(bdr,1e-5)))
-        elif channel == 'bsc': #binary switching
-            bdr = 2*bdr
+        bdr = self.erasure_rate(bdr,channel,simulated,byte_level)
+        index_to_check = self.fit_prefix(batch,bdr,bps,byte_level)
+        word_error_rate = 1-sum(itertools.islice(batch_lens,index_to_check+1))/sum(batch_lens)
+        return word_error_rate
+    
+    def fit_prefix(self,batch,bdr,bps,byte_level=False):
+        """ Binary search of the number of sentences of the batch that can be
+        sent within the bits per sentence budget
+        Args:
+            batch - batch of sentences
+            bdr - erasure rate the reed-solomon code is designed for
+            bps - bits per sentence
+            byte_level - bdr is a byte erasure rate (see rs_nsym)
+        Returns:
+            index of the last sentence sent
+        """
+        #Encoded size of every prefix of the batch, as source_channel would give
+        prefix_bits = self.channel_size(self.source_sizes(batch),bdr,byte_level)*8
             
         batch_size = len(batch)
         low_index = 0
         high_index = batch_size-1
         while high_index>=low_index:
             index_to_check = int((low_index+high_index)/2)
-            encoding = self.source_channel(' '.join(batch[:index_to_check+1]),bdr=bdr)
-            bits_per_sentence = self.getsize(encoding)/batch_size
+            bits_per_sentence = prefix_bits[index_to_check]/batch_size
             if bits_per_sentence> 1.01*bps:
                 high_index = index_to_check - 1
             elif bits_per_sentence< 0.99*bps:
                 low_index = index_to_check + 1
             else:
                 break
-        word_error_rate = 1-sum(itertools.islice(batch_lens,index_to_check+1))/sum(batch_lens)
-        return word_error_rate
+        return index_to_check
+    
+    def channel_decode(self,received,bdr=0.05,erased=None,sent=None,byte_level=False):
+        """ Reed-solomon decoding of a received code, one block at a time.
+        Blocks that cannot be decoded are kept as received
+        Args:
+            received - received bytes
+            bdr - erasure rate the code was made with
+            erased - boolean array marking the erased bytes, if known
+            sent - the bytes that were sent. Blocks received intact are then
+                not decoded (a shortcut of the simulation, the decoder would
+                return them unchanged)
+            byte_level - bdr is a byte erasure rate (see rs_nsym)
+        Returns:
+            decoded message bytes, number of blocks that failed
+        """
+        nsym = rs_nsym(bdr,byte_level)
+        channel_coder = self.rs_codec(nsym)
+        message = bytearray()
+        numb_failed = 0
+        for start in range(0,len(received),255):
+            block = received[start:start+255]
+            if nsym == 0 or (sent is not None and block == sent[start:start+255]):
+                message += block[:len(block)-nsym]
+                continue
+            erase_pos = [] if erased is None else list(np.flatnonzero(erased[start:start+255]))
+            try:
+                if len(erase_pos) > nsym:
+                    raise reedsolo.ReedSolomonError('Too many erasures')
+                message += channel_coder.decode(block,erase_pos=erase_pos)[0]
+            except reedsolo.ReedSolomonError:
+                message += block[:len(block)-nsym]
+                numb_failed += 1
+        return message,numb_failed
+    
+    def decode_batches(self,batches,bdr=0.05,bps=500,channel='erasure',simulated=False,seed=None,byte_level=False):
+        """ End to end performance: the sentences of each batch that fit the
+        budget are compressed and reed-solomon coded, the bits of all the
+        batches go through the simulated channel together, then each batch
+        is reed-solomon decoded (with the erased bytes as erasures) and
+        decompressed. All the words of the batch are compared with the
+        recovered ones
+        Args:
+            batches : a list of batches. Each has sentence,sentence_len
+            bdr - channel parameter
+            bps - bits per sentence
+            channel - type of channel. erasure, awgn, bsc
+            simulated - whether the erasure rate the code is designed for is
+                measured by simulation
+            seed - seed of the channel noise
+            byte_level - size the code for the byte erasure rate (see
+                rs_nsym). The default sizing, the one of performance_batch,
+                leaves most blocks of the mild channels undecodable
+        Returns:
+            list of word error rates (edit distance over number of words,
+            at most 1)
+        """
+        rate = self.erasure_rate(bdr,channel,simulated,byte_level)
+        sent,sources,tx_words = [],[],[]
+        for batch in batches:
+            sentences,_ = zip(*batch)
+            index = self.fit_prefix(sentences,rate,bps,byte_level)
+            source = self.source(' '.join(sentences[:index+1]))
+            sources.append(source)
+            sent.append(bytes(self.channel(source,rate,byte_level)))
+            tx_words.append(tokenize(' '.join(sentences)))
+
+        #All the codes go through the channel at once, as rows of +1/-1
+        numb_bytes = max(len(code) for code in sent)
+        tx_bytes = np.zeros([len(sent),numb_bytes],dtype=np.uint8)
+        for row,code in zip(tx_bytes,sent):
+            row[:len(code)] = np.frombuffer(code,dtype=np.uint8)
+        tx_bits = 2*np.unpackbits(tx_bytes,axis=1).astype(np.float32)-1
+        rx = ChannelSimulator(channel,seed)(tx_bits,bdr)
+        rx_bytes = np.packbits(rx>0,axis=1)
+        erased = (rx==0).reshape([len(sent),numb_bytes,8]).any(axis=2)
+
+        rx_words = []
+        for source,code,rx_row,erased_row in zip(sources,sent,rx_bytes,erased):
+            message,_ = self.channel_decode(rx_row[:len(code)].tobytes(),rate,erased_row[:len(code)],code,byte_level)
+            if isinstance(source,PackedBits):
+                text = self.source_decode(message,source.numb_bits)
+            else:
+                text = self.source_decode(message)
+            rx_words.append(tokenize(text))
+
+        #Words as ids for the batched edit distance
+        word_ids = collections.defaultdict(itertools.count().__next__)
+        tx_ids = [[word_ids[word] for word in words] for words in tx_words]
+        rx_ids = [[word_ids[word] for word in words] for words in rx_words]
+        distances = sentences_edit_distance(tx_ids,rx_ids)
+        return list(np.minimum(distances/np.maximum([len(words) for words in tx_words],1),1))
     
-    def performance_batches(self,batches,bdr=0.05,bps=500,verbose=False,channel='erasure'):
+    def performance_batches(self,batches,bdr=0.05,bps=500,verbose=False,channel='erasure',simulated=False,
+                            numb_workers=1,byte_level=False):
         """ Wrapper around performance_batch that computes the performance for 
         multiple batches
         Args:
@@ -128,52 +306,86 @@ class traditional(object):
             bps
             verbose: whether to print progress
             channel - type of channel
+            simulated - whether the erasure rate is measured by simulation
+            numb_workers - number of processes. 1 evaluates in this process,
+                None uses all cpus
+            byte_level - size the code for the byte erasure rate (see rs_nsym)
         returns:
             list of performance values
         """
+        if numb_workers != 1:
+            tasks = [('model',batch,bdr,bps,channel,simulated,byte_level) for batch in batches]
+            return run_baseline_tasks({'model':self},tasks,numb_workers,verbose)
         if verbose:
             batch_iter = tqdm(batches,desc=self.__class__.__name__)
         else:
             batch_iter = batches
             
-        return [self.performance_batch(bat,bat_lens,bdr,bps,channel=channel) for bat,bat_lens 
+        return [self.performance_batch(bat,bat_lens,bdr,bps,channel=channel,simulated=simulated,byte_level=byte_level) for bat,bat_lens 
                 in map(lambda x:zip(*x),batch_iter)]
     
     def bit_string_to_byte(self,bit_string):
         return int(bit_string, 2).to_bytes((len(bit_string) + 7) // 8, 'big')
     
     def getsize(self,encoding):
-        """ Returns the size of an encoding. Works for string or byte sequence
+        """ Returns the size of an encoding in bits. Works for packed bits,
+        binary strings or byte sequences
         
         Args:
-            encoding: binary string or byte sequence
+            encoding: PackedBits, binary string or byte sequence
         Returns:
             integer
         """
-        try:
-            int(encoding,2) #String is binary
+        if isinstance(encoding,PackedBits):
+            return encoding.numb_bits
+        if isinstance(encoding,str): #String is binary
             return len(encoding)
-        except ValueError: #String is byte sequence
-            return len(encoding)*8 
+        return len(encoding)*8 #Byte sequence
+    
+    def source_decode(self,encoding):
+        """ Inverse of source. Returns the sentences. Decompression stops at
+        the first corrupted chunk of the encoding
+        """
+        decompressor = zlib.decompressobj()
+        decoded = b''
+        try:
+            for start in range(0,len(encoding),64):
+                decoded += decompressor.decompress(bytes(encoding[start:start+64]))
+        except zlib.error:
+            pass
+        return decoded.decode(errors='ignore')
             
-class bit5_rs(traditional):
-    def __init__(self):
-        self.chars = string.ascii_lowercase + " ,.?!'"
-        self.char_bin = dict((char, '{0:05b}'.format(index)) for index,char in enumerate(self.chars))
-        self.bin_char = dict((value,key) for key,value in self.char_bin.items())
-        
+class prefix_code_rs(traditional):
+    """ Character level prefix code (self.codec, a PrefixCodec) followed by
+    reed-solomon coding
+    """
     def source(self,sentences):
-        encoding = ''.join(self.char_bin.get(x,self.char_bin['x']) for x in sentences)
-        return encoding
+        """ Returns PackedBits"""
+        return self.codec.encode(sentences)
+    
+    def source_sizes(self,sentences):
+        """ Bytes of the prefixes ' '.join(sentences[:k+1]), from the prefix
+        sums of the code lengths of the characters
+        """
+        return (self.codec.prefix_bits(sentences)+7)//8
+    
+    def source_decode(self,encoding,numb_bits=None):
+        return self.codec.decode(encoding,numb_bits)
     
-    def channel(self,encoding,bdr=0.05):
+    def channel(self,encoding,bdr=0.05,byte_level=False):
         """ Does channel coding using turbo/ldpc/convolutional codes
         """
-        obj_to_chan_code = self.bit_string_to_byte(encoding)
-        return super().channel(obj_to_chan_code,bdr)
+        return super().channel(encoding.data,bdr,byte_level)
+
+class bit5_rs(prefix_code_rs):
+    def __init__(self):
+        self.chars = string.ascii_lowercase + " ,.?!'"
+        self.char_bin = dict((char, '{0:05b}'.format(index)) for index,char in enumerate(self.chars))
+        self.bin_char = dict((value,key) for key,value in self.char_bin.items())
+        self.codec = PrefixCodec(self.char_bin,'x')
     
     
-class huffman_rs(traditional):
+class huffman_rs(prefix_code_rs):
     def __init__(self,path_corpus,num_lines_read=50000):
         fop = open(path_corpus,'r',encoding='utf8')
         char_count = collections.Counter()
@@ -182,15 +394,48 @@ class huffman_rs(traditional):
             char_count.update(line.lower()[:-1])
         fop.close()
         self.huffman_code = hcode(char_count.items())
-        
-    def source(self,sentences):
-        """ Returns binary string sequence"""
-        encoding = ''.join(self.huffman_code.get(x,self.huffman_code['?']) for x in sentences)
-        return encoding
-    
-    def channel(self,encoding,bdr=0.05):
-        obj_to_chan_code = self.bit_string_to_byte(encoding)
-        return super().channel(obj_to_chan_code,bdr=bdr)
+        self.codec = PrefixCodec(self.huffman_code,'?')
+
+_baseline_models = {}
+
+def _init_baseline_worker(models):
+    """ Initializer of the baseline worker processes. The models, with their
+    Huffman codebooks, are set up once per worker and their cached RS codecs
+    are reused by all the tasks of the worker
+    """
+    _baseline_models.clear()
+    _baseline_models.update(models)
+
+def _baseline_task(task):
+    """ performance_batch of a (model name, batch, bdr, bps, channel, simulated, byte_level) task"""
+    name,batch,bdr,bps,channel,simulated,byte_level = task
+    bat,bat_lens = zip(*batch)
+    return _baseline_models[name].performance_batch(bat,bat_lens,bdr,bps,channel=channel,simulated=simulated,
+                                                    byte_level=byte_level)
+
+def _decode_task(task):
+    """ decode_batches of a (model name, batches, bdr, bps, channel, simulated, seed, byte_level) task"""
+    name,batches,bdr,bps,channel,simulated,seed,byte_level = task
+    return _baseline_models[name].decode_batches(batches,bdr,bps,channel=channel,simulated=simulated,seed=seed,
+                                                 byte_level=byte_level)
+
+def run_baseline_tasks(models,tasks,numb_workers=None,verbose=False,chunk_size=4,task_fn=_baseline_task):
+    """ Evaluates baseline tasks in a process pool
+    Args:
+        models: dictionary name -> model
+        tasks: list of (model name, batch, bdr, bps, channel, simulated, byte_level)
+        numb_workers: number of processes. None uses all cpus
+        verbose: whether to print progress
+        chunk_size: number of tasks sent to a worker at a time
+        task_fn: _baseline_task, or _decode_task for tasks of decode_batches
+    Returns:
+        list of task results, in the order of the tasks
+    """
+    with mp.Pool(numb_workers or mp.cpu_count(),initializer=_init_baseline_worker,initargs=(models,)) as pool:
+        results = pool.imap(task_fn,tasks,chunksize=chunk_size)
+        if verbose:
+            results = tqdm(results,total=len(tasks),desc='baselines')
+        return list(results)
 
 def mean_std_performance(performance):
     """ takes in a performance object which is a dictionary whose keys 
@@ -204,7 +449,8 @@ def mean_std_performance(performance):
                         for name,values in performance.items())
     return performance_mean,performance_std
 
-def variation(word2numb,bdr=0.05,bps = list(range(300,700,50)),max_per_point=50,batch_size=32,channel='erasure',path_to_data='../data/news/news_test.dat'):
+def variation(word2numb,bdr=0.05,bps = list(range(300,700,50)),max_per_point=50,batch_size=32,channel='erasure',path_to_data='../data/news/news_test.dat',
+              simulated=False,numb_workers=1,end_to_end=False,seed=None,byte_level=False):
     """ Function loops through bdr, bps values and produced word error 
     rates for all the models considered.
     
@@ -216,6 +462,14 @@ def variation(word2numb,bdr=0.05,bps = list(range(300,700,50)),max_per_point=50,
         batch_size
         channel- could be erasure, awgn, or bsc
         path_to_data 
+        simulated - measure the channel erasure rates by simulation
+        numb_workers - number of processes sharing the batch x model x point
+            tasks. 1 evaluates in this process, None uses all cpus
+        end_to_end - decode the batches sent through a simulated channel
+            (decode_batches) instead of counting the sentences that fit
+        seed - seed of the channel noise of end_to_end
+        byte_level - size the reed-solomon codes for the byte erasure rate
+            (see rs_nsym) instead of the bit erasure rate
         
     Returns:
         performance - dictionary of 'trad', 'huffman', 'bit5'
@@ -239,11 +493,38 @@ def variation(word2numb,bdr=0.05,bps = list(range(300,700,50)),max_per_point=50,
     n2model['huffman'] = huffman_rs(path_to_data)
     performance = {'trad':[],'bit5':[],'huffman':[]}
     
-    for bdr_iter,bps_iter in tqdm(itertools.product(bdr,bps),total = len(bdr)*len(bps),desc='bdr-bps'):
-        batches = [batch_gen.get_next_batch() for _ in range(max_per_point)]
-        [performance[name].append(
-            model.performance_batches(batches,bdr_iter,bps_iter,channel=channel)) 
-            for name,model in n2model.items()]
+    if numb_workers != 1 and end_to_end:
+        points = list(itertools.product(bdr,bps))
+        point_batches = [[batch_gen.get_next_batch() for _ in range(max_per_point)] for _ in points]
+        tasks = [(name,batches,bdr_iter,bps_iter,channel,simulated,seed,byte_level)
+                 for (bdr_iter,bps_iter),batches in zip(points,point_batches) for name in n2model]
+        results = iter(run_baseline_tasks(n2model,tasks,numb_workers,verbose=True,chunk_size=1,task_fn=_decode_task))
+        for _ in points:
+            for name in n2model:
+                performance[name].append(next(results))
+    elif numb_workers != 1:
+        points = list(itertools.product(bdr,bps))
+        point_batches = [[batch_gen.get_next_batch() for _ in range(max_per_point)] for _ in points]
+        tasks = [(name,batch,bdr_iter,bps_iter,channel,simulated,byte_level)
+                 for (bdr_iter,bps_iter),batches in zip(points,point_batches)
+                 for name in n2model for batch in batches]
+        results = iter(run_baseline_tasks(n2model,tasks,numb_workers,verbose=True))
+        for _ in points:
+            for name in n2model:
+                performance[name].append(list(itertools.islice(results,max_per_point)))
+    else:
+        for bdr_iter,bps_iter in tqdm(itertools.product(bdr,bps),total = len(bdr)*len(bps),desc='bdr-bps'):
+            batches = [batch_gen.get_next_batch() for _ in range(max_per_point)]
+            if end_to_end:
+                [performance[name].append(
+                    model.decode_batches(batches,bdr_iter,bps_iter,channel=channel,simulated=simulated,seed=seed,
+                                         byte_level=byte_level))
+                    for name,model in n2model.items()]
+                continue
+            [performance[name].append(
+                model.performance_batches(batches,bdr_iter,bps_iter,channel=channel,simulated=simulated,
+                                          byte_level=byte_level)) 
+                for name,model in n2model.items()]
         
     perf_mean,perf_std = mean_std_performance(performance)
     return performance,perf_mean, perf_std
@@ -329,7 +610,8 @@ if __name__=="__main__":
     bps = 400 #previously 400
 
     bdr = [1,0.99,0.95,0.80]
-    perf_all,perf_mean,perf_std = variation(w2numb,bdr,bps,max_per_point=max_per_point,batch_size=batch_size)
+    perf_all,perf_mean,perf_std = variation(w2numb,bdr,bps,max_per_point=max_per_point,batch_size=batch_size,
+                                            numb_workers=None)
     print("Performance means:", perf_mean)
 #    perf_nn_all,perf_nn_mean,perf_nn_std = variation_exp(w2numb,bdr=bdr,bps=bps,channel='erasure')
 #    plt.figure(2)